@@ -36,6 +36,44 @@ def read_csv(path):
     return pd.read_csv(io.StringIO(''.join(lines)))
 
 
+QC_PREFIX = 'germline_full.metrics.samples.item.QC_summary.'
+QC_FIELDS = ['median_insert_size', 'mean_coverage', 'pct_10x', 'pct_20x']
+
+
+def read_qc_json(path):
+    # Returns only the summary.json values used below, with the same nesting as the file.
+    # With ijson installed the file is streamed and reading stops once all values are found,
+    # so large summaries are never fully loaded. Only the first sample is used.
+    try:
+        import ijson
+    except ImportError:
+        with open(path, 'r') as datfile:
+            return json.loads(datfile.read())
+
+    found = {}
+    with open(path, 'rb') as datfile:
+        for prefix, event, value in ijson.parse(datfile, use_float=True):
+            if prefix == 'metadata.experiment_run.experiment_samples.item.lab_id':
+                found.setdefault('lab_id', value)
+            elif prefix == 'germline_full.outputs' and event == 'map_key':
+                found.setdefault('run_id', value)
+            elif prefix.startswith(QC_PREFIX) and prefix[len(QC_PREFIX):] in QC_FIELDS:
+                found.setdefault(prefix[len(QC_PREFIX):], value)
+            if len(found) == len(QC_FIELDS) + 2:
+                break
+
+    d_dict = {}
+    if 'lab_id' in found:
+        d_dict['metadata'] = {'experiment_run': {
+            'experiment_samples': [{'lab_id': found['lab_id']}]}}
+    if 'run_id' in found or any(field in found for field in QC_FIELDS):
+        d_dict['germline_full'] = {
+            'outputs': {found['run_id']: None} if 'run_id' in found else {},
+            'metrics': {'samples': [{'QC_summary': {
+                field: found[field] for field in QC_FIELDS if field in found}}]}}
+    return d_dict
+
+
 csvfile = args.input
 
 # load csv data
@@ -69,8 +107,7 @@ snpdfrdy = snpdfrdy.drop("index", axis=1)
 snpdfrdy = snpdfrdy.join([indeldfrdy])
 
 # Getting summary.json qc parameter values
-with open(args.qc_json, 'r') as datfile:
-    d_dict = json.loads(datfile.read())
+d_dict = read_qc_json(args.qc_json)
 
 # check if the correct format and get parameter values from json file
 # JSON key shortcut
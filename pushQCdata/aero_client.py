@@ -0,0 +1,419 @@
+"""
+Shared client for the Aero API and the Keycloak token endpoint used by all pushQCdata scripts.
+
+The Keycloak access token is fetched once and reused until shortly before it expires.
+Requests go through one pooled requests.Session per host, so connections are kept alive
+instead of doing a new token fetch and TLS handshake for every call.
+Failed calls are retried with jittered exponential backoff, honouring Retry-After. Only idempotent
+methods are retried on server errors and timeouts; POST and PATCH are only retried on 429, where
+Aero has not processed the call. An optional AdaptiveLimiter bounds the number of calls in flight.
+JSON bodies are sent with compact separators and, for the routes given in compress, gzipped with
+Content-Encoding: gzip. A route answering 415 to a gzipped body gets plain bodies from then on.
+"""
+
+import email.utils
+import gzip
+import json
+import random
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import stage_timing
+
+KEYCLOAKURL = 'https://keycloak.dev.ngc.dk/auth/realms/Ngc/protocol/openid-connect/token'
+AEROURL = 'https://aero-hpc.dev.ngc.dk'
+CERT = '/usr/local/share/ca-certificates/CA-NGC.pem'
+
+
+# Methods that can be sent again without changing the result
+IDEMPOTENT = ('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE')
+# Statuses worth retrying. Only 429 is retried for non-idempotent methods
+RETRYSTATUSES = (429, 500, 502, 503, 504)
+# Statuses telling that Aero is overloaded
+OVERLOADSTATUSES = (429, 503)
+# Routes with the largest bodies, gzipped when compression is asked for without naming routes
+COMPRESSROUTES = ('POST /qc/analyses/{id}/metrics', 'POST /qc/analyses/{id}/id-snp-checks')
+
+
+def facilityNameFromLabID(labID: str) -> str:
+    """Facility name used in Aero API urls from a QC lab_id, e.g. wgs_east_test -> wgs-east
+
+    :param labID: lab_id from the QC json or facility folder name
+    :type labID: str
+    :return: facility name such as wgs-east or wgs-west
+    :rtype: str
+    """
+    # Testing for '_test' suffix in id string:
+    if "_test" in labID:
+        size = len(labID)
+        labID = labID[: size - 5]
+    return labID.replace("_", "-")
+
+
+# Path segments that name a route. Others are IDs
+_ROUTEWORDS = {'qc', 'analyses', 'flowcells', 'metrics', 'id-snp-checks'}
+
+
+def routeName(method: str, url: str) -> str:
+    """Route of a call with facility and IDs left out, e.g. POST /qc/analyses/{id}/metrics
+
+    :param method: HTTP method
+    :type method: str
+    :param url: full url or path. Query string is ignored
+    :type url: str
+    :rtype: str
+    """
+    path = urlsplit(url).path
+    if path.endswith('/token'):
+        return method.upper() + ' /token'
+    parts = path.split('/')
+    if len(parts) > 2 and parts[1] == 'wgs-facilities':
+        parts = [''] + parts[3:]
+    return method.upper() + ' ' + '/'.join(
+        part if not part or part in _ROUTEWORDS else '{id}' for part in parts)
+
+
+def serverTiming(r: requests.Response) -> float:
+    """Server side seconds of a call from its Server-Timing header, None if not given
+
+    :param r: response
+    :type r: requests.Response
+    :rtype: float
+    """
+    durations = []
+    for metric in r.headers.get('Server-Timing', '').split(','):
+        for param in metric.split(';')[1:]:
+            key, _, value = param.strip().partition('=')
+            if key == 'dur':
+                try:
+                    durations.append(float(value.strip('"')) / 1000)
+                except ValueError:
+                    pass
+    # Metrics may overlap, the longest is the best estimate of the total
+    return max(durations) if durations else None
+
+
+def responseBody(r: requests.Response):
+    """Parsed json body of a response, or its text if it is not json (e.g. an html error page from a proxy)
+
+    :param r: response
+    :type r: requests.Response
+    """
+    try:
+        return r.json()
+    except ValueError:
+        return r.text
+
+
+def retryAfter(r: requests.Response) -> float:
+    """Seconds to wait according to the Retry-After header of a response, None if not given
+
+    :param r: response
+    :type r: requests.Response
+    :rtype: float
+    """
+    value = r.headers.get('Retry-After')
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(when.timestamp() - time.time(), 0.0)
+
+
+class AdaptiveLimiter:
+    """AIMD limit on the number of concurrent calls. The limit grows by one per limit successful calls
+    and is halved when a call shows overload: 429/503, a timeout, or latency above latencytarget.
+    Calls that were already in flight when the limit was lowered do not lower it again
+
+    :param maximum: upper bound of the limit, e.g. the number of push workers
+    :type maximum: int
+    :param minimum: lower bound of the limit
+    :type minimum: int
+    :param initial: starting limit. Defaults to maximum
+    :type initial: int
+    :param latencytarget: seconds. Slower calls count as overload. Latency is ignored if not given
+    :type latencytarget: float
+    :param decrease: factor applied to the limit on overload
+    :type decrease: float
+    """
+
+    def __init__(self, maximum: int, minimum: int = 1, initial: int = None,
+                 latencytarget: float = None, decrease: float = 0.5):
+        self.maximum = maximum
+        self.minimum = max(minimum, 1)
+        self.limit = float(min(max(initial or maximum, self.minimum), maximum))
+        self.latencytarget = latencytarget
+        self.decrease = decrease
+        self.inflight = 0
+
+        self._epoch = 0
+        self._cond = threading.Condition()
+
+    def acquire(self) -> int:
+        """Wait for a free slot
+
+        :return: token to give to release
+        :rtype: int
+        """
+        with self._cond:
+            while self.inflight >= int(self.limit):
+                self._cond.wait()
+            self.inflight += 1
+            return self._epoch
+
+    def release(self, token: int, latency: float, overloaded: bool = False) -> None:
+        """Free a slot and adjust the limit from the outcome of the call
+
+        :param token: value returned by acquire
+        :type token: int
+        :param latency: seconds the call took
+        :type latency: float
+        :param overloaded: the call failed in a way that shows overload
+        :type overloaded: bool
+        """
+        with self._cond:
+            self.inflight -= 1
+            if overloaded or (self.latencytarget is not None and latency > self.latencytarget):
+                if token == self._epoch:
+                    self.limit = max(self.minimum, self.limit * self.decrease)
+                    self._epoch += 1
+            else:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self._cond.notify_all()
+
+
+class AeroClient:
+    """Authenticated connection to the Aero API, shared by all calls in a run
+
+    :param usrname: FreeIPA username
+    :type usrname: str
+    :param pw: FreeIPA password
+    :type pw: str
+    :param keycloakurl: Keycloak token endpoint
+    :type keycloakurl: str
+    :param aerourl: base url of the Aero API
+    :type aerourl: str
+    :param cert: CA bundle used to verify both hosts
+    :type cert: str
+    :param poolsize: max kept-alive connections per host
+    :type poolsize: int
+    :param tokenmargin: seconds before expiry at which the token is refreshed
+    :type tokenmargin: float
+    :param timeout: (connect, read) timeout in seconds of each call
+    :type timeout: tuple
+    :param retries: max number of retries of a call
+    :type retries: int
+    :param backoff: base of the exponential backoff in seconds
+    :type backoff: float
+    :param maxbackoff: max wait between retries in seconds, also applied to Retry-After
+    :type maxbackoff: float
+    :param limiter: bound on concurrent calls to the Aero API, shared by all threads
+    :type limiter: AdaptiveLimiter
+    :param compress: routes whose bodies are gzipped, as named by routeName, e.g. COMPRESSROUTES
+    :type compress: tuple
+    :param compressmin: bodies smaller than this many bytes are not worth gzipping
+    :type compressmin: int
+    """
+
+    def __init__(self, usrname: str, pw: str, keycloakurl: str = KEYCLOAKURL,
+                 aerourl: str = AEROURL, cert: str = CERT, poolsize: int = 10,
+                 tokenmargin: float = 30, timeout: tuple = (10, 120), retries: int = 5,
+                 backoff: float = 0.5, maxbackoff: float = 60,
+                 limiter: AdaptiveLimiter = None, compress: tuple = (),
+                 compressmin: int = 1024):
+        self.usrname = usrname
+        self.pw = pw
+        self.keycloakurl = keycloakurl
+        self.aerourl = aerourl.rstrip('/')
+        self.cert = cert
+        self.poolsize = poolsize
+        self.tokenmargin = tokenmargin
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.maxbackoff = maxbackoff
+        self.limiter = limiter
+        self.compress = set(compress)
+        self.compressmin = compressmin
+        self.retried = 0
+
+        self._token = None
+        self._tokenexpiry = 0.0
+        self._tokenlock = threading.Lock()
+        self._sessions = {}
+        self._sessionlock = threading.Lock()
+
+    def facilityURL(self, facilityName: str) -> str:
+        """Base url for calls on a facility, e.g. https://<aero>/wgs-facilities/wgs-east
+
+        :param facilityName: such as wgs-west or wgs-east
+        :type facilityName: str
+        :rtype: str
+        """
+        return self.aerourl + '/wgs-facilities/' + facilityName
+
+    def session(self, url: str) -> requests.Session:
+        """Pooled session for the host of url. Created on first use and reused afterwards
+
+        :param url: any url on the wanted host
+        :type url: str
+        :rtype: requests.Session
+        """
+        parts = urlsplit(url)
+        host = parts.scheme + '://' + parts.netloc
+        with self._sessionlock:
+            if host not in self._sessions:
+                s = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1,
+                                      pool_maxsize=self.poolsize)
+                s.mount(host, adapter)
+                s.verify = self.cert
+                self._sessions[host] = s
+            return self._sessions[host]
+
+    def token(self) -> str:
+        """Keycloak access token. Only fetched when there is none or it is about to expire
+
+        :return: access token
+        :rtype: str
+        """
+        with self._tokenlock:
+            if self._token is None or time.monotonic() >= self._tokenexpiry:
+                self._fetchToken()
+            return self._token
+
+    def invalidateToken(self) -> None:
+        """Forget the cached token so the next call fetches a new one"""
+        with self._tokenlock:
+            self._token = None
+
+    def _fetchToken(self) -> None:
+        header = {'Content-Type': 'application/x-www-form-urlencoded'}
+        with stage_timing.stage('token'):
+            tokenjson = self.session(self.keycloakurl).post(
+                self.keycloakurl, headers=header, timeout=self.timeout,
+                data={'username': self.usrname,
+                      'password': self.pw,
+                      'scope': 'profile',
+                      'grant_type': 'password',
+                      'client_id': 'sqs-web'
+                      })
+        tokenjson.raise_for_status()
+        tokendict = tokenjson.json()
+        self._token = tokendict['access_token']
+        # Keycloak gives lifetime in seconds. Refresh a bit before to avoid
+        # sending a token that expires in flight
+        lifetime = float(tokendict.get('expires_in', 60))
+        self._tokenexpiry = time.monotonic() + max(lifetime - self.tokenmargin, 0)
+
+    def request(self, method: str, url: str, **kwargs) -> requests.Response:
+        """Send an authenticated request. A 401 is retried once with a fresh token. Server errors,
+        throttling and network failures are retried with backoff as far as method allows
+
+        :param method: HTTP method, e.g. 'POST'
+        :type method: str
+        :param url: full url
+        :type url: str
+        :return: response of the last attempt
+        :rtype: requests.Response
+        """
+        method = method.upper()
+        idempotent = method in IDEMPOTENT
+        kwargs.setdefault('timeout', self.timeout)
+        if 'json' in kwargs:
+            # Serialized once for all attempts, compact to keep the body small
+            kwargs['data'] = json.dumps(kwargs.pop('json'), separators=(',', ':')).encode('utf-8')
+            kwargs['headers'] = dict(kwargs.get('headers') or {}, **{'Content-Type': 'application/json'})
+        compressed = self._compressed(routeName(method, url), kwargs.get('data'))
+        for attempt in range(self.retries + 1):
+            try:
+                r = self._send(method, url, compressed, **kwargs)
+            except requests.RequestException as exc:
+                # A failed connect never reached Aero, anything later may have
+                if not (idempotent or isinstance(exc, requests.ConnectTimeout)) or \
+                        attempt == self.retries:
+                    raise
+                wait = None
+            else:
+                if r.status_code not in RETRYSTATUSES or attempt == self.retries or \
+                        not (idempotent or r.status_code == 429):
+                    return r
+                wait = retryAfter(r)
+            if wait is None:
+                # Full jitter keeps concurrent workers from retrying in lockstep
+                wait = random.uniform(0, self.backoff * 2 ** attempt)
+            self.retried += 1
+            time.sleep(min(wait, self.maxbackoff))
+
+    def _compressed(self, route: str, data) -> bytes:
+        # gzipped data if the route takes gzipped bodies and data is large enough, else None
+        if route not in self.compress or not isinstance(data, (bytes, str)) or \
+                len(data) < self.compressmin:
+            return None
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        with stage_timing.stage('gzip ' + route):
+            return gzip.compress(data, compresslevel=5)
+
+    def _send(self, method: str, url: str, compressed: bytes = None, **kwargs) -> requests.Response:
+        # compressed is the gzipped data, sent instead of data as long as the route takes it
+        headers = dict(kwargs.pop('headers', None) or {})
+        route = routeName(method, url)
+        if compressed is not None and route in self.compress:
+            r = self._sendAuthorized(method, url, dict(headers, **{'Content-Encoding': 'gzip'}),
+                                     dict(kwargs, data=compressed))
+            if r.status_code != 415:
+                return r
+            # Aero does not take gzipped bodies on this route, send it plain from now on
+            self.compress.discard(route)
+        return self._sendAuthorized(method, url, headers, kwargs)
+
+    def _sendAuthorized(self, method: str, url: str, headers: dict, kwargs: dict) -> requests.Response:
+        for attempt in range(2):
+            headers['Authorization'] = 'Bearer {}'.format(self.token())
+            token = self.limiter.acquire() if self.limiter is not None else None
+            start = time.monotonic()
+            overloaded = True
+            r = None
+            try:
+                r = self.session(url).request(method, url, headers=headers, **kwargs)
+                overloaded = r.status_code in OVERLOADSTATUSES
+            finally:
+                latency = time.monotonic() - start
+                if self.limiter is not None:
+                    self.limiter.release(token, latency, overloaded)
+                if stage_timing.enabled():
+                    stage_timing.record(
+                        routeName(method, url), latency,
+                        status=r.status_code if r is not None else None,
+                        trace_id=r.headers.get('Trace-ID') if r is not None else None,
+                        server_seconds=serverTiming(r) if r is not None else None)
+            if r.status_code != 401 or attempt == 1:
+                return r
+            self.invalidateToken()
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url: str, **kwargs) -> requests.Response:
+        return self.request('POST', url, **kwargs)
+
+    def patch(self, url: str, **kwargs) -> requests.Response:
+        return self.request('PATCH', url, **kwargs)
+
+    def close(self) -> None:
+        """Close all pooled connections"""
+        with self._sessionlock:
+            for s in self._sessions.values():
+                s.close()
+            self._sessions = {}
@@ -0,0 +1,158 @@
+"""
+Unattended runs of the push scripts: credentials without prompts and sample selection by policy.
+
+Credentials are taken from the AERO_USERNAME and AERO_PASSWORD environment variables or from a file
+with the username on the first line and the password on the second. Only when neither is given and
+prompting is allowed is the user asked, as the scripts always did.
+
+A policy is a json file with include and exclude rules, e.g.
+
+    {"include": [{"check": "passed", "facility": "wgs_east"},
+                 {"samplename": ["S0*", "S1*"]}],
+     "exclude": [{"flowcell": "HTFHC0MXX"}]}
+
+A rule matches a row when every field it names matches one of its patterns (shell style, as in
+fnmatch). A row is selected when it matches an include rule, or there are none, and no exclude rule.
+"""
+
+import getpass
+import json
+import logging
+import os
+from fnmatch import fnmatchcase
+from pathlib import Path
+
+from aero_client import facilityNameFromLabID
+from json_list import JsonRow, flowcellGroup
+
+log = logging.getLogger(__name__)
+
+USERNAMEVAR = 'AERO_USERNAME'
+PASSWORDVAR = 'AERO_PASSWORD'
+
+# Fields a policy rule can filter on
+POLICYFIELDS = ('check', 'facility', 'flowcell', 'shortname', 'samplename')
+
+
+def readCredentials(path: Path = None, prompt: bool = True) -> tuple:
+    """Aero username and password from a credentials file, the environment or a prompt, in that order
+
+    :param path: file with the username on the first line and the password on the second
+    :type path: Path
+    :param prompt: ask for them if they are not given otherwise
+    :type prompt: bool
+    :raises SystemExit: if they are not given and prompt is False
+    :return: username and password
+    :rtype: tuple
+    """
+    if path is not None:
+        if os.stat(path).st_mode & 0o077:
+            log.warning("%s can be read by other users, chmod 600 it", path)
+        lines = Path(path).read_text().splitlines()
+        if len(lines) < 2 or not lines[0].strip():
+            raise SystemExit("{} should have the username on the first line and the password on the "
+                             "second".format(path))
+        return lines[0].strip(), lines[1]
+    usrname, pw = os.environ.get(USERNAMEVAR), os.environ.get(PASSWORDVAR)
+    if usrname and pw is not None:
+        return usrname, pw
+    if not prompt:
+        raise SystemExit("No credentials: set {} and {} or give a credentials file".format(
+            USERNAMEVAR, PASSWORDVAR))
+    usrname = input("\nEnter username...\n")
+    pw = getpass.getpass("\nEnter password...\n")
+    return usrname, pw
+
+
+def _patterns(value) -> tuple:
+    if isinstance(value, str):
+        return (value,)
+    if isinstance(value, list) and value and all(isinstance(item, str) for item in value):
+        return tuple(value)
+    raise ValueError("patterns must be a string or a list of strings, got {!r}".format(value))
+
+
+class SamplePolicy:
+    """Selects rows of a json path csv by include and exclude rules
+
+    :param include: rules of which a row must match one. All rows are included if empty
+    :type include: list
+    :param exclude: rules of which a row must match none
+    :type exclude: list
+    :raises ValueError: if a rule names an unknown field or has no patterns
+    """
+
+    def __init__(self, include: list = (), exclude: list = ()):
+        self.include = [self._compile(rule) for rule in include]
+        self.exclude = [self._compile(rule) for rule in exclude]
+
+    @staticmethod
+    def _compile(rule: dict) -> dict:
+        if not isinstance(rule, dict) or not rule:
+            raise ValueError("a rule must be a non-empty object, got {!r}".format(rule))
+        unknown = sorted(set(rule) - set(POLICYFIELDS))
+        if unknown:
+            raise ValueError("unknown fields {}, rules can filter on {}".format(
+                ', '.join(unknown), ', '.join(POLICYFIELDS)))
+        return {field: _patterns(value) for field, value in rule.items()}
+
+    @staticmethod
+    def _values(row: JsonRow) -> dict:
+        # The facility is matched both as the lab id of the csv and as the facility name of Aero urls
+        return {'check': (row.check,),
+                'facility': (row.facility, facilityNameFromLabID(row.facility)),
+                'flowcell': (flowcellGroup(row)[0],),
+                'shortname': (row.shortname,),
+                'samplename': (row.samplename,)}
+
+    @staticmethod
+    def _matches(rule: dict, values: dict) -> bool:
+        return all(any(fnmatchcase(value, pattern) for value in values[field] for pattern in patterns)
+                   for field, patterns in rule.items())
+
+    def selects(self, row: JsonRow) -> bool:
+        """Whether row is selected by the policy
+
+        :param row: csv row
+        :type row: JsonRow
+        :rtype: bool
+        """
+        values = self._values(row)
+        if self.include and not any(self._matches(rule, values) for rule in self.include):
+            return False
+        return not any(self._matches(rule, values) for rule in self.exclude)
+
+
+def loadPolicy(path: Path) -> SamplePolicy:
+    """Read a policy file
+
+    :param path: json file with include and exclude lists of rules
+    :type path: Path
+    :raises SystemExit: if the file is not a valid policy
+    :rtype: SamplePolicy
+    """
+    with open(path) as src:
+        try:
+            spec = json.load(src)
+        except json.JSONDecodeError as e:
+            raise SystemExit("{} is not valid json: {}".format(path, e))
+    if not isinstance(spec, dict) or set(spec) - {'include', 'exclude'}:
+        raise SystemExit("{} should be an object with only include and exclude lists".format(path))
+    try:
+        return SamplePolicy(spec.get('include', ()), spec.get('exclude', ()))
+    except ValueError as e:
+        raise SystemExit("{}: {}".format(path, e))
+
+
+def selectedFlowcells(rows, policy: SamplePolicy) -> set:
+    """Flowcell groups with at least one row selected by the policy. Flowcells are registered with all
+    their samples, so their unselected rows still have to be read
+
+    :param rows: rows of a json path csv
+    :type rows: Iterable[JsonRow]
+    :param policy: sample selection
+    :type policy: SamplePolicy
+    :return: json_list.flowcellGroup of the selected rows
+    :rtype: set
+    """
+    return {flowcellGroup(row) for row in rows if policy.selects(row)}
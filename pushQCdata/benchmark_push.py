@@ -0,0 +1,249 @@
+"""
+End-to-end throughput benchmark of the push path against a local mock Aero server.
+
+Writes N synthetic summary.json files, registers their flowcells with runFlowcellCalls and pushes
+every sample through runApiCalls on the push engine, exactly like push_historic_files.py does.
+Reports samples/sec, p50/p99 latency per API call, the total number of round-trips and the
+request body bytes sent.
+
+Input: number of samples, workers and mock server options (or --url of a running server)
+Output: report on stdout, optionally also as json
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+from aero_client import COMPRESSROUTES, AdaptiveLimiter, AeroClient, routeName
+from mock_aero import MockAero
+from push_engine import PushEngine
+from qc_documents import QCDocuments
+import push_historic_files as push
+import stage_timing
+
+
+def syntheticQC(i: int, lab: str, flowcell: str, run: int, sites: int = 100,
+                rng: random.Random = random) -> dict:
+    """QC json of a made-up sample with every field the reshapers use
+
+    :param i: sample number, used in names and IDs
+    :type i: int
+    :param lab: lab_id, e.g. wgs_east
+    :type lab: str
+    :param flowcell: flowcell ID
+    :type flowcell: str
+    :param run: run number
+    :type run: int
+    :param sites: number of idsnp sites
+    :type sites: int
+    :rtype: dict
+    """
+    details = {}
+    for k in range(sites):
+        site = {'position': ['chr{}:{}'.format(k % 22 + 1, 1000 * k)]}
+        for side in ('query', 'target'):
+            for base in ('A', 'T', 'G', 'C', 'N', 'gap'):
+                site['{}.{}.count'.format(side, base)] = [rng.randint(0, 50)]
+        details['rs{}'.format(1000 + k)] = site
+    rsIDs = list(details)
+    runID = '200622_A00559_{:04d}_A{}'.format(run, flowcell)
+    return {
+        'metadata': {'experiment_run': {
+            'lab_id': [lab], 'flowcell_id': [flowcell], 'run_number': [run],
+            'instrument_serial_nr': ['A00559'], 'run_id': [runID], 'start_time': ['2020-06-22'],
+            'read_type': ['paired'], 'flowcell_type': ['S4'],
+            'experiment_samples': [{
+                'sample_name': 'BENCH{:05d}'.format(i), 'subject_id': 'sub{}'.format(i),
+                'sample_id': 'sid{}'.format(i), 'ngc_subject_id': 'ngc{}'.format(i),
+                'registration_id': 'reg{}'.format(i), 'flow_id': 'flow', 'library_id': 'lib{}'.format(i),
+                'lab_id': lab, 'protocol_id': 'prot', 'registered_sample_id': 'rsid{}'.format(i),
+                'idsnp_sample_name': 'idsnp{}'.format(i)}]}},
+        'germline_full': {'outputs': {}, 'metrics': {'samples': [{'QC_summary': {
+            'pct_duplicates': 0.1234567, 'pct_q30': 0.9312, 'median_insert_size': 412,
+            'm_reads_mapped': 812.345678, 'mean_coverage': 33.2, 'sd_coverage': 8.1,
+            'pct_10x': 0.99, 'pct_20x': 0.97, 'pct_30x': 0.57, 'M_nSNPs_all': 4.56789,
+            'pct_SNPs_known': 0.989, 'pct_SNPs_novel': 0.011, 'tiTvRatio_all': 2.01,
+            'tiTvRatio_known': 2.05, 'tiTvRatio_novel': 1.6, 'hetHomRatio_all': 1.5,
+            'hetHomRatio_known': 1.4, 'hetHomRatio_novel': 3.1, 'msk_pct_regions': 0.3,
+            'msk_pct_homozygous_sites': 12.5, 'msk_meanpct_minorallele': 0.0123,
+            'insert_size_value': ';'.join(str(x) for x in range(1, 800)),
+            'insert_size_frequency': ';'.join(str(rng.randint(0, 99999)) for _ in range(1, 800)),
+            'alt_freq_all_value': ';'.join('{:.2f}'.format(x / 100) for x in range(0, 101)),
+            'alt_freq_all_frequency': ';'.join(str(rng.randint(0, 99999)) for _ in range(0, 101)),
+        }}]}},
+        'all_idsnp_comparisons': {'comparison': {'details': {
+            'all': details, 'invalid': rsIDs[:2], 'mismatches': rsIDs[2:5], 'matches': rsIDs[5:]}}},
+    }
+
+
+def writeSamples(folder: str, samples: int, perflowcell: int = 24, sites: int = 100,
+                 seed: int = 1) -> list:
+    """Write synthetic summary.json files in the folder layout of get_json_paths.py
+
+    :param folder: root folder
+    :type folder: str
+    :param samples: number of samples
+    :type samples: int
+    :param perflowcell: samples per flowcell
+    :type perflowcell: int
+    :param sites: number of idsnp sites per sample
+    :type sites: int
+    :return: rows of path,check,facility,NBA,shortname,samplename,file as read from a get_json_paths.py csv
+    :rtype: list
+    """
+    rng = random.Random(seed)
+    rows = []
+    for i in range(samples):
+        lab = ('wgs_east', 'wgs_west')[i // perflowcell % 2]
+        run = 200 + i // perflowcell
+        flowcell = 'BENCH{:04d}X'.format(i // perflowcell)
+        check = 'failed' if i % 10 == 0 else 'passed'
+        shortname = '200622_A00559_{:04d}_A{}'.format(run, flowcell)
+        samplename = 'BENCH{:05d}'.format(i)
+        path = os.path.join(folder, check, lab, 'NBA2', shortname, samplename)
+        os.makedirs(path, exist_ok=True)
+        jsonpath = os.path.join(path, 'summary.json')
+        with open(jsonpath, 'w') as fp:
+            json.dump(syntheticQC(i, lab, flowcell, run, sites, rng), fp)
+        rows.append([jsonpath, check, lab, 'NBA2', shortname, samplename, 'summary.json'])
+    return rows
+
+
+def percentile(values: list, q: float) -> float:
+    """Nearest-rank percentile, q in 0-100"""
+    if not values:
+        return float('nan')
+    ordered = sorted(values)
+    rank = max(int(round(q / 100 * len(ordered) + 0.5)) - 1, 0)
+    return ordered[min(rank, len(ordered) - 1)]
+
+
+def runBenchmark(rows: list, url: str, workers: int = 8, compress: tuple = ()) -> dict:
+    """Push all samples in rows to the Aero API at url and measure it
+
+    :param rows: rows as returned by writeSamples
+    :type rows: list
+    :param url: base url of a (mock) server with the token endpoint at <url>/token
+    :type url: str
+    :param workers: samples pushed concurrently
+    :type workers: int
+    :param compress: routes whose request bodies are gzipped
+    :type compress: tuple
+    :return: report with samples/sec, per call latencies, round-trips and bytes sent
+    :rtype: dict
+    """
+    client = AeroClient('benchmark', 'benchmark', keycloakurl=url + '/token', aerourl=url,
+                        limiter=AdaptiveLimiter(workers), compress=compress)
+    latencies = {}
+    sent = {}
+    lock = threading.Lock()
+
+    def record(r, *args, **kwargs):
+        # r.elapsed is the time from sending the request until the response headers arrived
+        route = routeName(r.request.method, r.request.url)
+        with lock:
+            latencies.setdefault(route, []).append(r.elapsed.total_seconds())
+            sent[route] = sent.get(route, 0) + len(r.request.body or b'')
+
+    hooked = set()
+    for s in (client.session(client.keycloakurl), client.session(client.aerourl)):
+        if id(s) not in hooked:
+            s.hooks['response'].append(record)
+            hooked.add(id(s))
+
+    documents = QCDocuments()
+    engine = PushEngine(workers)
+    start = time.perf_counter()
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        push.runFlowcellCalls(rows, 'send', client, documents=documents)
+        for row in rows:
+            engine.submit(push.facilityNameFromLabID(row[2]), row[5], push.pushSample,
+                          row[0], row[1], 'send', client, None, documents)
+        failed = engine.wait()
+    seconds = time.perf_counter() - start
+    engine.shutdown()
+    client.close()
+
+    calls = {route: {'count': len(values),
+                     'p50_ms': percentile(values, 50) * 1000,
+                     'p99_ms': percentile(values, 99) * 1000,
+                     'sent_kb': sent.get(route, 0) / 1024}
+             for route, values in sorted(latencies.items())}
+    return {'samples': len(rows),
+            'failed': len(failed),
+            'workers': workers,
+            'seconds': seconds,
+            'samples_per_sec': len(rows) / seconds if seconds else float('nan'),
+            'roundtrips': sum(call['count'] for call in calls.values()),
+            'retries': client.retried,
+            'sent_kb': sum(sent.values()) / 1024,
+            'calls': calls}
+
+
+def printReport(report: dict) -> None:
+    sys.stdout.write('{samples} samples ({failed} failed) with {workers} workers in {seconds:.2f} s: '
+                     '{samples_per_sec:.1f} samples/sec, {roundtrips} round-trips, '
+                     '{retries} retries, {sent_kb:.0f} kB sent\n'.format(**report))
+    sys.stdout.write('{:<40} {:>7} {:>9} {:>9} {:>9}\n'.format('call', 'count', 'p50 ms', 'p99 ms', 'sent kB'))
+    for route, call in report['calls'].items():
+        sys.stdout.write('{:<40} {count:>7} {p50_ms:>9.2f} {p99_ms:>9.2f} {sent_kb:>9.0f}\n'.format(
+            route, **call))
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        description=__doc__)
+    parser.add_argument('--samples', type=int, default=200, help="Number of synthetic samples")
+    parser.add_argument('--workers', type=int, default=8, help="Samples pushed concurrently")
+    parser.add_argument('--sites', type=int, default=100, help="idsnp sites per sample")
+    parser.add_argument('--per-flowcell', type=int, default=24, help="Samples per flowcell")
+    parser.add_argument('--url', help="Base url of an already running server instead of a local mock")
+    parser.add_argument('--latency', type=float, default=0.005,
+                        help="Local mock: mean added server time per call in seconds")
+    parser.add_argument('--jitter', type=float, default=0.0,
+                        help="Local mock: added server time varies by up to this many seconds")
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help="Local mock: fraction of calls answered with 503")
+    parser.add_argument('--throttle-rate', type=float, default=0.0,
+                        help="Local mock: fraction of calls answered with 429")
+    parser.add_argument('--gzip', action='store_true',
+                        help="gzip the request bodies of the metrics and idsnp-check posts")
+    parser.add_argument('--no-gzip-server', action='store_true',
+                        help="Local mock: answer gzipped bodies with 415")
+    parser.add_argument('--json', dest='jsonout', help="Also write the report to this json file")
+    parser.add_argument('--timings', help="Write per-stage timings as json lines to this file and print their summary")
+    args = parser.parse_args()
+
+    if args.timings:
+        stage_timing.enable(args.timings)
+
+    with tempfile.TemporaryDirectory(prefix='benchmark_push_') as folder:
+        rows = writeSamples(folder, args.samples, args.per_flowcell, args.sites)
+        mock = None
+        url = args.url
+        if url is None:
+            mock = MockAero(latency=args.latency, jitter=args.jitter, errorrate=args.error_rate,
+                            throttlerate=args.throttle_rate, seed=1,
+                            acceptgzip=not args.no_gzip_server).start()
+            url = mock.url
+        report = runBenchmark(rows, url.rstrip('/'), args.workers,
+                              COMPRESSROUTES if args.gzip else ())
+        if mock is not None:
+            report['server_roundtrips'] = mock.roundtrips()
+            mock.stop()
+
+    printReport(report)
+    timer = stage_timing.disable()
+    if timer is not None:
+        sys.stdout.write('\n' + timer.summary())
+    if args.jsonout:
+        with open(args.jsonout, 'w') as fp:
+            json.dump(report, fp, indent=2)
@@ -0,0 +1,77 @@
+"""
+Logging of Aero API calls: one line per call instead of the full request and response.
+
+Each call is logged at INFO as method, route, status, duration, bytes sent and received, the
+Trace-ID and the sample it was made for. The full request and response bodies are only logged at
+DEBUG, for a sampled fraction of the calls (configure(bodies=...)), or when the call failed.
+Bodies are taken from the prepared request, so nothing is serialized again just to be logged.
+"""
+
+import gzip
+import json
+import logging
+import random
+import sys
+
+from aero_client import responseBody, routeName
+import stage_timing
+
+# Fraction of calls whose bodies are logged at INFO
+_bodies = 0.0
+
+
+def configure(level: str = "INFO", bodies: float = 0.0, stream=None) -> None:
+    """Set up logging for a script run
+
+    :param level: log level name, DEBUG logs every body
+    :type level: str
+    :param bodies: fraction of calls, 0 to 1, whose bodies are logged at INFO as well
+    :type bodies: float
+    :param stream: stream to log to, stdout by default like the output it replaces
+    """
+    global _bodies
+    _bodies = bodies
+    logging.basicConfig(level=getattr(logging, level.upper()), format="%(message)s",
+                        stream=stream or sys.stdout)
+
+
+def _bodyText(request) -> str:
+    body = request.body
+    if body is None:
+        return ""
+    if request.headers.get("Content-Encoding") == "gzip":
+        body = gzip.decompress(body)
+    if isinstance(body, bytes):
+        return body.decode("utf-8", "replace")
+    return body
+
+
+def logExchange(log: logging.Logger, r) -> None:
+    """Log one Aero API call from its response
+
+    :param log: logger of the calling module
+    :type log: logging.Logger
+    :param r: response of the call
+    :type r: requests.Response
+    """
+    failed = r.status_code >= 400
+    if not failed and not log.isEnabledFor(logging.INFO):
+        return
+    request = r.request
+    sent = request.body or b""
+    tags = "".join(" {}={}".format(key, value) for key, value in stage_timing.currentTags().items())
+    log.log(logging.WARNING if failed else logging.INFO,
+            "%s %s %.3fs sent %dB%s received %dB Trace-ID %s%s",
+            routeName(request.method, request.url), r.status_code, r.elapsed.total_seconds(),
+            len(sent), " gzip" if request.headers.get("Content-Encoding") == "gzip" else "",
+            len(r.content), r.headers.get("Trace-ID", ""), tags)
+    if failed:
+        level = logging.WARNING
+    elif _bodies and random.random() < _bodies:
+        level = logging.INFO
+    elif log.isEnabledFor(logging.DEBUG):
+        level = logging.DEBUG
+    else:
+        return
+    log.log(level, "SENT:\n%s\nRECEIVED:\n%s", _bodyText(request),
+            json.dumps(responseBody(r), indent=2))
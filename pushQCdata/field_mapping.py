@@ -0,0 +1,217 @@
+"""
+Declarative mapping from QC json fields to Aero API payloads.
+
+A spec is a dict or list shaped like the payload. Its leaves say where each value comes from:
+Field (source path in the QC json plus an optional converter), Param (value given by the caller)
+or Check (a condition on source fields, evaluated but not put in the payload).
+compileSpec turns a spec into a function once, so applying it to a document is only lookups and
+converter calls. All fields missing from a document are reported together in one MissingFieldsError.
+"""
+
+from typing import Callable
+
+# Named subtrees of the QC json. Field paths may start with one of these names instead of
+# the full path. Roots may be built on earlier roots and are looked up once per document.
+QCROOTS = {
+    "er": ("metadata", "experiment_run"),
+    "es": ("er", "experiment_samples", 0),
+    "qcs": ("germline_full", "metrics", "samples", 0, "QC_summary"),
+    "idsnp": ("all_idsnp_comparisons",),
+}
+
+
+class MissingFieldsError(KeyError):
+    """Raised when fields used by a spec are not in the QC json. Lists all of them at once
+
+    :param missing: dotted paths of the missing fields
+    :type missing: list
+    """
+
+    def __init__(self, missing: list):
+        self.missing = missing
+        super().__init__('Missing fields in QC json: ' + ', '.join(missing))
+
+    def __str__(self):
+        return self.args[0]
+
+
+class Field:
+    """Value taken from the QC json
+
+    :param paths: source paths, e.g. ("er", "run_id", 0). With more than one path, convert gets one argument per path
+    :type paths: tuple
+    :param convert: converter applied to the source value(s)
+    :type convert: Callable
+    """
+
+    def __init__(self, *paths: tuple, convert: Callable = None):
+        self.paths = paths
+        self.convert = convert
+
+
+class Param:
+    """Value given by the caller when applying the spec, e.g. a perm ID
+
+    :param name: keyword argument name
+    :type name: str
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+
+
+class Check:
+    """Condition on source values that must hold. Raises AssertionError(message) if test returns False.
+    Checks are evaluated with the rest of the spec but not put in the payload
+
+    :param paths: source paths passed to test
+    :type paths: tuple
+    :param test: function returning True if the values are valid
+    :type test: Callable
+    :param message: message of the AssertionError
+    :type message: str
+    """
+
+    def __init__(self, *paths: tuple, test: Callable, message: str = ""):
+        self.paths = paths
+        self.test = test
+        self.message = message
+
+
+_MISSING = object()
+
+
+def _dotted(path: tuple) -> str:
+    return ''.join('[{}]'.format(key) if isinstance(key, int) else '.' + key
+                   for key in path).lstrip('.')
+
+
+def _expand(path: tuple, roots: dict) -> tuple:
+    """Full document path of a path that may start with a root name"""
+    if path and path[0] in roots:
+        return _expand(roots[path[0]], roots) + tuple(path[1:])
+    return tuple(path)
+
+
+def _getter(path: tuple, roots: dict, used: set) -> Callable:
+    """Accessor for path, returning _MISSING and recording the path if it is not in the document"""
+    if path and path[0] in roots:
+        root, rest = path[0], tuple(path[1:])
+        used.add(root)
+    else:
+        root, rest = None, tuple(path)
+    fullpath = _dotted(_expand(path, roots))
+
+    def get(doc: dict, resolved: dict, missing: list):
+        node = doc if root is None else resolved[root]
+        if node is _MISSING:
+            missing.append(fullpath)
+            return _MISSING
+        try:
+            for key in rest:
+                node = node[key]
+        except (KeyError, IndexError, TypeError):
+            missing.append(fullpath)
+            return _MISSING
+        return node
+    return get
+
+
+def _compile(spec, roots: dict, used: set) -> Callable:
+    if isinstance(spec, dict):
+        items = [(key, _compile(value, roots, used), isinstance(value, Check))
+                 for key, value in spec.items()]
+
+        def build(doc, resolved, params, missing):
+            out = {}
+            for key, fn, ischeck in items:
+                value = fn(doc, resolved, params, missing)
+                if not ischeck:
+                    out[key] = value
+            return out
+        return build
+
+    if isinstance(spec, list):
+        elements = [_compile(value, roots, used) for value in spec]
+
+        def build(doc, resolved, params, missing):
+            return [fn(doc, resolved, params, missing) for fn in elements]
+        return build
+
+    if isinstance(spec, Param):
+        name = spec.name
+
+        def build(doc, resolved, params, missing):
+            return params[name]
+        return build
+
+    if isinstance(spec, (Field, Check)):
+        getters = [_getter(path, roots, used) for path in spec.paths]
+        if isinstance(spec, Check):
+            test, message = spec.test, spec.message
+
+            def convert(*values):
+                assert test(*values), message
+        else:
+            convert = spec.convert
+
+        if len(getters) == 1 and convert is None:
+            get = getters[0]
+
+            def build(doc, resolved, params, missing):
+                return get(doc, resolved, missing)
+            return build
+
+        def build(doc, resolved, params, missing):
+            values = [get(doc, resolved, missing) for get in getters]
+            if any(value is _MISSING for value in values):
+                return _MISSING
+            return convert(*values) if convert is not None else values[0]
+        return build
+
+    raise TypeError('Unknown spec leaf: {!r}'.format(spec))
+
+
+def compileSpec(spec, roots: dict = QCROOTS) -> Callable:
+    """Compile a spec into a function applying it to a QC json document.
+
+    The returned function is called as fn(raw_qc, **params) and returns the payload. It raises
+    MissingFieldsError listing every missing field if any are missing.
+
+    :param spec: dict or list shaped like the payload with Field, Param and Check leaves
+    :param roots: named subtrees that field paths can start with
+    :type roots: dict
+    :return: function building the payload from a QC json document
+    :rtype: Callable
+    """
+    used = set()
+    build = _compile(spec, roots, used)
+
+    # Only roots used by the spec are looked up, in an order where a root
+    # comes after the roots it is built on
+    order = []
+
+    def addroot(name):
+        if name in order:
+            return
+        path = roots[name]
+        if path and path[0] in roots:
+            addroot(path[0])
+        order.append(name)
+    for name in sorted(used):
+        addroot(name)
+    rootgetters = [(name, _getter(roots[name], roots, set())) for name in order]
+
+    def apply(raw_qc: dict, **params):
+        missing = []
+        resolved = {}
+        rootmissing = []
+        for name, get in rootgetters:
+            resolved[name] = get(raw_qc, resolved, rootmissing)
+        payload = build(raw_qc, resolved, params, missing)
+        if missing:
+            # Report each field once, in spec order
+            raise MissingFieldsError(list(dict.fromkeys(missing)))
+        return payload
+
+    return apply
@@ -0,0 +1,146 @@
+"""
+Persistent index of flowcell registrations, so flowcells are built incrementally across runs.
+
+Stores per flowcell key <flowcellID>-<lab_id> the flowcell fields checked for consistency (run
+number, run ID, date) and per sample json the flowcell it belongs to, its entry in the samples
+list and the size and mtime of the file. Merging a list of jsons only parses files that are new or
+changed since the index last saw them, and checks them against the stored flowcell fields instead
+of reloading all other samples of the flowcell. Flowcells whose samples changed are marked until
+they are emitted, so a rerun after a failure emits them again.
+"""
+
+import json
+import os
+import sqlite3
+from pathlib import Path
+
+from qc_documents import QCDocuments
+from reshape_flowcell import checkFlowcell, flowcellParts
+
+
+class FlowcellIndex:
+    """SQLite backed index of flowcells and their samples
+
+    :param path: path to the index file. Created if it does not exist
+    :type path: Path
+    """
+
+    def __init__(self, path: Path):
+        self.path = str(path)
+        self._con = sqlite3.connect(self.path)
+        self._con.execute('PRAGMA journal_mode=WAL')
+        self._con.execute("""
+            CREATE TABLE IF NOT EXISTS flowcells (
+                key TEXT PRIMARY KEY,
+                fields TEXT NOT NULL,
+                changed INTEGER NOT NULL,
+                updated TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP
+            )""")
+        self._con.execute("""
+            CREATE TABLE IF NOT EXISTS samples (
+                jsonpath TEXT PRIMARY KEY,
+                key TEXT NOT NULL,
+                sample TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                mtime INTEGER NOT NULL
+            )""")
+        self._con.execute('CREATE INDEX IF NOT EXISTS samples_key ON samples (key)')
+        self._con.commit()
+
+    def _fields(self, key: str) -> dict:
+        row = self._con.execute('SELECT fields FROM flowcells WHERE key = ?', (key,)).fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    def _markChanged(self, key: str) -> None:
+        self._con.execute('UPDATE flowcells SET changed = 1, updated = CURRENT_TIMESTAMP WHERE key = ?',
+                          (key,))
+
+    def merge(self, rows, documents: QCDocuments = None) -> set:
+        """Add new and changed sample jsons to their flowcells. Unchanged files are not read
+
+        :param rows: rows of a json path csv
+        :type rows: Iterable[JsonRow]
+        :param documents: parsed document cache shared with later stages of the run
+        :type documents: QCDocuments
+        :raises SystemExit: if a sample disagrees with the stored fields of its flowcell
+        :raises MissingFieldsError: listing all fields missing from a json
+        :return: keys of the flowcells changed by this merge
+        :rtype: set
+        """
+        if documents is None:
+            documents = QCDocuments(maxbytes=0)
+        changed = set()
+        with self._con:
+            for row in rows:
+                jsonpath = str(row[0])
+                stat = os.stat(jsonpath)
+                known = self._con.execute('SELECT key, sample, size, mtime FROM samples WHERE jsonpath = ?',
+                                          (jsonpath,)).fetchone()
+                if known is not None and known[2:] == (stat.st_size, stat.st_mtime_ns):
+                    continue
+
+                key, flowcell, sample, checklist = flowcellParts(jsonpath, documents.get(jsonpath))
+                previous = self._fields(key)
+                if previous is None:
+                    self._con.execute('INSERT INTO flowcells (key, fields, changed) VALUES (?, ?, 1)',
+                                      (key, json.dumps(flowcell)))
+                else:
+                    checkFlowcell(previous, flowcell, checklist, jsonpath)
+
+                entry = json.dumps(sample)
+                self._con.execute(
+                    'INSERT INTO samples VALUES (?, ?, ?, ?, ?) ON CONFLICT (jsonpath) DO UPDATE SET '
+                    'key = excluded.key, sample = excluded.sample, size = excluded.size, mtime = excluded.mtime',
+                    (jsonpath, key, entry, stat.st_size, stat.st_mtime_ns))
+                if known is None or known[:2] != (key, entry):
+                    changed.add(key)
+                    self._markChanged(key)
+                    if known is not None and known[0] != key:
+                        # The json moved to another flowcell, which loses a sample
+                        changed.add(known[0])
+                        self._markChanged(known[0])
+        return changed
+
+    def changed(self) -> list:
+        """Keys of the flowcells changed since they were last emitted
+
+        :rtype: list
+        """
+        return [row[0] for row in self._con.execute('SELECT key FROM flowcells WHERE changed = 1 ORDER BY key')]
+
+    def flowcell(self, key: str) -> dict:
+        """Flowcell json with all samples indexed for it, in the order they were first added
+
+        :param key: <flowcellID>-<lab_id>
+        :type key: str
+        :raises KeyError: if the flowcell is not in the index
+        :rtype: dict
+        """
+        fields = self._fields(key)
+        if fields is None:
+            raise KeyError(key)
+        samples = [json.loads(row[0]) for row in self._con.execute(
+            'SELECT sample FROM samples WHERE key = ? ORDER BY rowid', (key,))]
+        return dict(fields, samples=samples)
+
+    def flowcellKey(self, jsonpath: str) -> str:
+        """Key of the flowcell a sample json was indexed for. None if it is not in the index
+
+        :param jsonpath: path to the sample json
+        :type jsonpath: str
+        :rtype: str
+        """
+        row = self._con.execute('SELECT key FROM samples WHERE jsonpath = ?', (str(jsonpath),)).fetchone()
+        return row[0] if row is not None else None
+
+    def markEmitted(self, key: str) -> None:
+        """Record that the flowcell was sent or saved as it is now
+
+        :param key: <flowcellID>-<lab_id>
+        :type key: str
+        """
+        with self._con:
+            self._con.execute('UPDATE flowcells SET changed = 0 WHERE key = ?', (key,))
+
+    def close(self) -> None:
+        self._con.close()
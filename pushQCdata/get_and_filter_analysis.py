@@ -1,72 +1,189 @@
-
 """
-Script for reshaping NBA-2 Germline pipeline QC JSON into something more suitable for
-HTTP POST analyses payloads.
+Script for fetching analyses from the Aero API and filtering out the keys needed for further
+bioinformatic processing.
+
 
-Input: csv file with paths of sample json files in first column of each row. Extra columns are ignored.
-Output: reshaped json file for each sample. Instead of saving, they can be directly sent as request with option -r
+Input: analysisPermID and facility, or with --bulk a file of analysisPermIDs, each optionally followed
+by the lastUpdateDatetime it is known to have
+Output: filtered analysis json on stdout. Fetched analyses can be cached locally with --cache. A cached
+analysis is only used if its lastUpdateDatetime is the known one, or with --max-age while it is young enough
 """
 
 import argparse
 import json
+import logging
+import sqlite3
 import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from aero_client import AeroClient
+from call_log import logExchange
+import call_log
+
+log = logging.getLogger(__name__)
+
+
+class AnalysisCache:
+    """SQLite cache of GET qc/analyses responses keyed by perm ID and facility. Each keeps the
+    lastUpdateDatetime of the analysis, to tell whether it is still current
+
+    :param path: path to the cache file. Created if it does not exist
+    :type path: Path
+    """
+
+    def __init__(self, path: Path):
+        self.path = str(path)
+        self._lock = threading.Lock()
+        self._con = sqlite3.connect(self.path, check_same_thread=False)
+        self._con.execute('PRAGMA journal_mode=WAL')
+        # Cache files written before the facility was part of the key are dropped, they are only a cache
+        # table_info rows are (cid, name, type, notnull, default, position in the primary key)
+        keycolumns = sorted((row[5], row[1]) for row in self._con.execute('PRAGMA table_info(analyses)') if row[5])
+        if keycolumns and [name for _, name in keycolumns] != ['permID', 'facility']:
+            self._con.execute('DROP TABLE analyses')
+        self._con.execute("""
+            CREATE TABLE IF NOT EXISTS analyses (
+                permID TEXT NOT NULL,
+                lastUpdateDatetime TEXT NOT NULL,
+                facility TEXT NOT NULL,
+                analysis TEXT NOT NULL,
+                fetched REAL NOT NULL,
+                PRIMARY KEY (permID, facility)
+            )""")
+        self._con.commit()
+
+    def get(self, permID: str, facilityName: str, lastUpdateDatetime: str = None,
+            maxage: float = None) -> dict:
+        """Cached analysis of permID as fetched from facilityName, if it is known to be current.
+        That is when it has the given lastUpdateDatetime or, if none is given, is younger than maxage.
+        Without either the entry counts as expired, since the analysis may have changed on Aero
+
+        :param permID: analysis perm ID
+        :type permID: str
+        :param facilityName: facility the analysis is fetched from
+        :type facilityName: str
+        :param lastUpdateDatetime: lastUpdateDatetime the analysis has on Aero
+        :type lastUpdateDatetime: str
+        :param maxage: seconds an entry is served without a known lastUpdateDatetime
+        :type maxage: float
+        :return: analysis json, None if not cached or not current
+        :rtype: dict
+        """
+        with self._lock:
+            row = self._con.execute(
+                'SELECT analysis, lastUpdateDatetime, fetched FROM analyses WHERE permID = ? AND facility = ?',
+                (permID, facilityName)).fetchone()
+        if row is None:
+            return None
+        if lastUpdateDatetime is not None:
+            current = row[1] == lastUpdateDatetime
+        else:
+            current = maxage is not None and time.time() - row[2] <= maxage
+        return json.loads(row[0]) if current else None
+
+    def put(self, permID: str, facilityName: str, analysisjson: dict) -> None:
+        """Store an analysis as fetched now
 
-import requests
+        :param permID: analysis perm ID
+        :type permID: str
+        :param facilityName: facility the analysis was fetched from
+        :type facilityName: str
+        :param analysisjson: response json of GET qc/analyses/permID
+        :type analysisjson: dict
+        """
+        with self._lock:
+            self._con.execute(
+                'INSERT OR REPLACE INTO analyses VALUES (?, ?, ?, ?, ?)',
+                (permID, analysisjson.get('lastUpdateDatetime') or '', facilityName,
+                 json.dumps(analysisjson), time.time()))
+            self._con.commit()
+
+    def close(self) -> None:
+        with self._lock:
+            self._con.close()
 
 
 def getAnalysis(analysisPermID: str,
-                        facilityName: str, usrname: str, pw: str) -> dict:
+                        facilityName: str, client: AeroClient) -> dict:
     """GET qc/analysis for a given analysisPermID and filter out keys that is needed for further bioinformatic processing
 
     :param analysisPermID: _description_
     :type analysisPermID: str
     :param facilityName: _description_
     :type facilityName: str
-    :param usrname: _description_
-    :type usrname: str
-    :param pw: _description_
-    :type pw: str
+    :param client: shared Aero API client
+    :type client: AeroClient
     :return: _description_
     :rtype: dict
     """
 
-    keycloackurl = 'https://keycloak.dev.ngc.dk/auth/realms/Ngc/protocol/openid-connect/token'
-    header = {'Content-Type': 'application/x-www-form-urlencoded'}
-    cert = '/usr/local/share/ca-certificates/CA-NGC.pem'
+    geturl = client.facilityURL(facilityName) + \
+        '/qc/analyses/' + analysisPermID
+    # Send json as request to AeroAPI
+    r = client.get(geturl)
 
-    tokenjson = requests.post(keycloackurl, headers=header, verify=cert, data={'username': usrname,
-                                                                               'password': pw,
-                                                                               'scope': 'profile',
-                                                                               'grant_type': 'password',
-                                                                               'client_id': 'sqs-web'
-                                                                               })
-    json.dump(tokenjson.json(), sys.stdout, indent=2)
+    # Log the call, bodies only at debug level or on errors
+    logExchange(log, r)
+    r.raise_for_status()
 
-    keycloaktoken = tokenjson.json()['access_token']
+    return r.json()
 
-    # Show sent json:
-    sys.stdout.write('\nSENT:\n')
-    sys.stdout.write('\n'+analysisPermID+'\n')
 
-    geturl = 'https://aero-hpc.dev.ngc.dk/wgs-facilities/' + \
-        facilityName + '/qc/analyses/' + analysisPermID
-    # Send json as request to AeroAPI
-    r = requests.get(
-        geturl,
-        verify='/usr/local/share/ca-certificates/CA-NGC.pem',
-        headers={
-            'Authorization': 'Bearer {}'.format(keycloaktoken)})
-
-    # Print recieved info:
-    sys.stdout.write('\nRECIEVED:\nStatus code: ' + str(r.status_code) + '\n')
-    sys.stdout.write('Trace ID: ' + r.headers.get('Trace-ID'))
-    sys.stdout.write('JSON:\n')
-    json.dump(r.json(), sys.stdout, indent=2)
+def bulkGetAnalyses(analysisPermIDs: list, facilityName: str, client: AeroClient,
+                    cache: AnalysisCache = None, workers: int = 16, maxage: float = None,
+                    refresh: bool = False, lastUpdates: dict = None) -> tuple:
+    """Fetch and filter many analyses concurrently over the client's pooled session.
+    Analyses in the cache are served from it without calling Aero
 
-    return r.json()
+    :param analysisPermIDs: analysis perm IDs
+    :type analysisPermIDs: list
+    :param facilityName: such as wgs-west or wgs-east
+    :type facilityName: str
+    :param client: shared Aero API client
+    :type client: AeroClient
+    :param cache: on-disk cache of fetched analyses
+    :type cache: AnalysisCache
+    :param workers: number of concurrent requests
+    :type workers: int
+    :param maxage: seconds a cached analysis without a known lastUpdateDatetime is served
+    :type maxage: float
+    :param refresh: fetch all analyses again and update the cache
+    :type refresh: bool
+    :param lastUpdates: {permID: lastUpdateDatetime} the analyses are known to have. Cached analyses
+        with the same lastUpdateDatetime are served at any age
+    :type lastUpdates: dict
+    :return: ({permID: filtered analysis}, {permID: exception} of failed fetches)
+    :rtype: tuple
+    """
+    lastUpdates = lastUpdates or {}
+
+    def one(permID: str) -> dict:
+        analysisjson = None
+        if cache is not None and not refresh:
+            analysisjson = cache.get(permID, facilityName, lastUpdates.get(permID), maxage)
+        if analysisjson is None:
+            analysisjson = getAnalysis(permID, facilityName, client)
+            if cache is not None:
+                cache.put(permID, facilityName, analysisjson)
+        return filterAnalysis(analysisjson, echo=False)
+
+    results = {}
+    failed = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {permID: executor.submit(one, permID)
+                   for permID in dict.fromkeys(analysisPermIDs)}
+        for permID, future in futures.items():
+            try:
+                results[permID] = future.result()
+            except Exception as exc:
+                failed[permID] = exc
+    return results, failed
 
 
-def filterAnalysis(analysisjson: dict) -> dict:
+def filterAnalysis(analysisjson: dict, echo: bool = True) -> dict:
     # Get relevant regID from sampleID
     aj = analysisjson
     payload = {}
@@ -89,7 +206,8 @@ def filterAnalysis(analysisjson: dict) -> dict:
             else:
                 payload[plr['pipelineID']]['samples'].append(smplsubdict)
 
-    json.dump(payload, sys.stdout, indent=2)
+    if echo:
+        json.dump(payload, sys.stdout, indent=2)
 
     return payload
 
@@ -104,17 +222,69 @@ if __name__ == "__main__":
         epilog=usage[1],
     )
     parser.add_argument("analysisPermID", type=str,
-                        help="analysisPermID on Aero API")
+                        help="analysisPermID on Aero API. With --bulk: file with one analysisPermID per line, "
+                             "optionally followed by its lastUpdateDatetime after a comma or whitespace")
     parser.add_argument("facilityName", type=str,
                         help="facilityName")
     parser.add_argument("usrname", type=str,
                         help="FreeIPA username")
     parser.add_argument("pw", type=str,
                         help="FreeIPA password")
+    parser.add_argument("--bulk", action="store_true",
+                        help="Fetch all perm IDs listed in the analysisPermID file concurrently and write "
+                             "one json object of filtered analyses keyed by perm ID")
+    parser.add_argument("--workers", type=int, default=16,
+                        help="With --bulk: number of concurrent requests")
+    parser.add_argument("--last-update", type=str,
+                        help="lastUpdateDatetime the analysis is known to have. A cached analysis with the "
+                             "same one is used at any age")
+    parser.add_argument("--cache", type=Path,
+                        help="SQLite file caching fetched analyses. A cached analysis is used if it has the "
+                             "known lastUpdateDatetime, or with --max-age while it is young enough")
+    parser.add_argument("--max-age", type=float,
+                        help="Hours a cached analysis without a known lastUpdateDatetime is used. Without it "
+                             "such analyses are always fetched again")
+    parser.add_argument("--refresh", action="store_true",
+                        help="Fetch all analyses again and update the cache")
+    parser.add_argument("--log-level", default="INFO", choices=("DEBUG", "INFO", "WARNING", "ERROR"),
+                        help="Logged to stderr. INFO logs one line per API call, DEBUG also the response bodies")
 
     args = parser.parse_args()
+    call_log.configure(args.log_level, stream=sys.stderr)
+
+    client = AeroClient(args.usrname, args.pw, poolsize=max(args.workers, 10))
+    cache = AnalysisCache(args.cache) if args.cache else None
+    maxage = args.max_age * 3600 if args.max_age is not None else None
+
+    if not args.bulk:
+        analysisjson = cache.get(args.analysisPermID, args.facilityName, args.last_update, maxage) \
+            if cache is not None and not args.refresh else None
+        if analysisjson is None:
+            analysisjson = getAnalysis(args.analysisPermID, args.facilityName, client)
+            if cache is not None:
+                cache.put(args.analysisPermID, args.facilityName, analysisjson)
+        filtered = filterAnalysis(analysisjson)
+
+        json.dump(filtered, sys.stdout, sort_keys=True, separators=(",", ":"))
+        sys.exit(0)
 
-    analysisjson = getAnalysis(args.analysisPermID, args.facilityName, args.usrname, args.pw)
-    filtered = filterAnalysis(analysisjson)
+    permIDs = []
+    lastUpdates = {}
+    with open(args.analysisPermID) as src:
+        for line in src:
+            fields = line.replace(",", " ").split(None, 1)
+            if not fields:
+                continue
+            permIDs.append(fields[0])
+            if len(fields) > 1:
+                lastUpdates[fields[0]] = fields[1].strip()
+    results, failed = bulkGetAnalyses(permIDs, args.facilityName, client, cache,
+                                      args.workers, maxage, args.refresh, lastUpdates)
+    if cache is not None:
+        cache.close()
 
-    json.dump(filtered, sys.stdout, sort_keys=True, separators=(",", ":"))
+    json.dump(results, sys.stdout, sort_keys=True, separators=(",", ":"))
+    for permID, exc in failed.items():
+        sys.stderr.write('Failed {}: {!r}\n'.format(permID, exc))
+    if failed:
+        raise SystemExit('{} of {} analyses failed'.format(len(failed), len(permIDs)))
@@ -12,49 +12,171 @@ Output: csv files with list of all json
 import argparse
 import os
 from argparse import RawTextHelpFormatter
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 import pandas as pd
 
+from scan_manifest import KnownTree, ScanManifest
+
+
+# Folder levels below the input path. Files are only looked for at the last
+# level and only NBA2 folders are entered.
+LAYOUT = ['check', 'facility', 'NBA', 'shortname', 'samplename', 'file']
+NBA = 'NBA2'
+
+
+def _listdir(path: str, dirs: bool) -> list:
+    """Names of non-hidden sub folders (dirs=True) or files (dirs=False) in path"""
+    try:
+        with os.scandir(path) as it:
+            return [entry.name for entry in it
+                    if not entry.name.startswith('.') and entry.is_dir() == dirs]
+    except (FileNotFoundError, NotADirectoryError, PermissionError):
+        return []
+
+
+def _statfiles(path: str) -> list:
+    """(name, size, mtime_ns) of non-hidden json files in path"""
+    try:
+        with os.scandir(path) as it:
+            return [(entry.name, st.st_size, st.st_mtime_ns) for entry in it
+                    if not entry.name.startswith('.') and ".json" in entry.name
+                    and not entry.is_dir() for st in [entry.stat()]]
+    except (FileNotFoundError, NotADirectoryError, PermissionError):
+        return []
+
+
+def _mtime(path: str) -> int:
+    try:
+        return os.stat(path).st_mtime_ns
+    except (FileNotFoundError, NotADirectoryError, PermissionError):
+        return None
+
+
+def _scanShortname(path: str, check: str, facility: str, shortname: str,
+                   known: KnownTree = None) -> tuple:
+    """Rows for all json files in the sample folders of one shortname folder.
+
+    Without known, rows are path,check,facility,NBA,shortname,samplename,file. With known, size and
+    mtime are added and folders whose mtime matches known are not listed again. Also returns the
+    (path, parent, mtime) of the scanned folders for the manifest.
+    """
+    rows = []
+    dirs = []
+    shortnamepath = os.path.join(path, check, facility, NBA, shortname)
+    if known is None:
+        samplenames = _listdir(shortnamepath, dirs=True)
+    else:
+        mtime = _mtime(shortnamepath)
+        if mtime is None:
+            return rows, dirs
+        dirs.append((shortnamepath, '', mtime))
+        if known.dirs.get(shortnamepath) == mtime:
+            samplenames = known.children.get(shortnamepath, [])
+        else:
+            samplenames = _listdir(shortnamepath, dirs=True)
+
+    for samplename in samplenames:
+        samplepath = os.path.join(shortnamepath, samplename)
+        if known is None:
+            for file in _listdir(samplepath, dirs=False):
+                if ".json" in file:
+                    rows.append([os.path.join(samplepath, file), check,
+                                 facility, NBA, shortname, samplename, file])
+            continue
+
+        mtime = _mtime(samplepath)
+        if mtime is None:
+            continue
+        dirs.append((samplepath, shortnamepath, mtime))
+        if known.dirs.get(samplepath) == mtime:
+            # Unchanged folder, same files as last time
+            rows.extend(known.files.get(samplepath, []))
+            continue
+        for file, size, filemtime in _statfiles(samplepath):
+            rows.append([os.path.join(samplepath, file), check, facility,
+                         NBA, shortname, samplename, file, size, filemtime])
+    return rows, dirs
+
+
+def _shortnames(path: str) -> list:
+    # The top levels hold few folders, list them directly
+    shortnames = []
+    for check in _listdir(path, dirs=True):
+        for facility in _listdir(os.path.join(path, check), dirs=True):
+            nbapath = os.path.join(path, check, facility, NBA)
+            for shortname in _listdir(nbapath, dirs=True):
+                shortnames.append((path, check, facility, shortname))
+    return shortnames
+
 
 # Making list of all files in the 'path' variable. Avoiding NBA1 and
 # hidden folders and files.
-def findJSONS(path: Path) -> pd.DataFrame:
+def findJSONS(path: Path, workers: int = 16) -> pd.DataFrame:
     """Find all relevant json files, make a list of their paths,check,facility,NBA,shortname,samplename,file and save as csv.
     Does not look for hidden files. Folder structure of folders holding json files must be /<check>/>facility>/<NBA>/<shortname>/<samplename>/<file.json>
     Example: /passed/wgs_east/NBA2/200622_A00559_0210_AHTFHCDMXX/06sjyvj81-17RKG002918-01_103719193860-DNA_Blood-WGS_v1-H27F5DSX2-RHGM00111/qc.json
 
+    Only the folders of the layout are listed: NBA folders other than NBA2 are never entered and
+    nothing below the sample folders is read. The shortname folders are scanned in parallel to hide
+    file system metadata latency.
+
     :param path: path to folders to look for summary.json files
     :type path: Path
-    :param outfile: outfile path to save csv file with list of all paths
+    :param workers: number of folders scanned at the same time
+    :type workers: int
+    :return: dataframe with columns path,check,facility,NBA,shortname,samplename,file
+    :rtype: pd.DataFrame
     """
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        scanned = executor.map(lambda args: _scanShortname(*args)[0],
+                               _shortnames(str(path)))
+        newlist = [row for rows in scanned for row in rows]
 
-    newlist = []
+    return pd.DataFrame(newlist, columns=['path'] + LAYOUT)
 
-    for root, dirs, files in os.walk(path):
 
-        files = [f for f in files if not f.startswith('.')]
+def scanTree(path: Path, known: KnownTree, workers: int = 16) -> tuple:
+    """Scan the json folder tree, only listing the folders whose mtime differs from known
 
-        for file in files:
-            newlist.append(str(os.path.join(root, file)))
-
-    # Converting list to dataframe for filtering
-    df = pd.DataFrame(newlist, columns=['path'])
-
-    # split paths of df into values and make new columns for chosen values of
-    # the split
-    path_length = str(path).split('/')
-    jsonpathstart = len(path_length)
-    jsonpathend = jsonpathstart + 6
+    :param path: path to folders to look for summary.json files
+    :type path: Path
+    :param known: what an earlier scan saw, from ScanManifest.known or scan_manifest.knownTree
+    :type known: KnownTree
+    :param workers: number of folders scanned at the same time
+    :type workers: int
+    :return: rows of path,check,facility,NBA,shortname,samplename,file,size,mtime for all json files and
+        (path, parent, mtime) of the scanned folders
+    :rtype: tuple
+    """
+    rows = []
+    dirs = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for shortnamerows, shortnamedirs in executor.map(
+                lambda args: _scanShortname(*args, known=known), _shortnames(str(path))):
+            rows.extend(shortnamerows)
+            dirs.extend(shortnamedirs)
+    return rows, dirs
 
-    df[['check', 'facility', 'NBA', 'shortname', 'samplename', 'file']
-       ] = df['path'].str.split('/', expand=True).iloc[:, jsonpathstart:jsonpathend]
 
-    # filtering for json files only and no NBA1 samples
-    df = df[df['NBA'] == 'NBA2']
-    df = df[df['file'].str.contains(".json")]
+def findChangedJSONS(path: Path, manifest: ScanManifest, workers: int = 16) -> tuple:
+    """Like findJSONS, but only lists folders that changed since the scan recorded in manifest
+    and also returns what was added, changed or removed. The manifest is updated with this scan.
 
-    return df
+    :param path: path to folders to look for summary.json files
+    :type path: Path
+    :param manifest: manifest of the previous scan
+    :type manifest: ScanManifest
+    :param workers: number of folders scanned at the same time
+    :type workers: int
+    :return: dataframe of all json files like findJSONS and dataframe of changes with an extra 'change' column
+    :rtype: tuple
+    """
+    rows, dirs = scanTree(path, manifest.known(), workers)
+    delta = manifest.update(rows, dirs)
+    return (pd.DataFrame([row[:7] for row in rows], columns=['path'] + LAYOUT),
+            pd.DataFrame(delta, columns=['path'] + LAYOUT + ['change']))
 
 
 if __name__ == "__main__":
@@ -66,10 +188,28 @@ if __name__ == "__main__":
     parser.add_argument('inpath', type=Path, help="Path to folder to search for json files. \n Folders with json files beneath this path must be in the following structure:\n /<check>/>facility>/<NBA>/<shortname>/<samplename>/<file.json>\n Example:\n .../passed/wgs_east/NBA2/200622_A00559_0210_AHTFHCDMXX/06sjyvj81-17RKG002918-01_103719193860-DNA_Blood-WGS_v1-H27F5DSX2-RHGM00111/qc.json")
     parser.add_argument('savefile', type=Path,
                         help="savefile path, e.g: <alljson.csv>")
+    parser.add_argument('--workers', type=int, default=16,
+                        help="Number of folders scanned at the same time")
+    parser.add_argument('--manifest', type=Path,
+                        help="Manifest file of earlier scans. Only folders changed since the last scan are listed.\n Created if it does not exist")
+    parser.add_argument('--delta', type=Path,
+                        help="With --manifest: csv file to save the added, changed and removed json files to")
 
     args = parser.parse_args()
 
-    jsondf = findJSONS(args.inpath)
+    if args.manifest:
+        manifest = ScanManifest(args.manifest)
+        jsondf, deltadf = findChangedJSONS(args.inpath, manifest, args.workers)
+        manifest.close()
+        if args.delta:
+            pd.DataFrame.to_csv(
+                deltadf,
+                args.delta,
+                sep=",",
+                index=False,
+                quoting=None)
+    else:
+        jsondf = findJSONS(args.inpath, args.workers)
     pd.DataFrame.to_csv(
         jsondf,
         args.savefile,
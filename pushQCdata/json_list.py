@@ -0,0 +1,75 @@
+"""
+Streaming reader of the json path csv written by get_json_paths.py.
+
+Rows are read lazily and by column name, so the file is never loaded as a whole and extra
+columns (such as 'change' in a --manifest delta csv) or a different column order do no harm.
+countFlowcellRows reads the csv once up front to know how many rows each flowcell has, so the
+flowcell stage can hand out a flowcell as soon as its last sample has been read.
+"""
+
+import csv
+from collections import namedtuple
+from pathlib import Path
+
+COLUMNS = ('path', 'check', 'facility', 'NBA', 'shortname', 'samplename', 'file')
+
+# One row of the csv. Fields can also be read by position, like the rows of the old lists
+JsonRow = namedtuple('JsonRow', COLUMNS)
+
+
+def readJsonList(path: Path):
+    """Rows of a json path csv, read one at a time
+
+    :param path: csv written by get_json_paths.py
+    :type path: Path
+    :raises SystemExit: if a column is missing
+    :rtype: Iterator[JsonRow]
+    """
+    with open(path, newline='') as src:
+        reader = csv.DictReader(src)
+        missing = [column for column in COLUMNS if column not in (reader.fieldnames or ())]
+        if missing:
+            raise SystemExit('{} lacks the columns {}'.format(path, ', '.join(missing)))
+        for row in reader:
+            yield JsonRow(*(row[column] for column in COLUMNS))
+
+
+def flowcellGroup(row: JsonRow) -> tuple:
+    """Flowcell of a row as told by its run folder, <date>_<instrument>_<run>_<position><flowcellID>,
+    and facility. Used to know when all samples of a flowcell have been read
+
+    :param row: csv row
+    :type row: JsonRow
+    :rtype: tuple
+    """
+    parts = row.shortname.rsplit('_', 1)
+    flowcell = parts[1][1:] if len(parts) == 2 and len(parts[1]) > 1 else row.shortname
+    return flowcell, row.facility
+
+
+def countFlowcellRows(path: Path) -> dict:
+    """Number of rows per flowcellGroup in a json path csv
+
+    :param path: csv written by get_json_paths.py
+    :type path: Path
+    :rtype: dict
+    """
+    counts = {}
+    for row in readJsonList(path):
+        group = flowcellGroup(row)
+        counts[group] = counts.get(group, 0) + 1
+    return counts
+
+
+def writeJsonList(path: Path, rows) -> None:
+    """Write rows as a json path csv that readJsonList and pandas read back
+
+    :param path: csv file to write
+    :type path: Path
+    :param rows: rows with the columns of COLUMNS
+    :type rows: Iterable[JsonRow]
+    """
+    with open(path, 'w', newline='') as out:
+        writer = csv.writer(out, lineterminator='\n')
+        writer.writerow(COLUMNS)
+        writer.writerows(rows)
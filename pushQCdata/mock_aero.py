@@ -0,0 +1,310 @@
+"""
+Local stand-in for the Keycloak token endpoint and the Aero API routes used by pushQCdata.
+
+Serves the token endpoint and per facility the /qc/flowcells, /qc/analyses, /metrics, /id-snp-checks
+routes and the analysis PATCH, keeping registered analyses in memory. Latency and error injection
+are configurable, so the push path can be measured and tested without the dev servers.
+Bodies sent with Content-Encoding: gzip are decompressed and checked, or refused with 415 if the
+mock is started without gzip support. Bytes received and encodings are counted per route.
+
+Input: host, port and injection options
+Output: a running server. Point AeroClient at it with keycloakurl=<url>/token and aerourl=<url>
+"""
+
+import argparse
+import gzip
+import json
+import zlib
+import random
+import re
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from aero_client import routeName
+
+_ANALYSIS = re.compile(r'^/wgs-facilities/([^/]+)/qc/analyses/([^/]+)$')
+_ANALYSES = re.compile(r'^/wgs-facilities/([^/]+)/qc/analyses$')
+_FLOWCELLS = re.compile(r'^/wgs-facilities/([^/]+)/qc/flowcells$')
+_SUBRESOURCE = re.compile(r'^/wgs-facilities/([^/]+)/qc/analyses/([^/]+)/(metrics|id-snp-checks)$')
+
+
+class MockAero:
+    """In-memory Keycloak and Aero API on a local port
+
+    :param host: interface to listen on
+    :type host: str
+    :param port: port to listen on. 0 picks a free one
+    :type port: int
+    :param latency: mean added server time per call in seconds
+    :type latency: float
+    :param jitter: added server time is uniform in latency +- jitter
+    :type jitter: float
+    :param errorrate: fraction of Aero calls answered with 503
+    :type errorrate: float
+    :param throttlerate: fraction of Aero calls answered with 429 and Retry-After
+    :type throttlerate: float
+    :param retryafter: seconds sent in Retry-After of 429 answers
+    :type retryafter: float
+    :param tokenlifetime: expires_in of issued tokens
+    :type tokenlifetime: int
+    :param seed: seed of the error injection
+    :type seed: int
+    :param acceptgzip: take gzipped request bodies, else answer them with 415
+    :type acceptgzip: bool
+    """
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 0, latency: float = 0.0,
+                 jitter: float = 0.0, errorrate: float = 0.0, throttlerate: float = 0.0,
+                 retryafter: float = 0.1, tokenlifetime: int = 300, seed: int = None,
+                 acceptgzip: bool = True):
+        self.latency = latency
+        self.jitter = jitter
+        self.errorrate = errorrate
+        self.throttlerate = throttlerate
+        self.retryafter = retryafter
+        self.tokenlifetime = tokenlifetime
+        self.acceptgzip = acceptgzip
+        # Requests per route, e.g. {'POST /qc/analyses': 10}
+        self.stats = {}
+        # Body bytes as received and requests per Content-Encoding, per route
+        self.bytesreceived = {}
+        self.encodings = {}
+        self.analyses = {}
+        self.flowcells = {}
+        self.lock = threading.Lock()
+
+        self._random = random.Random(seed)
+        self._last = 0.0
+        self._server = ThreadingHTTPServer((host, port), _handler(self))
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return 'http://{}:{}'.format(host, port)
+
+    def start(self) -> 'MockAero':
+        """Serve in a background thread"""
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def serve(self) -> None:
+        """Serve in this thread until interrupted"""
+        self._server.serve_forever()
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def roundtrips(self) -> int:
+        """Total number of requests served"""
+        with self.lock:
+            return sum(self.stats.values())
+
+    def received(self, method: str, path: str, nbytes: int, encoding: str) -> None:
+        """Count a request body as it came over the wire"""
+        route = routeName(method, path)
+        with self.lock:
+            self.bytesreceived[route] = self.bytesreceived.get(route, 0) + nbytes
+            counts = self.encodings.setdefault(route, {})
+            counts[encoding] = counts.get(encoding, 0) + 1
+
+    def _now(self) -> str:
+        # Called with the lock held. Strictly increasing, so every update gives a new lastUpdateDatetime
+        self._last = max(time.time(), self._last + 1e-6)
+        return datetime.fromtimestamp(self._last, timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+
+    def _inject(self):
+        # (status, extra headers) of an injected failure, None if the call goes through
+        draw = self._random.random()
+        if draw < self.throttlerate:
+            return 429, {'Retry-After': str(self.retryafter)}
+        if draw < self.throttlerate + self.errorrate:
+            return 503, {}
+        return None
+
+    def handle(self, method: str, path: str, body):
+        """Answer one request
+
+        :return: (status, json body, extra headers)
+        :rtype: tuple
+        """
+        route = routeName(method, path)
+        with self.lock:
+            self.stats[route] = self.stats.get(route, 0) + 1
+            injected = None if route.endswith('/token') else self._inject()
+        delay = self.latency + self._random.uniform(-self.jitter, self.jitter)
+        if delay > 0:
+            time.sleep(delay)
+        if injected is not None:
+            return injected[0], {'message': 'injected failure'}, injected[1]
+
+        path = path.split('?', 1)[0]
+        with self.lock:
+            if route == 'POST /token':
+                return 200, {'access_token': uuid.uuid4().hex,
+                             'expires_in': self.tokenlifetime}, {}
+
+            m = _FLOWCELLS.match(path)
+            if m and method == 'POST':
+                self.flowcells[body['flowcellID']] = body
+                return 201, dict(body, lastUpdateDatetime=self._now()), {}
+
+            m = _ANALYSES.match(path)
+            if m and method == 'POST':
+                permID = str(uuid.uuid4())
+                analysis = dict(body, permID=permID, facility=m.group(1),
+                                lastUpdateDatetime=self._now(), evalStatus='pending',
+                                submitStatus='draft')
+                analysis['pipelineRuns'] = [dict(run, pipelineRunPermID=str(uuid.uuid4()),
+                                                 pipelineID=run.get('pipelinePermID'))
+                                            for run in body.get('pipelineRuns', [])]
+                self.analyses[permID] = analysis
+                return 201, analysis, {}
+            if m and method == 'PATCH':
+                return self._patch(body)
+
+            m = _SUBRESOURCE.match(path)
+            if m and method == 'POST':
+                analysis = self.analyses.get(m.group(2))
+                if analysis is None:
+                    return 404, {'message': 'unknown analysis'}, {}
+                analysis[m.group(3)] = body
+                analysis['lastUpdateDatetime'] = self._now()
+                return 201, {'permID': analysis['permID'],
+                             'lastUpdateDatetime': analysis['lastUpdateDatetime']}, {}
+
+            m = _ANALYSIS.match(path)
+            if m and method == 'GET':
+                analysis = self.analyses.get(m.group(2))
+                if analysis is None:
+                    return 404, {'message': 'unknown analysis'}, {}
+                return 200, {k: v for k, v in analysis.items()
+                             if k not in ('metrics', 'id-snp-checks')}, {}
+
+        return 404, {'message': 'unknown route ' + route}, {}
+
+    def _patch(self, body):
+        # Called with the lock held. Every patch must carry the current lastUpdateDatetime
+        results = []
+        for item in body:
+            analysis = self.analyses.get(item['permID'])
+            if analysis is None:
+                return 404, {'message': 'unknown analysis'}, {}
+            if item['lastUpdateDatetime'] != analysis['lastUpdateDatetime']:
+                return 409, {'message': 'stale lastUpdateDatetime',
+                             'lastUpdateDatetime': analysis['lastUpdateDatetime']}, {}
+        for item in body:
+            analysis = self.analyses[item['permID']]
+            for op in item['ops']:
+                _applyOp(analysis, op)
+            analysis['lastUpdateDatetime'] = self._now()
+            results.append({'permID': analysis['permID'],
+                            'lastUpdateDatetime': analysis['lastUpdateDatetime']})
+        return 200, results, {}
+
+
+def _applyOp(doc: dict, op: dict) -> None:
+    # One add, replace or remove op of a JSON-Patch on doc
+    keys = [key.replace('~1', '/').replace('~0', '~') for key in op['path'].split('/')[1:]]
+    parent = doc
+    for key in keys[:-1]:
+        parent = parent[int(key) if isinstance(parent, list) else key]
+    last = int(keys[-1]) if isinstance(parent, list) else keys[-1]
+    if op['op'] == 'remove':
+        del parent[last]
+    elif op['op'] == 'add' and isinstance(parent, list):
+        parent.insert(last, op['value'])
+    elif op['op'] in ('add', 'replace'):
+        parent[last] = op['value']
+    else:
+        raise ValueError('unsupported op ' + op['op'])
+
+
+class _Unsupported(Exception):
+    pass
+
+
+def _handler(mock: MockAero):
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        # Headers and body are written separately, Nagle would hold the body back
+        disable_nagle_algorithm = True
+
+        def log_message(self, format, *args):
+            pass
+
+        def _serve(self):
+            start = time.perf_counter()
+            length = int(self.headers.get('Content-Length') or 0)
+            raw = self.rfile.read(length) if length else b''
+            encoding = self.headers.get('Content-Encoding', 'identity')
+            mock.received(self.command, self.path, len(raw), encoding)
+            try:
+                if encoding == 'gzip':
+                    if not mock.acceptgzip:
+                        raise _Unsupported(encoding)
+                    raw = gzip.decompress(raw)
+                elif encoding != 'identity':
+                    raise _Unsupported(encoding)
+                if self.headers.get('Content-Type', '').startswith('application/json') and raw:
+                    body = json.loads(raw)
+                else:
+                    body = raw.decode('utf-8', 'replace')
+                status, answer, headers = mock.handle(self.command, self.path, body)
+            except _Unsupported as exc:
+                status, answer, headers = 415, {'message': 'unsupported Content-Encoding ' + str(exc)}, {}
+            except (ValueError, KeyError, IndexError, TypeError, OSError, EOFError, zlib.error) as exc:
+                status, answer, headers = 400, {'message': 'bad request: ' + repr(exc)}, {}
+            data = json.dumps(answer).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.send_header('Trace-ID', uuid.uuid4().hex)
+            self.send_header('Server-Timing', 'app;dur={:.3f}'.format(
+                (time.perf_counter() - start) * 1000))
+            for key, value in headers.items():
+                self.send_header(key, value)
+            self.end_headers()
+            self.wfile.write(data)
+
+        do_GET = do_POST = do_PATCH = _serve
+
+    return Handler
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        description=__doc__)
+    parser.add_argument('--host', default='127.0.0.1', help="Interface to listen on")
+    parser.add_argument('--port', type=int, default=8080, help="Port to listen on")
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help="Mean added server time per call in seconds")
+    parser.add_argument('--jitter', type=float, default=0.0,
+                        help="Added server time varies by up to this many seconds")
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help="Fraction of Aero calls answered with 503")
+    parser.add_argument('--throttle-rate', type=float, default=0.0,
+                        help="Fraction of Aero calls answered with 429")
+    parser.add_argument('--retry-after', type=float, default=0.1,
+                        help="Seconds sent in Retry-After of 429 answers")
+    parser.add_argument('--no-gzip', action='store_true',
+                        help="Answer gzipped request bodies with 415")
+    args = parser.parse_args()
+
+    mock = MockAero(args.host, args.port, args.latency, args.jitter,
+                    args.error_rate, args.throttle_rate, args.retry_after,
+                    acceptgzip=not args.no_gzip)
+    print('Serving on ' + mock.url + ' (token url ' + mock.url + '/token)')
+    try:
+        mock.serve()
+    except KeyboardInterrupt:
+        mock.stop()
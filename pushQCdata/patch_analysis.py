@@ -2,49 +2,34 @@
 Script for patching analysis for pushing of historical data to SQS.
 """
 
-import json
-import sys
+import logging
 
 import requests
 
+from aero_client import AeroClient
+from call_log import logExchange
+
+log = logging.getLogger(__name__)
+
 
 def getLastUpdateDateTime(
-        facilityName: str, analysisPermID: str, usrname: str, pw: str) -> str:
+        facilityName: str, analysisPermID: str, client: AeroClient) -> str:
     """get LastUpdateDateTime from analysis perm ID
 
     :param facilityName: _description_
     :type facilityName: str
     :param analysisPermID: _description_
     :type analysisPermID: str
-    :param usrname: _description_
-    :type usrname: str
-    :param usrname: FreeIPA username
-    :type usrname: str
-    :param pw: FreeIPA password
-    :type pw: str
+    :param client: shared Aero API client
+    :type client: AeroClient
     """
 
-    keycloackurl = 'https://keycloak.dev.ngc.dk/auth/realms/Ngc/protocol/openid-connect/token'
-    header = {'Content-Type': 'application/x-www-form-urlencoded'}
-    cert = '/usr/local/share/ca-certificates/CA-NGC.pem'
-
-    tokenjson = requests.post(keycloackurl, headers=header, verify=cert, data={'username': usrname,
-                                                                               'password': pw,
-                                                                               'scope': 'profile',
-                                                                               'grant_type': 'password',
-                                                                               'client_id': 'sqs-web'
-                                                                               })
-    keycloaktoken = tokenjson.json()['access_token']
-
     # Get last updateDateTime
-    posturl = 'https://aero-hpc.dev.ngc.dk/wgs-facilities/' + \
-        facilityName + '/qc/analyses/' + analysisPermID
-    r = requests.get(
-        posturl,
-        verify='/usr/local/share/ca-certificates/CA-NGC.pem',
-        headers={
-            'Authorization': 'Bearer {}'.format(keycloaktoken)})
-    json.dump(r.json(), sys.stdout, separators=(",", ":"), indent=2)
+    posturl = client.facilityURL(facilityName) + \
+        '/qc/analyses/' + analysisPermID
+    r = client.get(posturl)
+    logExchange(log, r)
+    r.raise_for_status()
 
     lastUpdateDatetime = r.json()['lastUpdateDatetime']
 
@@ -59,7 +44,7 @@ def patchAnalysis(raw_qc: dict, qcCheck: str, permid: str,
     elif qcCheck == "fail" or qcCheck == "failed":
         checkvalue = "failed"
     else:
-        print("Unknown check:" + qcCheck)
+        log.warning("Unknown check: " + qcCheck)
 
     # shortcuts
     new_json = [{
@@ -85,39 +70,118 @@ def patchAnalysis(raw_qc: dict, qcCheck: str, permid: str,
 
 
 def sendPatchRequest(analysisRegJson: dict, facilityName: str,
-                     lastUpdateDatetime: str, usrname: str, pw: str):
+                     lastUpdateDatetime: str, client: AeroClient):
+
+    # Send json as request to AeroAPI
+    r = client.patch(
+        client.facilityURL(facilityName) + '/qc/analyses',
+        json=analysisRegJson)
 
-    keycloackurl = 'https://keycloak.dev.ngc.dk/auth/realms/Ngc/protocol/openid-connect/token'
-    header = {'Content-Type': 'application/x-www-form-urlencoded'}
-    cert = '/usr/local/share/ca-certificates/CA-NGC.pem'
+    # Log the call, bodies only at debug level or on errors
+    logExchange(log, r)
+    r.raise_for_status()
 
-    tokenjson = requests.post(keycloackurl, headers=header, verify=cert, data={'username': usrname,
-                                                                               'password': pw,
-                                                                               'scope': 'profile',
-                                                                               'grant_type': 'password',
-                                                                               'client_id': 'sqs-web'
-                                                                               })
-    keycloaktoken = tokenjson.json()['access_token']
+    return r.json()
 
-    # Show sent json:
-    sys.stdout.write('\nSENT:\n')
-    json.dump(analysisRegJson, sys.stdout, separators=(",", ":"), indent=2)
 
-    # Send json as request to AeroAPI
-    r = requests.patch(
-        'https://aero-hpc.dev.ngc.dk/wgs-facilities/' +
-        facilityName +
-        '/qc/analyses',
-        json=analysisRegJson,
-        verify='/usr/local/share/ca-certificates/CA-NGC.pem',
-        headers={
-            'Authorization': 'Bearer {}'.format(keycloaktoken)})
-
-    # Print recieved info:
-    sys.stdout.write('\nRECIEVED:\nStatus code: ' + str(r.status_code) + '\n')
-    sys.stdout.write('Trace ID: ' + r.headers.get('Trace-ID'))
-    sys.stdout.write('JSON:\n')
-    json.dump(r.json(), sys.stdout, indent=2)
+def latestUpdateDatetime(response, current: str) -> str:
+    """lastUpdateDatetime in an Aero API response, or current if the response has none
+
+    :param response: response json of a call on an analysis
+    :param current: lastUpdateDatetime known before the call
+    :type current: str
+    :rtype: str
+    """
+    if isinstance(response, list):
+        response = response[0] if response else None
+    if isinstance(response, dict) and response.get('lastUpdateDatetime'):
+        return response['lastUpdateDatetime']
+    return current
+
+
+def analysisState(analysisRegDict: dict, qcCheck: str) -> dict:
+    """The analysis as it is in Aero after it is registered and patched: the registration payload
+    with the fields set by patchAnalysis
+
+    :param analysisRegDict: analysis registration payload
+    :type analysisRegDict: dict
+    :param qcCheck: pass/passed or fail/failed
+    :type qcCheck: str
+    :rtype: dict
+    """
+    ops = patchAnalysis(None, qcCheck, "", "")[0]["ops"]
+    return dict(analysisRegDict, **{op["path"].lstrip("/"): op["value"] for op in ops})
+
+
+def _pointer(path: str, key) -> str:
+    # JSON Pointer (RFC 6901) of key below path
+    return path + "/" + str(key).replace("~", "~0").replace("/", "~1")
+
+
+def jsonPatchOps(old, new, path: str = "") -> list:
+    """Minimal JSON-Patch ops turning old into new. Objects and lists of the same length are
+    compared per member, so only changed values are replaced
+
+    :param old: document as Aero has it
+    :param new: document as it should be
+    :param path: JSON Pointer of old and new in the patched document
+    :type path: str
+    :return: list of add/remove/replace ops, empty if nothing changed
+    :rtype: list
+    """
+    if isinstance(old, dict) and isinstance(new, dict):
+        ops = [{"op": "remove", "path": _pointer(path, key)} for key in old if key not in new]
+        for key, value in new.items():
+            if key in old:
+                ops.extend(jsonPatchOps(old[key], value, _pointer(path, key)))
+            else:
+                ops.append({"op": "add", "path": _pointer(path, key), "value": value})
+        return ops
+    if isinstance(old, list) and isinstance(new, list) and len(old) == len(new):
+        ops = []
+        for i, (a, b) in enumerate(zip(old, new)):
+            ops.extend(jsonPatchOps(a, b, _pointer(path, i)))
+        return ops
+    if type(old) is type(new) and old == new:
+        return []
+    return [{"op": "replace", "path": path, "value": new}]
+
+
+def sendAnalysisPatch(raw_qc: dict, qcCheck: str, facilityName: str, analysisPermID: str,
+                      lastUpdateDatetime: str, client: AeroClient, ops: list = None):
+    """Patch the approve status of an analysis with the lastUpdateDatetime carried over from the
+    earlier calls on it. The current one is only fetched from Aero if it is not known or Aero
+    rejects it as stale (409/412), and the patch is then sent again
+
+    :param raw_qc: dictionary of qc json
+    :type raw_qc: dict
+    :param qcCheck: pass/passed or fail/failed
+    :type qcCheck: str
+    :param facilityName: such as wgs-west or wgs-east
+    :type facilityName: str
+    :param analysisPermID: perm ID of the analysis
+    :type analysisPermID: str
+    :param lastUpdateDatetime: from the latest response on the analysis, None if not known
+    :type lastUpdateDatetime: str
+    :param client: shared Aero API client
+    :type client: AeroClient
+    :param ops: JSON-Patch ops to send instead of those of patchAnalysis, e.g. from jsonPatchOps
+    :type ops: list
+    :return: response json
+    """
+    def payload(lastUpdateDatetime):
+        if ops is None:
+            return patchAnalysis(raw_qc, qcCheck, analysisPermID, lastUpdateDatetime)
+        return [{"permID": analysisPermID, "lastUpdateDatetime": lastUpdateDatetime, "ops": ops}]
+
+    if lastUpdateDatetime:
+        try:
+            return sendPatchRequest(payload(lastUpdateDatetime), facilityName, analysisPermID, client)
+        except requests.HTTPError as exc:
+            if exc.response is None or exc.response.status_code not in (409, 412):
+                raise
+    lastUpdateDatetime = getLastUpdateDateTime(facilityName, analysisPermID, client)
+    return sendPatchRequest(payload(lastUpdateDatetime), facilityName, analysisPermID, client)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,180 @@
+"""
+Compact archive of reshaped Aero API payloads, written instead of one json file per payload.
+
+Every payload is one NDJSON record {"type": ..., <tags>, "payload": ...}. Sample records are tagged
+with sample, facility, check and the path of the summary.json, flowcell records with flowcell and facility. The records of a sample
+are written together as one gzip member, so blocks can be compressed in worker processes and
+appended by the parent. Records go to one payloads.ndjson.gz or, with shards, to
+payloads-NNN.ndjson.gz picked by the sample name. replay_archive.py sends an archive to Aero.
+"""
+
+import gzip
+import json
+import threading
+import zlib
+from pathlib import Path
+
+import reshape_idsnp as s4
+
+SAMPLETYPES = ('analysis', 'metrics', 'idsnp', 'patch')
+
+
+def _compact(payload) -> str:
+    # Compact JSON text of a payload, idsnp details written straight from their columns
+    if isinstance(payload, dict) and isinstance(payload.get('details'), s4.IdsnpSites):
+        return s4.dumpsPayload(payload, separators=(',', ':'))
+    return json.dumps(payload, separators=(',', ':'))
+
+
+def packRecords(records: list, compress: bool = True, **tags) -> bytes:
+    """NDJSON lines of records as one block, a gzip member if compress
+
+    :param records: list of (type, payload)
+    :type records: list
+    :param compress: gzip the block
+    :type compress: bool
+    :param tags: fields put in every record after type, e.g. sample=..., facility=...
+    :return: block to append to an archive file
+    :rtype: bytes
+    """
+    lines = []
+    for kind, payload in records:
+        head = json.dumps(dict({'type': kind}, **tags), separators=(',', ':'))
+        lines.append(head[:-1] + ',"payload":' + _compact(payload) + '}\n')
+    block = ''.join(lines).encode('utf-8')
+    return gzip.compress(block, mtime=0) if compress else block
+
+
+def archiveFiles(folder: Path, shards: int = 1, compress: bool = True) -> list:
+    """Paths of the archive files of a folder
+
+    :param folder: folder the archive is written to
+    :type folder: Path
+    :param shards: number of files
+    :type shards: int
+    :param compress: gzip compressed archive
+    :type compress: bool
+    :rtype: list
+    """
+    suffix = '.ndjson.gz' if compress else '.ndjson'
+    if shards == 1:
+        return [Path(folder) / ('payloads' + suffix)]
+    return [Path(folder) / 'payloads-{:03d}{}'.format(i, suffix) for i in range(shards)]
+
+
+class ArchiveSink:
+    """Writes payload records to the archive files of a folder. Safe to use from several threads
+
+    :param folder: folder to write to. Existing archive files are overwritten
+    :type folder: Path
+    :param shards: number of files the samples are spread over
+    :type shards: int
+    :param compress: gzip the records
+    :type compress: bool
+    """
+
+    def __init__(self, folder: Path, shards: int = 1, compress: bool = True):
+        if shards < 1:
+            raise ValueError('shards must be at least 1')
+        self.compress = compress
+        self.paths = archiveFiles(folder, shards, compress)
+        self._files = [open(path, 'wb') for path in self.paths]
+        self._locks = [threading.Lock() for _ in self.paths]
+
+    def _shard(self, key: str) -> int:
+        return zlib.crc32(key.encode('utf-8')) % len(self._files)
+
+    def writeBlock(self, key: str, block: bytes) -> None:
+        """Append a block from packRecords to the shard of key
+
+        :param key: sample name or flowcell key, decides the shard
+        :type key: str
+        :param block: block from packRecords, compressed as the archive is
+        :type block: bytes
+        """
+        shard = self._shard(key)
+        with self._locks[shard]:
+            self._files[shard].write(block)
+
+    def write(self, key: str, records: list, **tags) -> None:
+        """Append records as one block, see packRecords
+
+        :param key: sample name or flowcell key, decides the shard
+        :type key: str
+        :param records: list of (type, payload)
+        :type records: list
+        """
+        self.writeBlock(key, packRecords(records, self.compress, **tags))
+
+    def close(self) -> None:
+        for f, lock in zip(self._files, self._locks):
+            with lock:
+                f.close()
+
+
+class MemorySink:
+    """Same interface as ArchiveSink, keeping the packed blocks in memory. Used in worker processes
+    that send their blocks to the process writing the archive
+
+    :param compress: gzip the records
+    :type compress: bool
+    """
+
+    def __init__(self, compress: bool = True):
+        self.compress = compress
+        # (key, block) in the order written
+        self.blocks = []
+
+    def write(self, key: str, records: list, **tags) -> None:
+        self.blocks.append((key, packRecords(records, self.compress, **tags)))
+
+
+def findArchives(path: Path) -> list:
+    """Archive files in a folder, or the file itself
+
+    :param path: folder written by ArchiveSink or one archive file
+    :type path: Path
+    :rtype: list
+    """
+    path = Path(path)
+    if path.is_dir():
+        return sorted(path.glob('payloads*.ndjson.gz')) + sorted(path.glob('payloads*.ndjson'))
+    return [path]
+
+
+def readArchive(paths: list, types: tuple = None):
+    """Records of archive files in the order written
+
+    :param paths: archive files
+    :type paths: list
+    :param types: only yield records of these types. Other lines are skipped without parsing them
+    :type types: tuple
+    :rtype: Iterator[dict]
+    """
+    prefixes = tuple('{"type":' + json.dumps(kind) + ',' for kind in types) if types else None
+    for path in paths:
+        opener = gzip.open if str(path).endswith('.gz') else open
+        with opener(path, 'rt', encoding='utf-8') as fp:
+            for line in fp:
+                if prefixes is not None and not line.startswith(prefixes):
+                    continue
+                yield json.loads(line)
+
+
+def readSamples(paths: list):
+    """Sample records of archive files grouped per sample
+
+    :param paths: archive files
+    :type paths: list
+    :return: (sample name, {type: record}) per sample
+    :rtype: Iterator[tuple]
+    """
+    sample, records = None, {}
+    for record in readArchive(paths, SAMPLETYPES):
+        if record['sample'] != sample and records:
+            yield sample, records
+            records = {}
+        sample = record['sample']
+        records[record['type']] = record
+    if records:
+        yield sample, records
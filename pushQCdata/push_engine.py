@@ -0,0 +1,130 @@
+"""
+Worker pool for pushing many samples to the Aero API at once.
+
+Each submitted task is the whole dependent call chain of one sample, so the order within a sample
+is kept while different samples run in parallel. Concurrency is limited overall and per facility.
+"""
+
+import sys
+import threading
+import traceback
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable
+
+
+class PushEngine:
+    """Run per-sample tasks concurrently with an overall and a per facility limit
+
+    :param workers: max number of samples in flight overall
+    :type workers: int
+    :param facilitylimits: max number of samples in flight per facility, e.g. {'wgs-east': 4}.
+        Facilities not listed are only bound by workers
+    :type facilitylimits: dict
+    """
+
+    def __init__(self, workers: int = 1, facilitylimits: dict = None):
+        if workers < 1:
+            raise ValueError('workers must be at least 1')
+        self.workers = workers
+        self.facilitylimits = dict(facilitylimits or {})
+        self.failed = []
+
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        self._pending = {}
+        self._order = deque()
+        self._inflight = 0
+        self._facilityinflight = {}
+
+    def submit(self, facilityName: str, name: str, fn: Callable, *args, **kwargs) -> None:
+        """Queue a task. It is started as soon as both limits allow it
+
+        :param facilityName: facility the task is counted against, such as wgs-east
+        :type facilityName: str
+        :param name: name of the task used when reporting failures, e.g. sample name
+        :type name: str
+        :param fn: function running the call chain of one sample
+        :type fn: Callable
+        """
+        with self._lock:
+            self._pending.setdefault(facilityName, deque()).append(
+                (name, fn, args, kwargs))
+            self._order.append(facilityName)
+            tostart = self._dispatch()
+        self._start(tostart)
+
+    def wait(self) -> list:
+        """Block until all queued tasks are done
+
+        :return: list of (name, exception) for the tasks that failed
+        :rtype: list
+        """
+        with self._idle:
+            while self._inflight or any(self._pending.values()):
+                self._idle.wait()
+        return list(self.failed)
+
+    def shutdown(self) -> None:
+        self.wait()
+        self._executor.shutdown()
+
+    def _hasroom(self, facilityName: str) -> bool:
+        limit = self.facilitylimits.get(facilityName)
+        return limit is None or self._facilityinflight.get(facilityName, 0) < limit
+
+    def _dispatch(self) -> list:
+        # Called with the lock held. Pick tasks in submission order, skipping
+        # facilities that are at their limit. They are started by _start once
+        # the lock is released
+        tostart = []
+        skipped = deque()
+        while self._order and self._inflight < self.workers:
+            facilityName = self._order.popleft()
+            if not self._hasroom(facilityName):
+                skipped.append(facilityName)
+                continue
+            self._inflight += 1
+            self._facilityinflight[facilityName] = self._facilityinflight.get(
+                facilityName, 0) + 1
+            tostart.append((facilityName, self._pending[facilityName].popleft()))
+        skipped.extend(self._order)
+        self._order = skipped
+        return tostart
+
+    def _start(self, tostart: list) -> None:
+        for facilityName, (name, fn, args, kwargs) in tostart:
+            future = self._executor.submit(fn, *args, **kwargs)
+            future.add_done_callback(
+                lambda f, fac=facilityName, n=name: self._done(f, fac, n))
+
+    def _done(self, future: Future, facilityName: str, name: str) -> None:
+        exc = future.exception()
+        if exc is not None:
+            sys.stderr.write('\nFAILED: ' + name + '\n')
+            traceback.print_exception(type(exc), exc, exc.__traceback__)
+        with self._lock:
+            if exc is not None:
+                self.failed.append((name, exc))
+            self._inflight -= 1
+            self._facilityinflight[facilityName] -= 1
+            tostart = self._dispatch()
+            self._idle.notify_all()
+        self._start(tostart)
+
+
+def parseFacilityLimits(limits: list) -> dict:
+    """Parse ['wgs-east=4', 'wgs-west=2'] into {'wgs-east': 4, 'wgs-west': 2}
+
+    :param limits: list of facility=limit strings
+    :type limits: list
+    :rtype: dict
+    """
+    facilitylimits = {}
+    for limit in limits or []:
+        facilityName, _, value = limit.partition('=')
+        if not value.isdigit() or int(value) < 1:
+            raise SystemExit('Facility limit must look like wgs-east=4, got: ' + limit)
+        facilitylimits[facilityName] = int(value)
+    return facilitylimits
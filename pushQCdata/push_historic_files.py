@@ -3,15 +3,29 @@ Executes api call scripts for each json file in given list
 
 Input: csv with list of json paths
 Output: api request calls for the chosen calls
+
+A flowcell whose samples disagree (flowcell number, run ID, date) is held back with all its samples.
+The rest of the list is still sent, and the held back samples are reported with the failed ones at the end.
 """
 
 import argparse
-import getpass
 import json
+import logging
+import sys
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 
-import pandas as pd
-
+from aero_client import COMPRESSROUTES, AdaptiveLimiter, AeroClient, facilityNameFromLabID
+from batch_mode import loadPolicy, readCredentials, selectedFlowcells
+import call_log
+from flowcell_index import FlowcellIndex
+from json_list import countFlowcellRows, flowcellGroup, readJsonList
+from push_engine import PushEngine, parseFacilityLimits
+from payload_archive import ArchiveSink, MemorySink
+from push_journal import PushJournal
+from qc_documents import QCDocuments, loadJSON, pruneQC
+from reshape_payloads import canonicalJSON, payloadHash, reshapeAll
+import stage_timing
 # Importing scripts for json reshaping
 import patch_analysis as s5
 import reshape_analysis as s2
@@ -19,10 +33,84 @@ import reshape_idsnp as s4
 import reshape_metrics as s3
 import reshape_flowcell as s1
 
+log = logging.getLogger(__name__)
+
+# Set type perm IDs:
+# analysis type id for Germline Analysis
+ANALYSISTYPEPERMID = "00000000-e186-4e86-85eb-55145dc0333d"
+# pipeline id for Germline NBA-2 Pipeline
+PIPELINEPERMID = "11111111-af39-4e13-bbc9-6d45cf802945"
+
+
+def syncSample(payloads: dict, passcheck: str, facilityName: str, client: AeroClient,
+               jsonpath: str, journal: PushJournal) -> bool:
+    """Push only what changed for a sample since Aero last accepted it. Metrics and idsnp-checks
+    are sent again if the hash of their canonical JSON differs from the journaled one. Changes to
+    the analysis are sent as the JSON-Patch ops between the journaled and the new analysis
+
+    :param payloads: payloads of the sample from reshapeAll
+    :type payloads: dict
+    :param passcheck: is this analysis approved/failed by facilities
+    :type passcheck: str
+    :param facilityName: such as wgs-west or wgs-east
+    :type facilityName: str
+    :param client: shared Aero API client
+    :type client: AeroClient
+    :param jsonpath: path of the summary.json
+    :type jsonpath: str
+    :param journal: journal with the accepted payloads
+    :type journal: PushJournal
+    :return: False if the analysis was never registered, so the sample needs a full push
+    :rtype: bool
+    """
+    samplename = payloads["analysis"]["analysisName"]
+    accepted = journal.accepted(samplename)
+    if "analysis" in accepted:
+        ids = accepted["analysis"]
+    else:
+        # Registered by a run that did not keep the accepted payloads
+        ids = journal.load(samplename, jsonpath).get("analysis", {})
+        if ids.get("status") != "done":
+            return False
+    analysisPermID = ids["analysisPermID"]
+    pipelineRunPermID = ids["pipelineRunPermID"]
+
+    # Unknown until a call on the analysis answers, the patch GETs it if nothing was sent before it
+    lastUpdateDateTime = None
+    sent = []
+    for kind, send in (
+            ("metrics", lambda: s3.sendMetrics(payloads["metrics"], facilityName, analysisPermID,
+                                               PIPELINEPERMID, pipelineRunPermID, client)),
+            ("idsnp", lambda: s4.sendIdsnp(payloads["idsnp"], facilityName, analysisPermID, client))):
+        digest = payloadHash(payloads[kind])
+        if accepted.get(kind, {}).get("hash") == digest:
+            continue
+        lastUpdateDateTime = s5.latestUpdateDatetime(send(), lastUpdateDateTime)
+        journal.accept(samplename, kind, digest)
+        sent.append(kind)
+
+    state = json.loads(canonicalJSON(s5.analysisState(payloads["analysis"], passcheck)))
+    if "analysis" in accepted:
+        ops = s5.jsonPatchOps(json.loads(accepted["analysis"]["document"]), state)
+    else:
+        # No copy of the accepted analysis, so send the full status patch
+        ops = None
+    if ops is None or ops:
+        s5.sendAnalysisPatch(None, passcheck, facilityName, analysisPermID,
+                             lastUpdateDateTime, client, ops)
+        journal.accept(samplename, "analysis", payloadHash(state), canonicalJSON(state),
+                       analysisPermID, pipelineRunPermID)
+        sent.append("patch")
+
+    log.info("Synced " + samplename + ": " + (", ".join(sent) if sent else "unchanged"))
+    return True
+
 
 # On individual jsons:
 def runApiCalls(
-    raw_qc: dict, passcheck: str, resulthandling: str, usrname: str, password: str
+    raw_qc: dict, passcheck: str, resulthandling: str, client: AeroClient,
+    jsonpath: str = "", journal: PushJournal = None, sync: bool = False,
+    sink: ArchiveSink = None
 ) -> None:
     """Posts analysis, metrics and idsnp-checks.
     Then patches the analysis to say approved/failed depending on input.
@@ -31,122 +119,321 @@ def runApiCalls(
         raw_qc (dict): input qc (summary.json on HPC)
         passcheck (str): is this analysis approved/failed by facilities
         resulthandling (str): send the results to Aero or save them locally for testing
-        usrname (str): FreeIPA username
-        password (str): FreeIPA password
+        client (AeroClient): shared Aero API client
+        jsonpath (str): path of the summary.json, used as journal key
+        journal (PushJournal): if given, steps already done for this sample are skipped
+            and finished steps are recorded
+        sync (bool): only send what changed since Aero last accepted the sample, see syncSample.
+            Needs journal
+        sink (ArchiveSink): when saving, write the payloads to this archive instead of json files
     """
-    # shortcuts
-    rh = resulthandling
     er = raw_qc["metadata"]["experiment_run"]
 
     # Getting facility name for api URL
-    facilityName = er["lab_id"][0]
-    # Testing for '_test' suffix in id string:
-    if "_test" in facilityName:
-        size = len(facilityName)
-        facilityName = facilityName[: size - 5]
-    facilityName = facilityName.replace("_", "-")
-
-    # Set type perm IDs:
-    analysisTypePermId = (
-        # analysis type id for Germline Analysis
-        "00000000-e186-4e86-85eb-55145dc0333d"
-    )
-    # pipeline id for Germline NBA-2 Pipeline
-    pipelinePermID = "11111111-af39-4e13-bbc9-6d45cf802945"
-    # Run the reshapings of the dict
-    analysisRegDict, samplename = s2.reshapeAnalysis(
-        raw_qc, analysisTypePermId, pipelinePermID
-    )
-    metricsDict = s3.reshape(raw_qc)
-    idsnpDict = s4.reshape(raw_qc)
-
-    # Send reshaped data to Aero API
-    analysisPermID = ""
-    if rh == "send":
-        # 1: Send analysis and get various analysis specific IDs back
-        analysisPermID, pipelineRunPermID, lastUpdateDateTime = s2.sendAnalysisReg(
-            analysisRegDict, facilityName, usrname, password
-        )
-
-        # 2: Send metrics for analysis
-        returnedDict = s3.sendMetrics(
-            metricsDict,
-            facilityName,
-            analysisPermID,
-            pipelinePermID,
-            pipelineRunPermID,
-            usrname,
-            password,
-        )
-
-        # 3: Send idsnp for analysis
-        returnedDict = s4.sendIdsnp(
-            idsnpDict, facilityName, analysisPermID, usrname, password
-        )
-
-        # Send json as request to AeroAPI
-        # 4: Patch analysis approve status
-        lastUpdateDateTime = s5.getLastUpdateDateTime(
-            facilityName, analysisPermID, usrname, password
-        )
-        patchDict = s5.patchAnalysis(
-            raw_qc, passcheck, analysisPermID, lastUpdateDateTime
-        )
-        returnedDict = s5.sendPatchRequest(
-            patchDict, facilityName, analysisPermID, usrname, password
-        )
+    facilityName = facilityNameFromLabID(er["lab_id"][0])
+
+    # Run the reshapings of the dict, all payloads in one pass
+    with stage_timing.stage("reshape", file=str(jsonpath)):
+        payloads = reshapeAll(raw_qc, ANALYSISTYPEPERMID, PIPELINEPERMID)
+    pushPayloads(payloads, passcheck, facilityName, resulthandling, client,
+                 jsonpath, journal, sync, sink)
+
+
+def pushPayloads(
+    payloads: dict, passcheck: str, facilityName: str, resulthandling: str, client: AeroClient,
+    jsonpath: str = "", journal: PushJournal = None, sync: bool = False,
+    sink: ArchiveSink = None
+) -> None:
+    """Send or save the reshaped payloads of one sample. Used by runApiCalls and to replay an archive
+
+    Args:
+        payloads (dict): payloads of the sample from reshapeAll, or read back from an archive
+        passcheck (str): is this analysis approved/failed by facilities
+        facilityName (str): such as wgs-west or wgs-east
+        resulthandling (str): send the results to Aero or save them locally for testing
+        client (AeroClient): shared Aero API client
+        jsonpath (str): journal key of the sample
+        journal (PushJournal): if given, steps already done for this sample are skipped
+            and finished steps are recorded
+        sync (bool): only send what changed since Aero last accepted the sample
+        sink (ArchiveSink): when saving, write the payloads to this archive instead of json files
+    """
+    # shortcuts
+    rh = resulthandling
+    analysisRegDict = payloads["analysis"]
+    metricsDict = payloads["metrics"]
+    idsnpDict = payloads["idsnp"]
+    samplename = analysisRegDict["analysisName"]
+
+    # Timings of the calls below are tagged with the sample
+    with stage_timing.tags(sample=samplename, facility=facilityName):
+        # Send reshaped data to Aero API
+        analysisPermID = ""
+        if rh == "send" and sync and syncSample(payloads, passcheck, facilityName,
+                                                client, jsonpath, journal):
+            return
+        if rh == "send":
+            # Steps finished in an earlier run are taken from the journal instead of resent
+            done = journal.load(samplename, jsonpath) if journal is not None else {}
+
+            def isDone(step: str) -> bool:
+                return done.get(step, {}).get("status") == "done"
+
+            def record(step: str, status: str = "done") -> None:
+                if journal is not None:
+                    journal.record(samplename, jsonpath, step, status, analysisPermID,
+                                   pipelineRunPermID, lastUpdateDateTime)
+
+            def accept(kind: str, payload, keep: bool = False) -> None:
+                # Keep what Aero accepted, for later syncs
+                if journal is not None:
+                    journal.accept(samplename, kind, payloadHash(payload),
+                                   canonicalJSON(payload) if keep else None,
+                                   analysisPermID, pipelineRunPermID)
 
+            pipelineRunPermID = lastUpdateDateTime = None
+            step = "analysis"
+            try:
+                # 1: Send analysis and get various analysis specific IDs back
+                if isDone(step):
+                    analysisPermID = done[step]["analysisPermID"]
+                    pipelineRunPermID = done[step]["pipelineRunPermID"]
+                    lastUpdateDateTime = done[step]["lastUpdateDatetime"]
+                else:
+                    analysisPermID, pipelineRunPermID, lastUpdateDateTime = s2.sendAnalysisReg(
+                        analysisRegDict, facilityName, client
+                    )
+                    record(step)
+
+                # 2: Send metrics for analysis
+                step = "metrics"
+                if not isDone(step):
+                    returnedDict = s3.sendMetrics(
+                        metricsDict,
+                        facilityName,
+                        analysisPermID,
+                        PIPELINEPERMID,
+                        pipelineRunPermID,
+                        client,
+                    )
+                    # Carry the analysis' update time forward for the patch
+                    lastUpdateDateTime = s5.latestUpdateDatetime(
+                        returnedDict, lastUpdateDateTime)
+                    record(step)
+                    accept(step, metricsDict)
+
+                # 3: Send idsnp for analysis
+                step = "idsnp"
+                if not isDone(step):
+                    returnedDict = s4.sendIdsnp(
+                        idsnpDict, facilityName, analysisPermID, client
+                    )
+                    lastUpdateDateTime = s5.latestUpdateDatetime(
+                        returnedDict, lastUpdateDateTime)
+                    record(step)
+                    accept(step, idsnpDict)
+
+                # Send json as request to AeroAPI
+                # 4: Patch analysis approve status
+                step = "patch"
+                if not isDone(step):
+                    # Uses the update time of the latest response, only GETs it if that is stale
+                    returnedDict = s5.sendAnalysisPatch(
+                        None, passcheck, facilityName, analysisPermID,
+                        lastUpdateDateTime, client
+                    )
+                    lastUpdateDateTime = s5.latestUpdateDatetime(
+                        returnedDict, lastUpdateDateTime)
+                    record(step)
+                    accept("analysis", s5.analysisState(analysisRegDict, passcheck), keep=True)
+            except Exception as exc:
+                record(step, "failed: " + repr(exc))
+                raise
+
+        elif sink is not None:
+            patchDict = s5.patchAnalysis(None, passcheck, analysisPermID, "")
+            sink.write(samplename, [("analysis", analysisRegDict), ("metrics", metricsDict),
+                                    ("idsnp", idsnpDict), ("patch", patchDict)],
+                       sample=samplename, facility=facilityName, check=passcheck, path=str(jsonpath))
+
+        else:
+            # No analysis is registered when saving, so there is no update time yet
+            lastUpdateDateTime = ""
+            with open(resulthandling + "/analysis_" + samplename + ".json", "w") as outfile:
+                returnedDict = json.dumps(analysisRegDict, indent=2)
+                outfile.write(returnedDict)
+            with open(resulthandling + "/metrics_" + samplename + ".json", "w") as outfile:
+                returnedDict = json.dumps(metricsDict, indent=2)
+                outfile.write(returnedDict)
+            with open(resulthandling + "/idsnp_" + samplename + ".json", "w") as outfile:
+                returnedDict = s4.dumpsPayload(idsnpDict, indent=2)
+                outfile.write(returnedDict)
+            patchDict = s5.patchAnalysis(
+                None, passcheck, analysisPermID, lastUpdateDateTime
+            )
+            with open(
+                resulthandling + "/patchAnalysis_" + samplename + ".json", "w"
+            ) as outfile:
+                returnedDict = json.dumps(patchDict, indent=2)
+                outfile.write(returnedDict)
+
+
+def pushSample(jsonpath: str, passcheck: str, resulthandling: str, client: AeroClient,
+               journal: PushJournal = None, documents: QCDocuments = None,
+               sync: bool = False, sink: ArchiveSink = None) -> None:
+    """Open a summary.json and run all api calls for it. Used as the per-sample task of the push engine
+
+    :param jsonpath: path to summary.json
+    :type jsonpath: str
+    :param passcheck: is this analysis approved/failed by facilities
+    :type passcheck: str
+    :param resulthandling: 'send' will send it to Aero API or input a path to save locally
+    :type resulthandling: str
+    :param client: shared Aero API client
+    :type client: AeroClient
+    :param journal: journal of finished calls. Samples with all steps done are skipped without reading the json
+    :type journal: PushJournal
+    :param documents: parsed document cache shared with the flowcell stage
+    :type documents: QCDocuments
+    :param sync: only send what changed since Aero last accepted the sample. Complete samples are read and compared
+    :type sync: bool
+    :param sink: when saving, write the payloads to this archive instead of json files
+    :type sink: ArchiveSink
+    """
+    if not sync and journal is not None and journal.isComplete(jsonpath):
+        log.info("Already pushed according to journal, skipping: " + str(jsonpath))
+        return
+    if documents is not None:
+        qc_payload = documents.get(jsonpath)
     else:
-        with open(resulthandling + "/analysis_" + samplename + ".json", "w") as outfile:
-            returnedDict = json.dumps(analysisRegDict, indent=2)
-            outfile.write(returnedDict)
-        with open(resulthandling + "/metrics_" + samplename + ".json", "w") as outfile:
-            returnedDict = json.dumps(metricsDict, indent=2)
-            outfile.write(returnedDict)
-        with open(resulthandling + "/idsnp_" + samplename + ".json", "w") as outfile:
-            returnedDict = json.dumps(idsnpDict, indent=2)
-            outfile.write(returnedDict)
-        patchDict = s5.patchAnalysis(
-            raw_qc, passcheck, analysisPermID, lastUpdateDateTime
-        )
-        with open(
-            resulthandling + "/patchAnalysis_" + samplename + ".json", "w"
-        ) as outfile:
-            returnedDict = json.dumps(patchDict, indent=2)
-            outfile.write(returnedDict)
-
-
-def runFlowcellCalls(jsonlist: list, resulthandling: str, usrname: str, password: str) -> None:
+        qc_payload = loadJSON(jsonpath)
+    runApiCalls(qc_payload, passcheck, resulthandling, client,
+                jsonpath, journal, sync, sink)
+
+
+def _saveSampleOffline(task: list) -> tuple:
+    # Worker of runOfflineCalls. Runs in a separate process, so only the small
+    # experiment_run subtree is sent back for the flowcell stage. With an archive
+    # the payloads are compressed here and sent back as blocks for the parent to write
+    jsonpath, passcheck, resulthandling, archive = task
+    raw_qc = loadJSON(jsonpath)
+    sink = MemorySink() if archive else None
+    runApiCalls(raw_qc, passcheck, resulthandling, None, jsonpath, sink=sink)
+    blocks = sink.blocks if sink is not None else []
+    return jsonpath, pruneQC(raw_qc, (("metadata", "experiment_run"),)), blocks
+
+
+def runOfflineCalls(jsonlist: list, resulthandling: str, processes: int, chunksize: int = 16,
+                    sink: ArchiveSink = None, flowcelllist: list = None) -> None:
+    """Reshape all jsons and save them to a directory using a pool of processes. Offline mode has no
+    network waits, so the work is spread over CPU cores instead. Each file is parsed once, by the worker
+    that reshapes it, and the flowcell jsons are built from the experiment_run parts sent back.
+
+    :param jsonlist: List of paths to summary.jsons with the pass/fail check as second value
+    :type jsonlist: list
+    :param resulthandling: path to save dir
+    :type resulthandling: str
+    :param processes: number of worker processes
+    :type processes: int
+    :param chunksize: number of files handed to a worker at a time
+    :type chunksize: int
+    :param sink: write the payloads to this archive instead of json files
+    :type sink: ArchiveSink
+    :param flowcelllist: paths to build the flowcell jsons from, if not those of jsonlist
+    :type flowcelllist: list
+    """
+    documents = QCDocuments()
+    tasks = [list(jsonfile[:2]) + [resulthandling, sink is not None] for jsonfile in jsonlist]
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        for jsonpath, pruned, blocks in executor.map(_saveSampleOffline, tasks, chunksize=chunksize):
+            documents.add(jsonpath, pruned)
+            for key, block in blocks:
+                sink.writeBlock(key, block)
+
+    runFlowcellCalls(jsonlist if flowcelllist is None else flowcelllist, resulthandling, None,
+                     documents=documents, sink=sink)
+
+
+def sendFlowcell(flowcellid: str, flowcelljson: dict, client: AeroClient,
+                 journal: PushJournal = None, sync: bool = False) -> None:
+    """Register one flowcell in Aero unless the journal has it
+
+    :param flowcellid: flowcell key, <flowcellID>-<lab_id>
+    :type flowcellid: str
+    :param flowcelljson: flowcell payload with its samples
+    :type flowcelljson: dict
+    :param client: shared Aero API client
+    :type client: AeroClient
+    :param journal: journal of finished calls. Flowcells already registered are not sent again
+    :type journal: PushJournal
+    :param sync: send registered flowcells again if their payload changed since Aero accepted it
+    :type sync: bool
+    """
+    facilityName = facilityNameFromLabID(flowcellid.split("-", 1)[
+        1
+    ])  # Get first value in split string which contains lab_id aka. facilityName
+    digest = payloadHash(flowcelljson)
+    if journal is not None and journal.isDone(flowcellid, "", "flowcell"):
+        if not sync or journal.accepted(flowcellid).get("flowcell", {}).get("hash") in (None, digest):
+            return
+    s1.sendFlowcells(flowcelljson, facilityName, client)
+    if journal is not None:
+        journal.record(flowcellid, "", "flowcell", "done")
+        journal.accept(flowcellid, "flowcell", digest)
+
+
+def runFlowcellCalls(jsonlist: list, resulthandling: str, client: AeroClient,
+                     journal: PushJournal = None, documents: QCDocuments = None,
+                     sync: bool = False, sink: ArchiveSink = None) -> None:
     """Runs through all analyses, reshapes them to jsons that fit the Aero API sorted by flowcells and posts or or saves them locally.
 
     :param jsonlist: List of paths to summary.jsons
     :type jsonlist: list
     :param resulthandling: 'send' will send it to Aero API or input a path to save locally
     :type resulthandling: str
-    :param usrname: FreeIPA username
-    :type usrname: str
-    :param password: FreeIPA password
-    :type password: str
+    :param client: shared Aero API client
+    :type client: AeroClient
+    :param journal: journal of finished calls. Flowcells already registered are not sent again
+    :type journal: PushJournal
+    :param documents: parsed document cache shared with the per-sample stage
+    :type documents: QCDocuments
+    :param sync: send registered flowcells again if their payload changed since Aero accepted it
+    :type sync: bool
+    :param sink: when saving, write the flowcells to this archive instead of json files
+    :type sink: ArchiveSink
     """
-    rh = resulthandling
     # Handle flowcell registration from sample jsons:
-    multijson = s1.reshapeToFlowcellJsons(jsonlist)
-    if rh == "send":
-        for flowcellid in multijson.keys():
-            # Testing for '_test' suffix in id string:
-            facilityName = flowcellid.split("-", 1)[
-                1
-            ]  # Get first value in split string which contains lab_id aka. facilityName
-            if "_test" in facilityName:
-                size = len(facilityName)
-                facilityName = facilityName[: size - 5]
-                facilityName = facilityName.replace("_", "-")
-            facilityName = facilityName.replace("_", "-")
-            s1.sendFlowcells(multijson[flowcellid],
-                             facilityName, usrname, password)
+    multijson = s1.reshapeToFlowcellJsons(jsonlist, documents)
+    for flowcellid in multijson.keys():
+        handleFlowcell(flowcellid, multijson[flowcellid], resulthandling, client, journal, sync, sink)
+
+
+def handleFlowcell(flowcellid: str, flowcelljson: dict, resulthandling: str, client: AeroClient,
+                   journal: PushJournal = None, sync: bool = False, sink: ArchiveSink = None) -> None:
+    """Send or save one flowcell json
+
+    :param flowcellid: <flowcellID>-<lab_id>
+    :type flowcellid: str
+    :param flowcelljson: flowcell payload with all its samples
+    :type flowcelljson: dict
+    :param resulthandling: 'send' will send it to Aero API or input a path to save locally
+    :type resulthandling: str
+    :param client: shared Aero API client
+    :type client: AeroClient
+    :param journal: journal of finished calls. Flowcells already registered are not sent again
+    :type journal: PushJournal
+    :param sync: send a registered flowcell again if its payload changed since Aero accepted it
+    :type sync: bool
+    :param sink: when saving, write the flowcell to this archive instead of a json file
+    :type sink: ArchiveSink
+    """
+    if resulthandling == "send":
+        sendFlowcell(flowcellid, flowcelljson, client, journal, sync)
+    elif sink is not None:
+        sink.write(flowcellid, [("flowcell", flowcelljson)], flowcell=flowcellid,
+                   facility=facilityNameFromLabID(flowcellid.split("-", 1)[1]))
     else:
-        for flowcellid in multijson.keys():
-            s1.saveFlowcellJsons(multijson[flowcellid], flowcellid, rh)
+        s1.saveFlowcellJsons(flowcelljson, flowcellid, resulthandling)
 
 
 if __name__ == "__main__":
@@ -163,49 +450,255 @@ if __name__ == "__main__":
         type=str,
         help="Define if results should be sent or saved to file [send / pathToSaveDir]",
     )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of samples to push concurrently when running all samples. Calls within a sample keep their order",
+    )
+    parser.add_argument(
+        "--batch",
+        action="store_true",
+        help="Run without prompts: push all samples selected by --policy. When sending, credentials come from\n"
+             "--credentials or the AERO_USERNAME and AERO_PASSWORD environment variables",
+    )
+    parser.add_argument(
+        "--credentials",
+        type=Path,
+        help="File with the username on the first line and the password on the second, instead of prompting",
+    )
+    parser.add_argument(
+        "--policy",
+        type=Path,
+        help="json file selecting samples by check, facility, flowcell, shortname or samplename patterns, e.g.\n"
+             '{"include": [{"check": "passed", "facility": "wgs_east"}], "exclude": [{"samplename": "NA12878*"}]}\n'
+             "Flowcells are only registered if one of their samples is selected",
+    )
+    parser.add_argument(
+        "--facility-limit",
+        action="append",
+        metavar="FACILITY=N",
+        help="Max number of concurrent samples for one facility, e.g. wgs-east=4. Can be given more than once",
+    )
+    parser.add_argument(
+        "--journal",
+        type=Path,
+        help="SQLite file recording finished calls per sample. A rerun with the same journal resumes where it stopped",
+    )
+    parser.add_argument(
+        "--sync",
+        action="store_true",
+        help="Delta sync with --journal: only send payloads that changed since Aero last accepted them,\n"
+             "and changes to an analysis as JSON-Patch ops",
+    )
+    parser.add_argument(
+        "--flowcell-index",
+        type=Path,
+        help="SQLite file indexing flowcells and their samples across runs. Only new or changed jsons are read\n"
+             "for the flowcells, which then hold every sample ever indexed, and only changed flowcells are sent",
+    )
+    parser.add_argument(
+        "--cache-mb",
+        type=int,
+        default=2048,
+        help="Memory bound in MB (on-disk size of the source files) for parsed jsons kept between the flowcell and sample stages",
+    )
+    parser.add_argument(
+        "--processes",
+        type=int,
+        default=1,
+        help="When saving to a directory: number of processes to reshape with. All samples are saved without prompting",
+    )
+    parser.add_argument(
+        "--chunksize",
+        type=int,
+        default=16,
+        help="When saving with --processes: number of files handed to a process at a time",
+    )
+    parser.add_argument(
+        "--archive",
+        action="store_true",
+        help="When saving to a directory: write all payloads as records of gzipped NDJSON (payloads.ndjson.gz)\n"
+             "instead of one json file per payload. Send it later with replay_archive.py",
+    )
+    parser.add_argument(
+        "--archive-shards",
+        type=int,
+        default=1,
+        help="With --archive: spread the samples over this many files (payloads-NNN.ndjson.gz)",
+    )
+    parser.add_argument(
+        "--streaming",
+        action="store_true",
+        help="Read only the needed parts of each json with an incremental parser (ijson). Lowers peak memory on large files",
+    )
+    parser.add_argument(
+        "--retries",
+        type=int,
+        default=5,
+        help="Max retries of a failed Aero API call. POST and PATCH are only retried when throttled (429)",
+    )
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        default=120,
+        help="Seconds to wait for an Aero API response",
+    )
+    parser.add_argument(
+        "--latency-target",
+        type=float,
+        help="Seconds. Slower Aero API calls lower the number of calls in flight like throttling does",
+    )
+    parser.add_argument(
+        "--gzip",
+        nargs="*",
+        metavar="ROUTE",
+        help="gzip request bodies of these routes, e.g. 'POST /qc/analyses/{id}/metrics'.\n"
+             "Without routes: the metrics and idsnp-check posts. Routes answering 415 get plain bodies",
+    )
+    parser.add_argument(
+        "--log-level",
+        default="INFO",
+        choices=("DEBUG", "INFO", "WARNING", "ERROR"),
+        help="INFO logs one line per API call, DEBUG also the full request and response bodies",
+    )
+    parser.add_argument(
+        "--log-bodies",
+        type=float,
+        default=0.0,
+        metavar="FRACTION",
+        help="Also log the bodies of this fraction of the API calls, e.g. 0.01. Bodies of failed calls are always logged",
+    )
+    parser.add_argument(
+        "--timings",
+        type=Path,
+        help="Write per-stage timings (file read, parse, reshape, token, each API call) as json lines to this file "
+             "and print a histogram per stage at the end",
+    )
     args = parser.parse_args()
+    if args.sync and not args.journal:
+        parser.error("--sync needs --journal, which keeps what Aero last accepted")
+    call_log.configure(args.log_level, args.log_bodies)
+    policy = loadPolicy(args.policy) if args.policy else None
 
-    usrname = input("\nEnter username...\n")
-    pw = getpass.getpass("\nEnter password...\n")
+    if args.timings:
+        stage_timing.enable(args.timings)
 
-    # Handle flowcell registration
-    with args.qc_list_input.open("r") as src:
-        jsonlist = pd.read_csv(src)
-        jsonlist = jsonlist.values.tolist()
+    sink = None
+    if args.archive and args.resulthandling != "send":
+        sink = ArchiveSink(args.resulthandling, args.archive_shards)
 
-    runFlowcellCalls(
-        jsonlist, args.resulthandling, usrname, pw
-    )
+    if args.resulthandling != "send" and args.processes > 1:
+        jsonlist = list(readJsonList(args.qc_list_input))
+        flowcelllist = None
+        if policy is not None:
+            groups = selectedFlowcells(jsonlist, policy)
+            flowcelllist = [row for row in jsonlist if flowcellGroup(row) in groups]
+            jsonlist = [row for row in jsonlist if policy.selects(row)]
+        runOfflineCalls(jsonlist, args.resulthandling,
+                        args.processes, args.chunksize, sink, flowcelllist)
+        if sink is not None:
+            sink.close()
+        sys.exit(0)
 
-    run_choice = "Not given"
+    documents = QCDocuments(args.cache_mb * 1024 ** 2,
+                            streaming=args.streaming)
+    engine = PushEngine(args.workers, parseFacilityLimits(args.facility_limit))
+    journal = PushJournal(args.journal) if args.journal else None
+
+    client = None
+    # Saving locally needs no credentials
+    if args.resulthandling == "send":
+        usrname, pw = readCredentials(args.credentials, prompt=not args.batch)
+        # Calls in flight adapt between 1 and the number of workers to what Aero can take
+        limiter = AdaptiveLimiter(max(args.workers, 1),
+                                  latencytarget=args.latency_target)
+        compress = () if args.gzip is None else (args.gzip or COMPRESSROUTES)
+        client = AeroClient(usrname, pw, timeout=(10, args.timeout),
+                            retries=args.retries, limiter=limiter, compress=compress)
+
+    # The list is read row by row. Each flowcell is registered as soon as all its samples are read,
+    # before any of them is pushed
+    rows = readJsonList(args.qc_list_input)
+    if policy is not None:
+        # Only flowcells with a selected sample are read, with all their samples
+        groups = selectedFlowcells(readJsonList(args.qc_list_input), policy)
+        rows = (row for row in rows if flowcellGroup(row) in groups)
+    expected = countFlowcellRows(args.qc_list_input)
+    if args.flowcell_index:
+        # Flowcells come from the index, with the samples of earlier runs
+        index = FlowcellIndex(args.flowcell_index)
+        index.merge(rows, documents)
+        for flowcellid in index.changed():
+            # A changed flowcell is sent again even if the journal has it, unless Aero has this payload
+            handleFlowcell(flowcellid, index.flowcell(flowcellid), args.resulthandling, client, journal,
+                           True, sink)
+            index.markEmitted(flowcellid)
+        index.close()
+        events = (("sample", row, None) for row in readJsonList(args.qc_list_input))
+    else:
+        events = s1.streamFlowcellJsons(rows, expected, documents)
+
+    run_choice = "a" if args.batch else "Not given"
+    selected = 0
+    # Samples of flowcells whose samples disagree, with the problem
+    heldback = []
     # Handle other api calls one by one
-    for jsonfile in jsonlist:
-        jsonpath = jsonfile[0]
+    for event, item, value in events:
+        if event == "flowcell":
+            handleFlowcell(item, value, args.resulthandling, client, journal, args.sync, sink)
+            continue
+        row = item
+        if policy is not None and not policy.selects(row):
+            continue
+        selected += 1
+        if event == "mismatch":
+            # The rest of the list is still sent, the flowcell is reported at the end
+            log.error("Holding back %s: %s", row.samplename, value)
+            heldback.append((row.samplename, value))
+            continue
 
         if run_choice == "Not given":
             run_choice = input(
                 "\nEnter 'a' to send all jsons in list or 'o' to accept one by one..")
 
         if run_choice == "a":
-            # Open json file
-            with open(jsonpath, "r") as src:
-                qc_payload = json.load(src)
-
-            runApiCalls(qc_payload, jsonfile[1],
-                        args.resulthandling, usrname, pw)
+            # Queue the sample, it runs as soon as the engine has a free slot
+            engine.submit(facilityNameFromLabID(row.facility), row.samplename, pushSample,
+                          row.path, row.check, args.resulthandling, client, journal, documents,
+                          args.sync, sink)
         else:
             while True:
                 run_choice = input(
-                    "\nSend {}? Enter 'y' to send, 'n' to skip or 'a' to run all remaining samples...".format(jsonfile[6]))
+                    "\nSend {}? Enter 'y' to send, 'n' to skip or 'a' to run all remaining samples...".format(row.file))
 
-                if run_choice == "y" or run_choice == "a":
-                    with open(jsonpath, "r") as src:
-                        qc_payload = json.load(src)
-                    runApiCalls(
-                        qc_payload, jsonfile[1], args.resulthandling, usrname, pw)
+                if run_choice == "y":
+                    pushSample(row.path, row.check,
+                               args.resulthandling, client, journal, documents, args.sync, sink)
+                    break
+                elif run_choice == "a":
+                    engine.submit(facilityNameFromLabID(row.facility), row.samplename, pushSample,
+                                  row.path, row.check, args.resulthandling, client, journal, documents,
+                                  args.sync, sink)
                     break
                 elif run_choice == "n":
                     break
                 else:
                     print("\nWrong choice... try again")
                     continue
+
+    if policy is not None:
+        log.info("Policy selected %d of %d samples", selected, sum(expected.values()))
+    failed = engine.wait()
+    engine.shutdown()
+    if journal is not None:
+        journal.close()
+    if sink is not None:
+        sink.close()
+    timer = stage_timing.disable()
+    if timer is not None:
+        sys.stderr.write('\nStage timings:\n' + timer.summary())
+    problems = [name for name, exc in failed] + \
+        ['{} held back, {}'.format(name, problem) for name, problem in heldback]
+    if problems:
+        raise SystemExit('{} samples failed:\n'.format(len(problems)) + '\n'.join(problems))
@@ -0,0 +1,156 @@
+"""
+Local journal of which Aero API calls are done for each sample, so interrupted pushes can be resumed.
+
+Every step of a sample (analysis, metrics, idsnp, patch) is stored with its status and the IDs
+returned by Aero, keyed by sample name and source json path. Flowcell registrations are stored
+as step 'flowcell' keyed by the flowcell key. On restart finished steps are skipped.
+
+For delta syncs the journal also keeps what Aero last accepted per sample and payload kind: a hash
+of the canonical JSON and, for the analysis, the document itself so later changes can be sent as
+JSON-Patch ops.
+"""
+
+import sqlite3
+import threading
+from pathlib import Path
+
+STEPS = ('analysis', 'metrics', 'idsnp', 'patch')
+
+
+class PushJournal:
+    """SQLite backed journal of finished Aero API calls
+
+    :param path: path to the journal file. Created if it does not exist
+    :type path: Path
+    """
+
+    def __init__(self, path: Path):
+        self.path = str(path)
+        self._lock = threading.Lock()
+        self._con = sqlite3.connect(self.path, check_same_thread=False)
+        self._con.execute('PRAGMA journal_mode=WAL')
+        self._con.execute('PRAGMA synchronous=NORMAL')
+        self._con.execute("""
+            CREATE TABLE IF NOT EXISTS steps (
+                samplename TEXT NOT NULL,
+                jsonpath TEXT NOT NULL,
+                step TEXT NOT NULL,
+                status TEXT NOT NULL,
+                analysisPermID TEXT,
+                pipelineRunPermID TEXT,
+                lastUpdateDatetime TEXT,
+                updated TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (samplename, jsonpath, step)
+            )""")
+        self._con.execute("""
+            CREATE TABLE IF NOT EXISTS accepted (
+                samplename TEXT NOT NULL,
+                kind TEXT NOT NULL,
+                hash TEXT NOT NULL,
+                document TEXT,
+                analysisPermID TEXT,
+                pipelineRunPermID TEXT,
+                updated TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (samplename, kind)
+            )""")
+        self._con.commit()
+
+    def load(self, samplename: str, jsonpath: str) -> dict:
+        """All journaled steps of a sample
+
+        :param samplename: sample name
+        :type samplename: str
+        :param jsonpath: path to the source summary.json
+        :type jsonpath: str
+        :return: {step: {'status': ..., 'analysisPermID': ..., 'pipelineRunPermID': ..., 'lastUpdateDatetime': ...}}
+        :rtype: dict
+        """
+        with self._lock:
+            rows = self._con.execute(
+                'SELECT step, status, analysisPermID, pipelineRunPermID, lastUpdateDatetime '
+                'FROM steps WHERE samplename = ? AND jsonpath = ?',
+                (samplename, str(jsonpath))).fetchall()
+        return {row[0]: {'status': row[1],
+                         'analysisPermID': row[2],
+                         'pipelineRunPermID': row[3],
+                         'lastUpdateDatetime': row[4]} for row in rows}
+
+    def isDone(self, samplename: str, jsonpath: str, step: str) -> bool:
+        return self.load(samplename, jsonpath).get(step, {}).get('status') == 'done'
+
+    def isComplete(self, jsonpath: str) -> bool:
+        """True if every step is done for the sample in jsonpath. Lets a rerun skip the file without reading it
+
+        :param jsonpath: path to the source summary.json
+        :type jsonpath: str
+        :rtype: bool
+        """
+        with self._lock:
+            ndone = self._con.execute(
+                "SELECT COUNT(DISTINCT step) FROM steps WHERE jsonpath = ? AND status = 'done' "
+                'AND step IN ({})'.format(','.join('?' * len(STEPS))),
+                (str(jsonpath),) + STEPS).fetchone()[0]
+        return ndone == len(STEPS)
+
+    def record(self, samplename: str, jsonpath: str, step: str, status: str,
+               analysisPermID: str = None, pipelineRunPermID: str = None,
+               lastUpdateDatetime: str = None) -> None:
+        """Store the outcome of a step. Committed right away so it survives a crash
+
+        :param samplename: sample name
+        :type samplename: str
+        :param jsonpath: path to the source summary.json
+        :type jsonpath: str
+        :param step: one of STEPS or 'flowcell'
+        :type step: str
+        :param status: 'done' or a failure description
+        :type status: str
+        """
+        with self._lock:
+            self._con.execute(
+                'INSERT OR REPLACE INTO steps (samplename, jsonpath, step, status, analysisPermID, '
+                'pipelineRunPermID, lastUpdateDatetime, updated) VALUES (?, ?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP)',
+                (samplename, str(jsonpath), step, status, analysisPermID,
+                 pipelineRunPermID, lastUpdateDatetime))
+            self._con.commit()
+
+    def accepted(self, samplename: str) -> dict:
+        """What Aero last accepted for a sample (or flowcell key), per payload kind
+
+        :param samplename: sample name
+        :type samplename: str
+        :return: {kind: {'hash': ..., 'document': ..., 'analysisPermID': ..., 'pipelineRunPermID': ...}}
+        :rtype: dict
+        """
+        with self._lock:
+            rows = self._con.execute(
+                'SELECT kind, hash, document, analysisPermID, pipelineRunPermID '
+                'FROM accepted WHERE samplename = ?', (samplename,)).fetchall()
+        return {row[0]: {'hash': row[1],
+                         'document': row[2],
+                         'analysisPermID': row[3],
+                         'pipelineRunPermID': row[4]} for row in rows}
+
+    def accept(self, samplename: str, kind: str, hash: str, document: str = None,
+               analysisPermID: str = None, pipelineRunPermID: str = None) -> None:
+        """Store the payload Aero accepted for a sample, replacing the earlier one
+
+        :param samplename: sample name, or flowcell key for kind 'flowcell'
+        :type samplename: str
+        :param kind: 'analysis', 'metrics', 'idsnp' or 'flowcell'
+        :type kind: str
+        :param hash: hash of the canonical JSON of the payload
+        :type hash: str
+        :param document: canonical JSON of the payload, kept where later changes are sent as patches
+        :type document: str
+        """
+        with self._lock:
+            self._con.execute(
+                'INSERT OR REPLACE INTO accepted (samplename, kind, hash, document, analysisPermID, '
+                'pipelineRunPermID, updated) VALUES (?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP)',
+                (samplename, kind, hash, document, analysisPermID, pipelineRunPermID))
+            self._con.commit()
+
+    def close(self) -> None:
+        with self._lock:
+            self._con.close()
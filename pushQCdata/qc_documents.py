@@ -0,0 +1,284 @@
+"""
+Parsed QC json documents shared between the stages of a push run.
+
+Each summary.json is read and parsed once. Only the subtrees used by the reshapers are kept, in an
+LRU cache with an upper bound on memory, so the flowcell stage and the per-sample stage do not both
+parse the same large files from GPFS.
+"""
+
+import json
+import os
+import threading
+from collections import OrderedDict
+
+import stage_timing
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ijson
+    from ijson.common import ObjectBuilder
+except ImportError:
+    ijson = None
+
+# Subtrees of summary.json used by the reshape_* scripts. Integers are list indices
+QCPATHS = (
+    ("metadata", "experiment_run"),
+    ("germline_full", "metrics", "samples", 0, "QC_summary"),
+    ("germline_full", "outputs"),
+    ("all_idsnp_comparisons",),
+)
+
+
+def loadJSON(jsonpath: str) -> dict:
+    """Read and parse a json file. Uses orjson when it is installed, falling back to the json module
+    for documents orjson rejects, such as ones containing NaN
+
+    :param jsonpath: path to json file
+    :type jsonpath: str
+    :rtype: dict
+    """
+    with stage_timing.stage("read", file=str(jsonpath)):
+        with open(jsonpath, "rb") as src:
+            data = src.read()
+    with stage_timing.stage("parse", file=str(jsonpath)):
+        if orjson is None:
+            return json.loads(data)
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            return json.loads(data)
+
+
+def pruneQC(raw_qc: dict, paths: tuple = QCPATHS) -> dict:
+    """Copy of raw_qc holding only the given subtrees, with the same nesting so reshapers can use it as is.
+    Paths that are not in raw_qc are left out, so lookups on them fail the same way as on the full document
+
+    :param raw_qc: dictionary of qc json
+    :type raw_qc: dict
+    :param paths: paths of subtrees to keep
+    :type paths: tuple
+    :return: pruned dictionary
+    :rtype: dict
+    """
+    return _prune(raw_qc, [tuple(path) for path in paths])
+
+
+def _prune(node, paths: list):
+    if () in paths or not isinstance(node, (dict, list)):
+        return node
+
+    children = {}
+    for path in paths:
+        children.setdefault(path[0], []).append(path[1:])
+
+    if isinstance(node, list):
+        present = [k for k in children if isinstance(k, int) and 0 <= k < len(node)]
+        # Indices that are not asked for are kept as None placeholders
+        pruned = [None] * (max(present) + 1 if present else 0)
+    else:
+        present = [k for k in children if k in node]
+        pruned = {}
+    for key in present:
+        pruned[key] = _prune(node[key], children[key])
+    return pruned
+
+
+def extractQC(jsonpath: str, paths: tuple = QCPATHS) -> dict:
+    """Read only the given subtrees of a json file, e.g. extractQC(path, [("germline_full", "outputs")]).
+    The file is parsed incrementally with ijson and reading stops as soon as all subtrees are found,
+    so the rest of the document is never built in memory. The result has the same nesting as the file
+    and is what pruneQC would return for the full document. Without ijson the whole file is loaded and pruned.
+
+    :param jsonpath: path to json file
+    :type jsonpath: str
+    :param paths: paths of subtrees to read. Integers are list indices
+    :type paths: tuple
+    :return: dictionary with only the requested subtrees
+    :rtype: dict
+    """
+    if ijson is None:
+        return pruneQC(loadJSON(jsonpath), paths)
+    # Reading and parsing are interleaved, so they are timed as one stage
+    with stage_timing.stage("read+parse", file=str(jsonpath)), open(jsonpath, "rb") as src:
+        return _extract(ijson.basic_parse(src, use_float=True), paths)
+
+
+def _extract(events, paths: tuple) -> dict:
+    remaining = set(tuple(path) for path in paths)
+    # Containers that are not on the way to a requested subtree are skipped
+    # without tracking positions inside them
+    onpath = set(path[:i] for path in remaining for i in range(len(path)))
+    skipdepth = 0
+    extracted = {}
+    # One [kind, key] entry per open container above the current position.
+    # key is the current map key or array index
+    stack = []
+    builder = None
+    for event, value in events:
+        if skipdepth:
+            if event in ("start_map", "start_array"):
+                skipdepth += 1
+            elif event in ("end_map", "end_array"):
+                skipdepth -= 1
+            continue
+        if builder is not None:
+            # Inside a requested subtree, build it until its container closes
+            builder.event(event, value)
+            if event in ("start_map", "start_array"):
+                depth += 1
+            elif event in ("end_map", "end_array"):
+                depth -= 1
+                if depth == 0:
+                    _graft(extracted, target, builder.value)
+                    remaining.discard(target)
+                    builder = None
+                    if not remaining:
+                        break
+            continue
+
+        if event == "map_key":
+            stack[-1][1] = value
+            continue
+        if event in ("end_map", "end_array"):
+            stack.pop()
+            continue
+
+        # Any other event starts a value
+        if stack and stack[-1][0] == "array":
+            stack[-1][1] += 1
+        here = tuple(entry[1] for entry in stack)
+        if here in remaining:
+            if event in ("start_map", "start_array"):
+                builder = ObjectBuilder()
+                builder.event(event, value)
+                depth = 1
+                target = here
+            else:
+                _graft(extracted, here, value)
+                remaining.discard(here)
+                if not remaining:
+                    break
+        elif event in ("start_map", "start_array") and here not in onpath:
+            skipdepth = 1
+        elif event == "start_map":
+            stack.append(["map", None])
+        elif event == "start_array":
+            stack.append(["array", -1])
+    return extracted
+
+
+def _graft(root: dict, path: tuple, value) -> None:
+    # Put value at path in root, creating the containers on the way
+    node = root
+    for key, nextkey in zip(path, path[1:] + (None,)):
+        if isinstance(node, list):
+            while len(node) <= key:
+                node.append(None)
+        if nextkey is None:
+            node[key] = value
+        else:
+            if isinstance(node, list) and node[key] is None or \
+                    isinstance(node, dict) and key not in node:
+                node[key] = [] if isinstance(nextkey, int) else {}
+            node = node[key]
+
+
+def _fileState(jsonpath: str) -> tuple:
+    stat = os.stat(jsonpath)
+    return stat.st_size, stat.st_mtime_ns
+
+
+class QCDocuments:
+    """LRU cache of pruned QC json documents, bounded by the on-disk size of the cached files.
+    A cached document is only used while the size and mtime of its file are unchanged
+
+    :param maxbytes: max total size of the source files of cached documents
+    :type maxbytes: int
+    :param paths: subtrees to keep of each document
+    :type paths: tuple
+    :param streaming: read only the subtrees with extractQC instead of parsing whole files. Uses far less
+        memory on large files, but parsing whole files with orjson is faster when memory is not a concern
+    :type streaming: bool
+    """
+
+    def __init__(self, maxbytes: int = 2 * 1024 ** 3, paths: tuple = QCPATHS,
+                 streaming: bool = False):
+        self.maxbytes = maxbytes
+        self.paths = paths
+        self.streaming = streaming
+        self.hits = 0
+        self.misses = 0
+
+        self._docs = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, jsonpath: str) -> dict:
+        """Pruned document of jsonpath. Parsed from disk only if not cached or the file changed since
+
+        :param jsonpath: path to summary.json
+        :type jsonpath: str
+        :rtype: dict
+        """
+        key = str(jsonpath)
+        state = _fileState(key)
+        with self._lock:
+            cached = self._docs.get(key)
+            if cached is not None and cached[2] == state:
+                self._docs.move_to_end(key)
+                self.hits += 1
+                return cached[0]
+            self.misses += 1
+
+        size = state[0]
+        if self.streaming:
+            doc = extractQC(key, self.paths)
+        else:
+            doc = pruneQC(loadJSON(key), self.paths)
+
+        with self._lock:
+            if key in self._docs:
+                self._size -= self._docs.pop(key)[1]
+            if size <= self.maxbytes:
+                self._docs[key] = (doc, size, state)
+                self._size += size
+                self._evict()
+        return doc
+
+    def _evict(self) -> None:
+        # Called with the lock held
+        while self._size > self.maxbytes:
+            _, (_, oldsize, _) = self._docs.popitem(last=False)
+            self._size -= oldsize
+
+    def add(self, jsonpath: str, doc: dict, size: int = 0) -> None:
+        """Put an already parsed document in the cache, e.g. one parsed by a worker process
+
+        :param jsonpath: path to summary.json
+        :type jsonpath: str
+        :param doc: parsed (and possibly pruned) document
+        :type doc: dict
+        :param size: size counted against maxbytes
+        :type size: int
+        """
+        key = str(jsonpath)
+        state = _fileState(key)
+        with self._lock:
+            if key in self._docs:
+                self._size -= self._docs.pop(key)[1]
+            self._docs[key] = (doc, size, state)
+            self._size += size
+            self._evict()
+
+    def experimentRun(self, jsonpath: str) -> dict:
+        """metadata.experiment_run of jsonpath, which is all the flowcell stage needs
+
+        :param jsonpath: path to summary.json
+        :type jsonpath: str
+        :rtype: dict
+        """
+        return self.get(jsonpath)["metadata"]["experiment_run"]
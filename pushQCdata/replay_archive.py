@@ -0,0 +1,181 @@
+"""
+Sends a payload archive written by push_historic_files.py --archive to the Aero API
+
+Flowcells are registered first, then every sample goes through the same send path as
+push_historic_files.py (journal, delta sync, retries and concurrency included).
+
+Input: save dir with payloads*.ndjson.gz or one archive file
+Output: api request calls for all payloads in the archive
+"""
+
+import argparse
+import logging
+import sys
+import threading
+from pathlib import Path
+
+from aero_client import COMPRESSROUTES, AdaptiveLimiter, AeroClient
+from batch_mode import readCredentials
+import call_log
+from payload_archive import findArchives, readArchive, readSamples
+from push_engine import PushEngine, parseFacilityLimits
+from push_journal import PushJournal
+import push_historic_files as push
+import stage_timing
+
+log = logging.getLogger(__name__)
+
+
+def replayArchive(paths: list, client: AeroClient, engine: PushEngine,
+                  journal: PushJournal = None, sync: bool = False) -> list:
+    """Send all payloads of archive files to Aero
+
+    :param paths: archive files
+    :type paths: list
+    :param client: shared Aero API client
+    :type client: AeroClient
+    :param engine: runs the samples concurrently
+    :type engine: PushEngine
+    :param journal: journal of finished calls. Samples are keyed by the path of their summary.json, as
+        in direct pushes, or by <archive folder>#<sample name> in archives written without paths
+    :type journal: PushJournal
+    :param sync: only send what changed since Aero last accepted each sample
+    :type sync: bool
+    :return: list of (sample name, exception) for the samples that failed
+    :rtype: list
+    """
+    for record in readArchive(paths, ("flowcell",)):
+        push.sendFlowcell(record["flowcell"], record["payload"], client, journal, sync)
+
+    # Only a few samples per worker are read ahead, so the archive is never all in memory
+    slots = threading.Semaphore(2 * engine.workers)
+
+    def pushRecords(key: str, records: dict) -> None:
+        try:
+            if not sync and journal is not None and journal.isComplete(key):
+                log.info("Already pushed according to journal, skipping: " + key)
+                return
+            payloads = {kind: record["payload"] for kind, record in records.items()}
+            analysis = records["analysis"]
+            push.pushPayloads(payloads, analysis["check"], analysis["facility"], "send", client,
+                              key, journal, sync)
+        finally:
+            slots.release()
+
+    folder = str(Path(paths[0]).parent) if paths else ""
+    for sample, records in readSamples(paths):
+        slots.acquire()
+        # Journaled under the same key as a direct push of the sample
+        key = records["analysis"].get("path") or folder + "#" + sample
+        engine.submit(records["analysis"]["facility"], sample, pushRecords, key, records)
+    return engine.wait()
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawTextHelpFormatter,
+        description=__doc__)
+    parser.add_argument(
+        "archive",
+        type=Path,
+        help="Save dir written by push_historic_files.py --archive, or one payloads*.ndjson.gz file",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of samples to push concurrently. Calls within a sample keep their order",
+    )
+    parser.add_argument(
+        "--facility-limit",
+        action="append",
+        metavar="FACILITY=N",
+        help="Max number of concurrent samples for one facility, e.g. wgs-east=4. Can be given more than once",
+    )
+    parser.add_argument(
+        "--journal",
+        type=Path,
+        help="SQLite file recording finished calls per sample. A rerun with the same journal resumes where it stopped.\n"
+             "Samples are journaled by the path of their summary.json, so the journal of push_historic_files.py\n"
+             "can be shared and samples it already pushed are skipped. Archives written before paths were\n"
+             "recorded are journaled by <archive folder>#<sample name> and do not share it",
+    )
+    parser.add_argument(
+        "--sync",
+        action="store_true",
+        help="Delta sync with --journal: only send payloads that changed since Aero last accepted them",
+    )
+    parser.add_argument(
+        "--credentials",
+        type=Path,
+        help="File with the username on the first line and the password on the second. Without it the\n"
+             "AERO_USERNAME and AERO_PASSWORD environment variables are used, or else prompted for",
+    )
+    parser.add_argument(
+        "--retries",
+        type=int,
+        default=5,
+        help="Max retries of a failed Aero API call. POST and PATCH are only retried when throttled (429)",
+    )
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        default=120,
+        help="Seconds to wait for an Aero API response",
+    )
+    parser.add_argument(
+        "--gzip",
+        nargs="*",
+        metavar="ROUTE",
+        help="gzip request bodies of these routes, e.g. 'POST /qc/analyses/{id}/metrics'.\n"
+             "Without routes: the metrics and idsnp-check posts. Routes answering 415 get plain bodies",
+    )
+    parser.add_argument(
+        "--log-level",
+        default="INFO",
+        choices=("DEBUG", "INFO", "WARNING", "ERROR"),
+        help="INFO logs one line per API call, DEBUG also the full request and response bodies",
+    )
+    parser.add_argument(
+        "--log-bodies",
+        type=float,
+        default=0.0,
+        metavar="FRACTION",
+        help="Also log the bodies of this fraction of the API calls, e.g. 0.01. Bodies of failed calls are always logged",
+    )
+    parser.add_argument(
+        "--timings",
+        type=Path,
+        help="Write per-stage timings as json lines to this file and print a histogram per stage at the end",
+    )
+    args = parser.parse_args()
+    if args.sync and not args.journal:
+        parser.error("--sync needs --journal, which keeps what Aero last accepted")
+    call_log.configure(args.log_level, args.log_bodies)
+
+    paths = findArchives(args.archive)
+    if not paths:
+        raise SystemExit("No payloads*.ndjson.gz in " + str(args.archive))
+    if args.timings:
+        stage_timing.enable(args.timings)
+
+    engine = PushEngine(args.workers, parseFacilityLimits(args.facility_limit))
+    journal = PushJournal(args.journal) if args.journal else None
+
+    usrname, pw = readCredentials(args.credentials)
+    compress = () if args.gzip is None else (args.gzip or COMPRESSROUTES)
+    client = AeroClient(usrname, pw, timeout=(10, args.timeout), retries=args.retries,
+                        limiter=AdaptiveLimiter(max(args.workers, 1)), compress=compress)
+
+    failed = replayArchive(paths, client, engine, journal, args.sync)
+    engine.shutdown()
+    client.close()
+    if journal is not None:
+        journal.close()
+    timer = stage_timing.disable()
+    if timer is not None:
+        sys.stderr.write('\nStage timings:\n' + timer.summary())
+    if failed:
+        raise SystemExit('{} samples failed:\n'.format(len(failed)) +
+                         '\n'.join(name for name, exc in failed))
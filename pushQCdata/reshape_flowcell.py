@@ -2,125 +2,241 @@
 Script for reshaping NBA-2 Germline pipeline QC JSON into something more suitable for
 HTTP POST flowcell payloads.
 
-Input: csv file with paths of sample json files in first column of each row. Extra columns are ignored.
+Input: csv file from get_json_paths.py, read row by row. Extra columns are ignored.
 Output: json file for each found flowcell with all samples in that flowcell. Instead of saving
+Flowcells whose samples disagree are left out and their samples listed at the end
 """
 
 import argparse
 import json
-import sys
+import logging
 from pathlib import Path
 
-import pandas as pd
-import requests
+from aero_client import AeroClient, facilityNameFromLabID
+from call_log import logExchange
+from field_mapping import Field, compileSpec
+from json_list import countFlowcellRows, flowcellGroup, readJsonList
+from qc_documents import QCDocuments
+import stage_timing
+
+log = logging.getLogger(__name__)
+
+
+def seqRunDate(start_time) -> str:
+    """Date part of start_time, which is either a date or a datetime"""
+    # "seqRunDatetime" : start_time, TEST. Datetime is not working at backend
+    return start_time[:10] if len(str(start_time)) > 10 else start_time
+
+
+# Flowcell payload without its samples, which are added one by one
+FLOWCELLSPEC = {
+    "flowcellID": Field(("er", "flowcell_id", 0)),
+    "flowcellNr": Field(("er", "run_number", 0)),
+    "machineSerialNr": Field(("er", "instrument_serial_nr", 0)),
+    "seqRunID": Field(("er", "run_id", 0)),
+    "seqRunDate": Field(("er", "start_time", 0), convert=seqRunDate),
+}
+# One entry of the samples list of a flowcell payload
+FLOWCELLSAMPLESPEC = {
+    "ngcSubjectID": Field(("es", "ngc_subject_id")),
+    "sampleID": Field(("es", "sample_id")),
+    "sampleName": Field(("es", "sample_name")),
+    "subjectID": Field(("es", "subject_id")),
+    "registrationIDs": [
+        Field(("es", "registration_id"))
+    ]
+}
+# Key of a flowcell in the output of reshapeToFlowcellJsons, and the fields needed for the date check
+FLOWCELLKEYSPEC = {
+    "flowcellID": Field(("er", "flowcell_id", 0)),
+    "labID": Field(("er", "lab_id", 0)),
+    "startTime": Field(("er", "start_time", 0)),
+}
+_FLOWCELL = compileSpec({"key": FLOWCELLKEYSPEC,
+                         "flowcell": FLOWCELLSPEC,
+                         "sample": FLOWCELLSAMPLESPEC})
+
+
+def flowcellParts(qc_json: str, raw_qc: dict) -> tuple:
+    """Reshape a sample json to the parts of its flowcell json
+
+    :param qc_json: path of the sample json
+    :type qc_json: str
+    :param raw_qc: dictionary of the sample json
+    :type raw_qc: dict
+    :raises MissingFieldsError: listing all fields missing from the json
+    :return: flowcell key <flowcellID>-<lab_id>, flowcell fields, sample entry and the flowcell fields
+        that must match other samples of the flowcell
+    :rtype: tuple
+    """
+    with stage_timing.stage("flowcell reshape", file=str(qc_json)):
+        reshaped = _FLOWCELL(raw_qc)
+    key = reshaped["key"]
+    flowcellkey = key["flowcellID"] + '-' + key["labID"]
+
+    # Check if date or datetime:
+    # commented out as TEST, currently cant check because datetime is
+    # not working at backend
+    if len(str(key["startTime"])) > 10:
+        checklist = ["flowcellID", "flowcellNr", "seqRunID"]  # seqRunDatetime
+    else:
+        checklist = ["flowcellID", "flowcellNr", "seqRunID", "seqRunDate"]
+    return flowcellkey, reshaped["flowcell"], reshaped["sample"], checklist
+
+
+def checkFlowcell(previous: dict, flowcell: dict, checklist: list, qc_json: str) -> None:
+    """Check for equal values in already loaded flowcell and new flowcell
+
+    :param previous: flowcell fields from earlier samples
+    :type previous: dict
+    :param flowcell: flowcell fields of the sample json
+    :type flowcell: dict
+    :param checklist: fields to compare, from flowcellParts
+    :type checklist: list
+    :param qc_json: path of the sample json, used in the error message
+    :type qc_json: str
+    :raises SystemExit: if a value differs
+    """
+    for valueToCheck in checklist:
+        if previous[valueToCheck] != flowcell[valueToCheck]:
+            raise SystemExit(f'{valueToCheck} does not match previous values for:\n' +
+                             str(qc_json) +
+                             '\nthis file have\n' +
+                             str(flowcell[valueToCheck]) +
+                             '\nand previous have\n' +
+                             str(previous[valueToCheck]))
+
+
+def addToFlowcells(multiFCjson: dict, qc_json: str, raw_qc: dict) -> str:
+    """Add a sample to the flowcell jsons, creating its flowcell if it is the first sample of it
+
+    :param multiFCjson: flowcell jsons keyed by <flowcellID>-<lab_id>, updated in place
+    :type multiFCjson: dict
+    :param qc_json: path of the sample json, used in error messages
+    :type qc_json: str
+    :param raw_qc: dictionary of the sample json
+    :type raw_qc: dict
+    :raises SystemExit: if the sample disagrees with earlier samples of its flowcell
+    :raises MissingFieldsError: listing all fields missing from the json
+    :return: key of the flowcell of the sample
+    :rtype: str
+    """
+    flowcellkey, flowcell, sample, checklist = flowcellParts(qc_json, raw_qc)
+
+    # Inputting values for flowcell in directory
+    # Check if flowcell exists in multiFCjson, else create the keys for it
+    if flowcellkey not in multiFCjson:
+        multiFCjson[flowcellkey] = dict(flowcell, samples=[])
+    else:
+        checkFlowcell(multiFCjson[flowcellkey], flowcell, checklist, qc_json)
 
+    # Append sample specific values to flowcell json
+    multiFCjson[flowcellkey]["samples"].append(sample)
+    return flowcellkey
 
-def reshapeToFlowcellJsons(jsonlist: list) -> dict:
+
+def reshapeToFlowcellJsons(jsonlist: list, documents: QCDocuments = None) -> dict:
     """Reshape a list of jsonpaths to a dictionary reshaped and sorted into flowcells
 
     :param jsonlist: list of jsonpaths
     :type jsonlist: list
-    :raises SystemExit: _description_
-    :return: jsons reshaped and sorted into flowcells
+    :param documents: parsed document cache shared with later stages of the run. Files are parsed
+        without caching if not given
+    :type documents: QCDocuments
+    :raises SystemExit: if a sample disagrees with earlier samples of its flowcell
+    :raises MissingFieldsError: listing all fields missing from a json
+    :return: jsons reshaped and sorted into flowcells, keyed by <flowcellID>-<lab_id>
     :rtype: dict
     """
     # Opening jsons from list one by one and creating a big dict with specific
     # keys from all
+    if documents is None:
+        documents = QCDocuments(maxbytes=0)
     multiFCjson = {}
     for sample in range(len(jsonlist)):
         qc_json = jsonlist[sample][0]  # filepath is first value in list
-        # fileCheck = jsonlist[sample][1] # pass/fail check is second value in
-        # list
-
         # Getting summary.json qc parameter values
-        with open(qc_json, "r") as src:
-            raw_qc = json.load(src)
-
-        # shortcuts
-        er = raw_qc["metadata"]["experiment_run"]
-        es = er["experiment_samples"][0]
-
-        flowcell_id = er["flowcell_id"][0]
-
-        # Check if date or datetime:
-        if len(str(er["start_time"][0])) > 10:
-            dateformat = "dateTime"
-        elif len(str(er["start_time"][0])) <= 10:
-            dateformat = "date"
-
-        # Inputting values for flowcell in directory
-        # Check if flowcell_id exists in multiFCjson, else create the keys for
-        # it
-        if flowcell_id not in multiFCjson.keys():
-
-            # Create new values for flowcell
-            # Making dict with either date or datetime, depending on what is
-            # given
-            if dateformat == "date":
-                multiFCjson[flowcell_id + '-' + er['lab_id'][0]] = {
-                    "flowcellID": er["flowcell_id"][0],
-                    "flowcellNr": er["run_number"][0],
-                    "machineSerialNr": er["instrument_serial_nr"][0],
-                    "seqRunID": er["run_id"][0],
-                    "seqRunDate": er["start_time"][0],
-                    "samples": []
-                }
-            elif dateformat == "dateTime":
-                multiFCjson[flowcell_id + '-' + er['lab_id'][0]] = {
-                    "flowcellID": er["flowcell_id"][0],
-                    "flowcellNr": er["run_number"][0],
-                    "machineSerialNr": er["instrument_serial_nr"][0],
-                    "seqRunID": er["run_id"][0],
-                    # "seqRunDatetime" : er["start_time"][0], TEST
-                    "seqRunDate": er["start_time"][0][:10],
-                    "samples": []
-                }
+        addToFlowcells(multiFCjson, qc_json, documents.get(qc_json))
 
-        else:
+    return multiFCjson
 
-            # Check for equal values in already loaded flowcell and new
-            # flowcell
-
-            # string conversions [new_json,old_json]
-            fCstr = ["flowcellID", "flowcell_id"]
-            fIDstr = ["flowcellNr", "run_number"]
-            sRID = ["seqRunID", "run_id"]
-            dateID = ["seqRunDate", "start_time"]
-            dateTimeID = ["seqRunDatetime", "start_time"]  #For possible future use
-
-            # commented out as TEST, currently cant check because datetime is
-            # not working at backend
-            if dateformat == "dateTime":
-                checklist = [fCstr, fIDstr, sRID]  # dateTimeID
-            elif dateformat == "date":
-                checklist = [fCstr, fIDstr, sRID, dateID]
-
-            for valueToCheck in checklist:
-                if multiFCjson[flowcell_id + '-' + er['lab_id']
-                               [0]][valueToCheck[0]] != er[valueToCheck[1]][0]:
-                    raise SystemExit(f'{valueToCheck[0]} does not match previous values for:\n' +
-                                     qc_json +
-                                     '\nthis file have\n' +
-                                     er[valueToCheck[1]][0] +
-                                     '\nand previous have\n' +
-                                     multiFCjson[flowcell_id + '-' + er['lab_id'][0]][valueToCheck[0]])
-
-        # Find sample specific values and append to dict
-        samplesubdict = {
-            "ngcSubjectID": es["ngc_subject_id"],
-            "sampleID": es["sample_id"],
-            "sampleName": es["sample_name"],
-            "subjectID": es["subject_id"],
-            "registrationIDs": [
-                es["registration_id"]
-            ]
-        }
-
-        # Append sample specific values to flowcell json
-        multiFCjson[flowcell_id + '-' + er['lab_id']
-                    [0]]["samples"].append(samplesubdict)
 
-    return multiFCjson
+def streamFlowcellJsons(rows, expected: dict, documents: QCDocuments = None):
+    """Reshape csv rows into flowcell jsons as they are read. Each flowcell is handed out as soon as all
+    its rows are read, followed by the rows of its samples, so only unfinished flowcells are kept.
+    A flowcell whose samples disagree is not handed out and none of its rows are handed out as samples.
+    They are handed out as mismatches instead, so the rest of the list can still be sent
+
+    :param rows: rows of a json path csv, e.g. from json_list.readJsonList
+    :type rows: Iterable[JsonRow]
+    :param expected: number of rows per json_list.flowcellGroup, from json_list.countFlowcellRows
+    :type expected: dict
+    :param documents: parsed document cache shared with later stages of the run
+    :type documents: QCDocuments
+    :raises MissingFieldsError: listing all fields missing from a json
+    :return: ('flowcell', <flowcellID>-<lab_id>, flowcell json), ('sample', row, flowcell key) in send order
+        and ('mismatch', row, problem) for the rows of flowcells whose samples disagree
+    :rtype: Iterator[tuple]
+    """
+    if documents is None:
+        documents = QCDocuments(maxbytes=0)
+    building = {}
+    remaining = dict(expected)
+    keygroups = {}
+    groupkeys = {}
+    # Rows read but not handed out yet, per group, as (row, flowcell key)
+    held = {}
+    sent = set()
+    # Problem of each flowcell whose samples disagree
+    mismatched = {}
+
+    def release(groups, force=False):
+        out = []
+        for group in groups:
+            for key in sorted(groupkeys.get(group, ())):
+                if key in building and (force or all(remaining[g] <= 0 for g in keygroups[key])):
+                    if key in sent:
+                        log.warning("Flowcell %s has samples after it was handed out, they are sent as "
+                                    "another registration", key)
+                    sent.add(key)
+                    out.append(("flowcell", key, building.pop(key)))
+            waiting = []
+            for row, key in held.pop(group, ()):
+                if key in mismatched:
+                    out.append(("mismatch", row, mismatched[key]))
+                elif key in building:
+                    waiting.append((row, key))
+                else:
+                    out.append(("sample", row, key))
+            if waiting:
+                held[group] = waiting
+        return out
+
+    for row in rows:
+        group = flowcellGroup(row)
+        key, flowcell, sample, checklist = flowcellParts(row[0], documents.get(row[0]))
+        if key in building:
+            try:
+                checkFlowcell(building[key], flowcell, checklist, row[0])
+            except SystemExit as e:
+                # Held back with all its rows, as validate_qc does
+                mismatched[key] = "flowcell {} has samples that disagree: {}".format(
+                    key, " ".join(str(e).split("\n")))
+                del building[key]
+        elif key not in mismatched:
+            building[key] = dict(flowcell, samples=[])
+        if key in building:
+            building[key]["samples"].append(sample)
+        keygroups.setdefault(key, set()).add(group)
+        groupkeys.setdefault(group, set()).add(key)
+        held.setdefault(group, []).append((row, key))
+        # Groups missing from expected are handed out row by row
+        remaining[group] = remaining.get(group, 1) - 1
+        if remaining[group] <= 0:
+            yield from release(list(keygroups[key]))
+
+    # Rows counted but never read, e.g. the csv changed in between
+    yield from release(list(held), force=True)
 
 
 def saveFlowcellJsons(flowcelljson: dict, flowcellid: str,
@@ -147,51 +263,25 @@ def saveFlowcellJsons(flowcelljson: dict, flowcellid: str,
 
 
 def sendFlowcells(flowcelljson: dict, facilityName: str,
-                  usrname: str, pw: str) -> None:
+                  client: AeroClient) -> None:
     """Send flowcells to the Aero API
 
     :param flowcelljson: flowcell dictionary
     :type flowcelljson: dict
     :param facilityName: such as wgs-west or wgs-east
     :type facilityName: str
-    :param usrname: FreeIPA username
-    :type usrname: str
-    :param pw: FreeIPA password
-    :type pw: str
+    :param client: shared Aero API client
+    :type client: AeroClient
     """
 
-    keycloackurl = 'https://keycloak.dev.ngc.dk/auth/realms/Ngc/protocol/openid-connect/token'
-    header = {'Content-Type': 'application/x-www-form-urlencoded'}
-    cert = '/usr/local/share/ca-certificates/CA-NGC.pem'
-
-    tokenjson = requests.post(keycloackurl, headers=header, verify=cert, data={'username': usrname,
-                                                                               'password': pw,
-                                                                               'scope': 'profile',
-                                                                               'grant_type': 'password',
-                                                                               'client_id': 'sqs-web'
-                                                                               })
-
-    keycloaktoken = tokenjson.json()['access_token']
-
-    # Show sent json:
-    sys.stdout.write('\nSENT:\n')
-    json.dump(flowcelljson, sys.stdout, separators=(",", ":"), indent=2)
-
     # Send json as request to AeroAPI
-    r = requests.post(
-        'https://aero-hpc.dev.ngc.dk/wgs-facilities/' +
-        facilityName +
-        '/qc/flowcells',
-        json=flowcelljson,
-        verify='/usr/local/share/ca-certificates/CA-NGC.pem',
-        headers={
-            'Authorization': 'Bearer {}'.format(keycloaktoken)})
-
-    # Print recieved info:
-    sys.stdout.write('\nRECIEVED:\nStatus code: ' + str(r.status_code) + '\n')
-    sys.stdout.write('Trace ID: ' + r.headers.get('Trace-ID'))
-    sys.stdout.write('JSON:\n')
-    json.dump(r.json(), sys.stdout, indent=2)
+    r = client.post(
+        client.facilityURL(facilityName) + '/qc/flowcells',
+        json=flowcelljson)
+
+    # Log the call, bodies only at debug level or on errors
+    logExchange(log, r)
+    r.raise_for_status()
 
 
 if __name__ == "__main__":
@@ -217,30 +307,28 @@ if __name__ == "__main__":
         help="FreeIPA password")
     args = parser.parse_args()
 
-    with args.qc_list_input.open("r") as src:
-        jsonpaths = pd.read_csv(src)
-        jsonpaths_list = jsonpaths.values.tolist()
-        multijson = reshapeToFlowcellJsons(jsonpaths_list)
-
-    # Handle results
+    # Handle results, each flowcell as soon as all its samples are read
     rh = args.resulthandling
-
-    if rh == "send":
-        for flowcellid in multijson.keys():
-            # Getting facility name for api URL
-            er = multijson[flowcellid]["metadata"]["experiment_run"]
-            facilityName = er["lab_id"][0]
-            # Testing for '_test' suffix in id string:
-            if "_test" in facilityName:
-                size = len(facilityName)
-                facilityName = facilityName[: size - 5]
-            facilityName = facilityName.replace("_", "-")
+    client = AeroClient(args.username, args.pw) if rh == "send" else None
+    events = streamFlowcellJsons(readJsonList(args.qc_list_input), countFlowcellRows(args.qc_list_input))
+    mismatches = []
+    for event, item, value in events:
+        if event == "mismatch":
+            # item is the row and value the problem of its flowcell
+            mismatches.append("{}: {}".format(item.path, value))
+            continue
+        if event != "flowcell":
+            continue
+        flowcellid, flowcelljson = item, value
+        if client is not None:
+            # Getting facility name for api URL. Keys are <flowcellID>-<lab_id>
+            facilityName = facilityNameFromLabID(flowcellid.split("-", 1)[1])
 
             sendFlowcells(
-                multijson[flowcellid],
+                flowcelljson,
                 facilityName,
-                args.username,
-                args.pw)
-    else:
-        for flowcellid in multijson.keys():
-            saveFlowcellJsons(multijson[flowcellid], flowcellid, rh)
+                client)
+        else:
+            saveFlowcellJsons(flowcelljson, flowcellid, rh)
+    if mismatches:
+        raise SystemExit('{} samples held back:\n'.format(len(mismatches)) + '\n'.join(mismatches))
@@ -4,12 +4,202 @@ HTTP POST idsnp-check payloads.
 """
 
 import argparse
+import csv
+import functools
 import json
+import logging
 import sys
 from pathlib import Path
 from typing import cast
 
-import requests
+from aero_client import AeroClient
+from call_log import logExchange
+from field_mapping import Field, compileSpec
+from qc_documents import extractQC
+
+log = logging.getLogger(__name__)
+
+# Parts of summary.json used by reshape
+IDSNPPATHS = (
+    ("metadata", "experiment_run", "experiment_samples", 0),
+    ("all_idsnp_comparisons",),
+)
+
+
+# Bases counted per site, in payload order
+BASES = ("A", "T", "G", "C", "N", "gap")
+# Columns of IdsnpSites.rows
+ROWCOLUMNS = ("rsID", "loc") + tuple("query." + base for base in BASES) + \
+    tuple("target." + base for base in BASES)
+
+
+def _column(sites: list, key: str) -> list:
+    # First value of key in every site
+    return [v[key][0] for v in sites]
+
+
+class IdsnpSites:
+    """Per-site base counts of an idsnp comparison, stored column-wise: one list per base for the
+    query (diagnostic) sample and one per base for the target (IDSNP) sample, aligned with rsIDs
+
+    :param rsIDs: site IDs
+    :type rsIDs: list
+    :param locs: site locations without the chr prefix
+    :type locs: list
+    :param query: {base: counts} of the diagnostic sample
+    :type query: dict
+    :param target: {base: counts} of the IDSNP sample
+    :type target: dict
+    """
+
+    def __init__(self, rsIDs: list, locs: list, query: dict, target: dict):
+        self.rsIDs = rsIDs
+        self.locs = locs
+        self.query = query
+        self.target = target
+
+    @classmethod
+    def fromComparisons(cls, qc_idsnp: dict) -> "IdsnpSites":
+        """Load the single comparison in all_idsnp_comparisons of a qc json
+
+        :param qc_idsnp: all_idsnp_comparisons of a qc json
+        :type qc_idsnp: dict
+        :rtype: IdsnpSites
+        """
+        # Sanity checks and shortcuts.
+        assert len(qc_idsnp) == 1
+        dets = list(qc_idsnp.values())[0]["details"]
+        assert len(dets["all"]) == (
+            len(dets["invalid"]) + len(dets["mismatches"]) + len(dets["matches"])
+        )
+
+        # Gather per-site counts, one column at a time
+        sites = list(dets["all"].values())
+        return cls(
+            list(dets["all"]),
+            [v["position"][0].strip("chr") for v in sites],
+            {base: _column(sites, "query." + base + ".count") for base in BASES},
+            {base: _column(sites, "target." + base + ".count") for base in BASES},
+        )
+
+    def __len__(self) -> int:
+        return len(self.rsIDs)
+
+    def details(self) -> list:
+        """details list of the idsnp-check payload
+
+        :rtype: list
+        """
+        q, t = self.query, self.target
+        return [{"rsID": rsID,
+                 "loc": loc,
+                 "diagnosticSample": {"baseCounts": {"A": qA, "T": qT, "G": qG, "C": qC, "N": qN, "gap": qgap}},
+                 "IDSNPSample": {"baseCounts": {"A": tA, "T": tT, "G": tG, "C": tC, "N": tN, "gap": tgap}}}
+                for rsID, loc, qA, qT, qG, qC, qN, qgap, tA, tT, tG, tC, tN, tgap in zip(
+                    self.rsIDs, self.locs,
+                    q["A"], q["T"], q["G"], q["C"], q["N"], q["gap"],
+                    t["A"], t["T"], t["G"], t["C"], t["N"], t["gap"])]
+
+    def rows(self):
+        """One tuple per site with the values of ROWCOLUMNS, for bulk export
+
+        :rtype: Iterator[tuple]
+        """
+        return zip(self.rsIDs, self.locs,
+                   *(self.query[base] for base in BASES),
+                   *(self.target[base] for base in BASES))
+
+    def dumps(self, indent: int = None, separators: tuple = None, level: int = 0,
+              sort_keys: bool = False) -> str:
+        """JSON text of details(), written straight from the columns. Same text as json.dumps of
+        details() with the same indent, separators and sort_keys, nested level containers deep
+
+        :param indent: as for json.dumps
+        :type indent: int
+        :param separators: as for json.dumps
+        :type separators: tuple
+        :param level: nesting depth of the list in the dumped document
+        :type level: int
+        :param sort_keys: as for json.dumps
+        :type sort_keys: bool
+        :rtype: str
+        """
+        if not self.rsIDs:
+            return "[]"
+        itemsep = (separators or ((", ", ": ") if indent is None else (",", ": ")))[0]
+        if indent is not None:
+            itemsep += "\n" + " " * (indent * (level + 1))
+        columns = [_encode(self.rsIDs), _encode(self.locs)] + \
+            [_encode(self.query[base]) for base in BASES] + \
+            [_encode(self.target[base]) for base in BASES]
+        items = itemsep.join(map(_siteTemplate(indent, separators, level + 1, sort_keys).format, *columns))
+        if indent is None:
+            return "[" + items + "]"
+        return "[\n" + " " * (indent * (level + 1)) + items + "\n" + " " * (indent * level) + "]"
+
+
+def _encode(column: list) -> list:
+    # JSON text of every value in column
+    if all(type(x) is int for x in column):
+        return list(map(int.__repr__, column))
+    if all(type(x) is str for x in column):
+        return list(map(json.encoder.encode_basestring_ascii, column))
+    return [json.dumps(x) for x in column]
+
+
+@functools.lru_cache(maxsize=None)
+def _siteTemplate(indent: int, separators: tuple, level: int, sort_keys: bool = False) -> str:
+    # json.dumps of one site with {0}..{13} in place of the ROWCOLUMNS values
+    placeholders = ["\x00{}\x00".format(i) for i in range(len(ROWCOLUMNS))]
+    q = dict(zip(BASES, placeholders[2:8]))
+    t = dict(zip(BASES, placeholders[8:]))
+    site = {"rsID": placeholders[0],
+            "loc": placeholders[1],
+            "diagnosticSample": {"baseCounts": q},
+            "IDSNPSample": {"baseCounts": t}}
+    text = json.dumps(site, indent=indent, separators=separators, sort_keys=sort_keys)
+    text = text.replace("{", "{{").replace("}", "}}")
+    for i, placeholder in enumerate(placeholders):
+        text = text.replace(json.dumps(placeholder), "{" + str(i) + "}")
+    if indent is not None:
+        text = text.replace("\n", "\n" + " " * (indent * level))
+    return text
+
+
+def dumpsPayload(payload: dict, indent: int = None, separators: tuple = None,
+                 sort_keys: bool = False) -> str:
+    """JSON text of an idsnp-check payload, same as json.dumps with the same indent, separators and sort_keys.
+    details may be an IdsnpSites, which is written straight from its columns
+
+    :param payload: idsnp-check payload
+    :type payload: dict
+    :param indent: as for json.dumps
+    :type indent: int
+    :param separators: as for json.dumps
+    :type separators: tuple
+    :param sort_keys: as for json.dumps
+    :type sort_keys: bool
+    :rtype: str
+    """
+    sites = payload["details"]
+    keys = sorted(payload) if sort_keys else list(payload)
+    if not isinstance(sites, IdsnpSites) or keys[-1] != "details":
+        if isinstance(sites, IdsnpSites):
+            payload = dict(payload, details=sites.details())
+        return json.dumps(payload, indent=indent, separators=separators, sort_keys=sort_keys)
+    # details is the last key, so its placeholder is the last null in the text
+    text = json.dumps(dict(payload, details=None), indent=indent, separators=separators,
+                      sort_keys=sort_keys)
+    head, null, tail = text.rpartition("null")
+    return head + sites.dumps(indent, separators, level=1, sort_keys=sort_keys) + tail
+
+
+# details is left as IdsnpSites. reshape turns it into the payload list, dumpsPayload writes it as JSON
+IDSNPSPEC = {
+    "IDSNPSampleName": Field(("es", "idsnp_sample_name")),
+    "details": Field(("idsnp",), convert=IdsnpSites.fromComparisons),
+}
+_IDSNP = compileSpec(IDSNPSPEC)
 
 
 def reshape(raw_qc: dict) -> dict:
@@ -17,104 +207,45 @@ def reshape(raw_qc: dict) -> dict:
 
     :param raw_qc: dictioany of qc json
     :type raw_qc: dict
+    :raises MissingFieldsError: listing all fields missing from raw_qc
     :return: reshaped dict that fits the idsnp-check format of the Aero API
     :rtype: dict
     """
-
-    # Sanity checks and shortcuts.
-    es = raw_qc["metadata"]["experiment_run"]["experiment_samples"][0]
-    qc_idsnp = raw_qc["all_idsnp_comparisons"]
-    assert len(qc_idsnp) == 1
-    dets = list(qc_idsnp.values())[0]["details"]
-    assert len(dets["all"]) == (
-        len(dets["invalid"]) + len(dets["mismatches"]) + len(dets["matches"])
-    )
-
-    # Gather per-site counts.
-    sites = {}
-    for k, v in dets["all"].items():
-        assert k not in sites
-        sites[k] = {
-            "loc": v["position"][0].strip("chr"),
-            "diagnosticSample": {
-                "baseCounts": {
-                    "A": v["query.A.count"][0],
-                    "T": v["query.T.count"][0],
-                    "G": v["query.G.count"][0],
-                    "C": v["query.C.count"][0],
-                    "N": v["query.N.count"][0],
-                    "gap": v["query.gap.count"][0],
-                },
-            },
-            "IDSNPSample": {
-                "baseCounts": {
-                    "A": v["target.A.count"][0],
-                    "T": v["target.T.count"][0],
-                    "G": v["target.G.count"][0],
-                    "C": v["target.C.count"][0],
-                    "N": v["target.N.count"][0],
-                    "gap": v["target.gap.count"][0],
-                },
-            }
-        }
-
-    payload = {
-        "IDSNPSampleName": es["idsnp_sample_name"],
-        "details": [{"rsID": k, **v} for k, v in sites.items()],
-    }
-
+    payload = _IDSNP(raw_qc)
+    payload["details"] = payload["details"].details()
     return payload
 
 
 def sendIdsnp(idsnpjson: dict, facilityName: str,
-                 analysispermID: str, usrname: str, pw: str) -> None:
+                 analysispermID: str, client: AeroClient) -> dict:
     """Send idsnp-checks to Aero API
 
-    :param idsnpjson: _description_
+    :param idsnpjson: idsnp-check payload. details may be an IdsnpSites
     :type idsnpjson: dict
     :param facilityName: _description_
     :type facilityName: str
     :param analysispermID: _description_
     :type analysispermID: str
-    :param usrname: FreeIPA username
-    :type usrname: str
-    :param pw: FreeIPA password
-    :type pw: str
+    :param client: shared Aero API client
+    :type client: AeroClient
+    :return: response json
+    :rtype: dict
     """
 
-    keycloackurl = 'https://keycloak.dev.ngc.dk/auth/realms/Ngc/protocol/openid-connect/token'
-    header = {'Content-Type': 'application/x-www-form-urlencoded'}
-    cert = '/usr/local/share/ca-certificates/CA-NGC.pem'
-
-    tokenjson = requests.post(keycloackurl, headers=header, verify=cert, data={'username': usrname,
-                                                                               'password': pw,
-                                                                               'scope': 'profile',
-                                                                               'grant_type': 'password',
-                                                                               'client_id': 'sqs-web'
-                                                                               })
-    keycloaktoken = tokenjson.json()['access_token']
-
-    # Show sent json:
-    sys.stdout.write('\nSENT:\n')
-    json.dump(idsnpjson, sys.stdout, separators=(",", ":"), indent=2)
-
     # Send json as request to AeroAPI
-    r = requests.post(
-        'https://aero-hpc.dev.ngc.dk/wgs-facilities/' +
-        facilityName +
+    r = client.post(
+        client.facilityURL(facilityName) +
         '/qc/analyses/' +
         analysispermID +
         '/id-snp-checks',
-        json=idsnpjson,
-        verify='/usr/local/share/ca-certificates/CA-NGC.pem',
-        headers={
-            'Authorization': 'Bearer {}'.format(keycloaktoken)})
+        data=dumpsPayload(idsnpjson, separators=(",", ":")).encode('utf-8'),
+        headers={'Content-Type': 'application/json'})
+
+    # Log the call, bodies only at debug level or on errors
+    logExchange(log, r)
+    r.raise_for_status()
 
-    # Print recieved info:
-    sys.stdout.write('\nRECIEVED:\nStatus code: ' + str(r.status_code) + '\n')
-    sys.stdout.write('Trace ID: ' + r.headers.get('Trace-ID'))
-    sys.stdout.write('JSON:\n')
-    json.dump(r.json(), sys.stdout, indent=2)
+    return r.json()
 
 
 if __name__ == "__main__":
@@ -127,11 +258,17 @@ if __name__ == "__main__":
         epilog=usage[1],
     )
     parser.add_argument("qc_input", type=Path, help="Path to input QC JSON")
+    parser.add_argument("--rows", action="store_true",
+                        help="Write per-site counts as tab separated rows instead of the payload")
 
     args = parser.parse_args()
 
-    with args.qc_input.open("r") as src:
-        qc_payload = json.load(src)
-        reshaped = reshape(qc_payload)
+    qc_payload = extractQC(args.qc_input, IDSNPPATHS)
+    if args.rows:
+        writer = csv.writer(sys.stdout, delimiter="\t", lineterminator="\n")
+        writer.writerow(ROWCOLUMNS)
+        writer.writerows(IdsnpSites.fromComparisons(qc_payload["all_idsnp_comparisons"]).rows())
+        sys.exit(0)
+    reshaped = reshape(qc_payload)
 
     json.dump(reshaped, sys.stdout, sort_keys=True, separators=(",", ":"))
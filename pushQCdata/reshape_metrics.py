@@ -4,12 +4,191 @@ HTTP POST metrics payloads.
 """
 import argparse
 import json
+import logging
+import re
 import sys
+import warnings
 from decimal import Decimal
 from pathlib import Path
 from typing import Callable
 
-import requests
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from aero_client import AeroClient
+from call_log import logExchange
+from field_mapping import Check, Field, compileSpec
+from qc_documents import extractQC
+
+log = logging.getLogger(__name__)
+
+# Parts of summary.json used by reshape
+METRICSPATHS = (
+    ("metadata", "experiment_run"),
+    ("germline_full", "metrics", "samples", 0, "QC_summary"),
+    ("all_idsnp_comparisons",),
+)
+
+# Plain decimal numbers such as 0.9312 or -1.5e-05
+_DECIMAL = re.compile(r"\s*([+-]?)(\d*)(?:\.(\d*))?(?:[eE]([+-]?\d+))?\s*$")
+# Decimal keeps 28 significant digits, up to that the exact integer path gives the same results
+_MAXDIGITS = 28
+
+
+def _scaled(x, power: int) -> tuple:
+    """Exact value of str(x) * 10**power as (negative, numerator, denominator).
+    None if str(x) is not a plain decimal number, so the caller can fall back to Decimal
+    """
+    m = _DECIMAL.match(str(x))
+    if m is None:
+        return None
+    sign, intpart, fracpart, exp = m.groups()
+    fracpart = fracpart or ""
+    digits = intpart + fracpart
+    if not digits or len(digits) > _MAXDIGITS:
+        return None
+    e = int(exp or 0) - len(fracpart) + power
+    if not -330 < e < 300:
+        return None
+    if e >= 0:
+        return sign == "-", int(digits) * 10 ** e, 1
+    return sign == "-", int(digits), 10 ** -e
+
+
+def adj_pct_float(x) -> float:
+    """Fraction to percent, same result as float(Decimal(str(x)) * 100)"""
+    scaled = _scaled(x, 2)
+    if scaled is None:
+        return float(Decimal(str(x)) * 100)
+    negative, num, den = scaled
+    # int / int is correctly rounded, like the Decimal to float conversion, but raises where that gives inf
+    try:
+        value = num / den
+    except OverflowError:
+        return float(Decimal(str(x)) * 100)
+    return -value if negative else value
+
+
+def adj_m_float(x) -> int:
+    """Millions to count, same result as int(Decimal(str(x)) * 1000000)"""
+    scaled = _scaled(x, 6)
+    if scaled is None:
+        return int(Decimal(str(x)) * 1000000)
+    negative, num, den = scaled
+    value = num // den
+    return -value if negative else value
+
+
+def parseList(dps: str, func: Callable, sep: str = ";") -> list:
+    """Convert a separated string of numbers with func (int or float) in one batch
+
+    :param dps: separated numbers, e.g. "1;2;3"
+    :type dps: str
+    :param func: int or float
+    :type func: Callable
+    :param sep: separator
+    :type sep: str
+    :rtype: list
+    """
+    if np is not None and func in (int, float):
+        # Depending on the numpy version a bad item either raises or stops the
+        # parsing early, which shows as a length mismatch. Both are left to the
+        # plain conversion below to report
+        try:
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore", DeprecationWarning)
+                arr = np.fromstring(dps, dtype=np.int64 if func is int else np.float64, sep=sep)
+        except ValueError:
+            arr = None
+        if arr is not None and len(arr) == dps.count(sep) + 1:
+            # Integers outside int64 saturate to its limits instead of raising, so lists
+            # reaching a limit are converted item by item to keep Python's unbounded ints
+            limits = np.iinfo(np.int64)
+            if func is not int or not (arr.size and (arr.max() == limits.max or arr.min() == limits.min)):
+                return arr.tolist()
+    return list(map(func, dps.split(sep)))
+
+
+def to_array(
+    x_dps: str,
+    x_func: Callable,
+    y_dps: str,
+    y_func: Callable,
+    sep: str = ";",
+) -> dict:
+    """Histogram dict from separated strings of x values and y values"""
+    x_conv = parseList(x_dps, x_func, sep)
+    y_conv = parseList(y_dps, y_func, sep)
+    assert len(x_conv) == len(y_conv), (
+        "Unequal number of items in X-axis and Y-axis:"
+        f" {len(x_conv)} vs {len(y_conv)}"
+    )
+    return dict(zip(x_conv, y_conv))
+
+
+def histogram(x_func: Callable, y_func: Callable) -> Callable:
+    """Converter for a Field of two paths (x values, y values) into a histogram dict"""
+    return lambda x_dps, y_dps: to_array(x_dps, x_func, y_dps, y_func)
+
+
+def _qc(name: str, convert: Callable) -> Field:
+    return Field(("qcs", name), convert=convert)
+
+
+METRICSSPEC = {
+    "sampleLevel": {
+        "labels": {
+            "seqRunID": Field(("er", "run_id", 0)),
+            "readType": Field(("er", "read_type", 0)),
+            "pipelineID": Field(("es", "flow_id")),
+            "flowcellID": Field(("er", "flowcell_id", 0)),
+            "flowcellType": Field(("er", "flowcell_type", 0)),
+            "libraryID": Field(("es", "library_id")),
+            "registrationID": Field(("es", "registration_id")),
+            "labID": Field(("es", "lab_id")),
+            "subjectID": Field(("es", "subject_id")),
+            "ngcSubjectID": Field(("es", "ngc_subject_id")),
+            "protocolID": Field(("es", "protocol_id")),
+            "sampleID": Field(("es", "registered_sample_id")),
+            "sampleName": Field(("es", "sample_name")),
+        },
+        "qcValues": {
+            "pctDuplicates": _qc("pct_duplicates", adj_pct_float),
+            "pctQ30": _qc("pct_q30", adj_pct_float),
+            "medianInsertSize": _qc("median_insert_size", int),
+            "nReadsMapped": _qc("m_reads_mapped", adj_m_float),
+            "meanCov": _qc("mean_coverage", float),
+            "sdCov": _qc("sd_coverage", float),
+            "pctCov10x": _qc("pct_10x", adj_pct_float),
+            "pctCov20x": _qc("pct_20x", adj_pct_float),
+            "pctCov30x": _qc("pct_30x", adj_pct_float),
+            "nSNPsAll": _qc("M_nSNPs_all", adj_m_float),
+            "pctSNPsKnown": _qc("pct_SNPs_known", adj_pct_float),
+            "pctSNPsNovel": _qc("pct_SNPs_novel", adj_pct_float),
+            "ratioTiTvAll": _qc("tiTvRatio_all", float),
+            "ratioTiTvKnown": _qc("tiTvRatio_known", float),
+            "ratioTiTvNovel": _qc("tiTvRatio_novel", float),
+            "ratioHetHomAll": _qc("hetHomRatio_all", float),
+            "ratioHetHomKnown": _qc("hetHomRatio_known", float),
+            "ratioHetHomNovel": _qc("hetHomRatio_novel", float),
+            "pctMskRegions": _qc("msk_pct_regions", float),
+            "pctMskHomozygousSites": _qc("msk_pct_homozygous_sites", float),
+            "meanPctMskMinorAllele": _qc("msk_meanpct_minorallele", adj_pct_float),
+            "insertSize": Field(("qcs", "insert_size_value"),
+                                ("qcs", "insert_size_frequency"),
+                                convert=histogram(int, int)),
+            "altFreqAll": Field(("qcs", "alt_freq_all_value"),
+                                ("qcs", "alt_freq_all_frequency"),
+                                convert=histogram(float, int)),
+        },
+    },
+    # Metrics are only sent for samples with exactly one idsnp comparison
+    "oneIdsnpComparison": Check(("idsnp",), test=lambda qc_idsnp: len(qc_idsnp) == 1,
+                                message="all_idsnp_comparisons must hold exactly one comparison"),
+}
+_METRICS = compileSpec(METRICSSPEC)
 
 
 def reshape(raw_qc: dict) -> dict:
@@ -17,98 +196,15 @@ def reshape(raw_qc: dict) -> dict:
 
     :param raw_qc: dictioany of qc json
     :type raw_qc: dict
+    :raises MissingFieldsError: listing all fields missing from raw_qc
     :return: reshaped dict that fits the metrics format of the Aero API
     :rtype: dict
     """
-    # shortcuts
-    er = raw_qc["metadata"]["experiment_run"]
-    es = er["experiment_samples"][0]
-
-    qcs = raw_qc["germline_full"]["metrics"]["samples"][0]["QC_summary"]
-    qc_idsnp = raw_qc["all_idsnp_comparisons"]
-
-    assert len(qc_idsnp) == 1
-
-    def adj_pct_float(x): return float(Decimal(str(x)) * 100)
-    def adj_m_float(x): return int(Decimal(str(x)) * 1000000)
-
-    def to_array(
-        x_dps: str,
-        x_func: Callable,
-        y_dps: str,
-        y_func: Callable,
-        sep: str = ";",
-    ) -> dict:
-        x_split = x_dps.split(sep)
-        y_split = y_dps.split(sep)
-        x_conv = [x_func(i) for i in x_split]
-        y_conv = [y_func(i) for i in y_split]
-        assert len(x_conv) == len(y_conv), (
-            "Unequal number of items in X-axis and Y-axis:"
-            f" {len(x_conv)} vs {len(y_conv)}"
-        )
-        return dict(zip(x_conv, y_conv))
-
-    payload = {
-        "sampleLevel": {
-            "labels": {
-                "seqRunID": er["run_id"][0],
-                "readType": er["read_type"][0],
-                "pipelineID": es["flow_id"],
-                "flowcellID": er["flowcell_id"][0],
-                "flowcellType": er["flowcell_type"][0],
-                "libraryID": es["library_id"],
-                "registrationID": es["registration_id"],
-                "labID": es["lab_id"],
-                "subjectID": es["subject_id"],
-                "ngcSubjectID": es["ngc_subject_id"],
-                "protocolID": es["protocol_id"],
-                "sampleID": es["registered_sample_id"],
-                "sampleName": es["sample_name"],
-            },
-            "qcValues": {
-                "pctDuplicates": adj_pct_float(qcs["pct_duplicates"]),
-                "pctQ30": adj_pct_float(qcs["pct_q30"]),
-                "medianInsertSize": int(qcs["median_insert_size"]),
-                "nReadsMapped": adj_m_float(qcs["m_reads_mapped"]),
-                "meanCov": float(qcs["mean_coverage"]),
-                "sdCov": float(qcs["sd_coverage"]),
-                "pctCov10x": adj_pct_float(qcs["pct_10x"]),
-                "pctCov20x": adj_pct_float(qcs["pct_20x"]),
-                "pctCov30x": adj_pct_float(qcs["pct_30x"]),
-                "nSNPsAll": adj_m_float(qcs["M_nSNPs_all"]),
-                "pctSNPsKnown": adj_pct_float(qcs["pct_SNPs_known"]),
-                "pctSNPsNovel": adj_pct_float(qcs["pct_SNPs_novel"]),
-                "ratioTiTvAll": float(qcs["tiTvRatio_all"]),
-                "ratioTiTvKnown": float(qcs["tiTvRatio_known"]),
-                "ratioTiTvNovel": float(qcs["tiTvRatio_novel"]),
-                "ratioHetHomAll": float(qcs["hetHomRatio_all"]),
-                "ratioHetHomKnown": float(qcs["hetHomRatio_known"]),
-                "ratioHetHomNovel": float(qcs["hetHomRatio_novel"]),
-                "pctMskRegions": float(qcs["msk_pct_regions"]),
-                "pctMskHomozygousSites": float(qcs["msk_pct_homozygous_sites"]),
-                "meanPctMskMinorAllele": adj_pct_float(qcs["msk_meanpct_minorallele"]),
-                "insertSize": to_array(
-                    qcs["insert_size_value"],
-                    lambda x: int(x),
-                    qcs["insert_size_frequency"],
-                    lambda y: int(y),
-                ),
-                "altFreqAll": to_array(
-                    qcs["alt_freq_all_value"],
-                    lambda x: float(x),
-                    qcs["alt_freq_all_frequency"],
-                    lambda y: int(y),
-                ),
-            },
-        }
-    }
-
-    return payload
+    return _METRICS(raw_qc)
 
 
 def sendMetrics(metricsjson: dict, facilityName: str, analysispermID: str,
-                pipelinepermID: str, pipelinerunpermID: str, usrname: str, pw: str) -> None:
+                pipelinepermID: str, pipelinerunpermID: str, client: AeroClient) -> dict:
     
     """Send metrics to Aero API
 
@@ -122,48 +218,25 @@ def sendMetrics(metricsjson: dict, facilityName: str, analysispermID: str,
     :type pipelinepermID: str
     :param pipelinerunpermID: _description_
     :type pipelinerunpermID: str
-    :param usrname: FreeIPA username
-    :type usrname: str
-    :param pw: FreeIPA password
-    :type pw: str
+    :param client: shared Aero API client
+    :type client: AeroClient
+    :return: response json
+    :rtype: dict
     """
 
-    keycloackurl = 'https://keycloak.dev.ngc.dk/auth/realms/Ngc/protocol/openid-connect/token'
-    header = {'Content-Type': 'application/x-www-form-urlencoded'}
-    cert = '/usr/local/share/ca-certificates/CA-NGC.pem'
-
-    tokenjson = requests.post(keycloackurl, headers=header, verify=cert, data={'username': usrname,
-                                                                               'password': pw,
-                                                                               'scope': 'profile',
-                                                                               'grant_type': 'password',
-                                                                               'client_id': 'sqs-web'
-                                                                               })
-
-    keycloaktoken = tokenjson.json()['access_token']
-
-    # Show sent json:
-    sys.stdout.write('\nSENT:\n')
-    json.dump(metricsjson, sys.stdout, separators=(",", ":"), indent=2)
-
     # Send json as request to AeroAPI
-    posturlstart = 'https://aero-hpc.dev.ngc.dk/wgs-facilities/' + \
-        facilityName + '/qc/analyses/' + analysispermID
+    posturlstart = client.facilityURL(facilityName) + \
+        '/qc/analyses/' + analysispermID
     posturlend = '/metrics?pipelinePermID=' + pipelinepermID + \
         '&pipelineRunPermID=' + pipelinerunpermID
     posturl = posturlstart + posturlend
-    r = requests.post(
-        posturl,
-        json=metricsjson,
-        verify='/usr/local/share/ca-certificates/CA-NGC.pem',
-        headers={
-            'Authorization': 'Bearer {}'.format(keycloaktoken)})
+    r = client.post(posturl, json=metricsjson)
+
+    # Log the call, bodies only at debug level or on errors
+    logExchange(log, r)
+    r.raise_for_status()
 
-    # Print recieved info:
-    sys.stdout.write('\nRECIEVED GET JSON:\nStatus code: ' +
-                     str(r.status_code) + '\n')
-    sys.stdout.write('Trace ID: ' + r.headers.get('Trace-ID'))
-    sys.stdout.write('JSON:\n')
-    json.dump(r.json(), sys.stdout, indent=2)
+    return r.json()
 
 
 if __name__ == "__main__":
@@ -179,9 +252,8 @@ if __name__ == "__main__":
 
     args = parser.parse_args()
 
-    with args.qc_input.open("r") as src:
-        qc_payload = json.load(src)
-        reshaped = reshape(qc_payload)
+    qc_payload = extractQC(args.qc_input, METRICSPATHS)
+    reshaped = reshape(qc_payload)
 
     json.dump(reshaped, sys.stdout, sort_keys=True, separators=(",", ":"))
 
@@ -0,0 +1,66 @@
+"""
+All Aero API payloads of one sample from its QC json in a single pass.
+
+The specs of reshape_analysis, reshape_metrics, reshape_idsnp and reshape_flowcell are compiled
+together, so shared parts of the QC json are looked up once and every missing field of every
+payload is reported in one MissingFieldsError.
+canonicalJSON and payloadHash give a stable text and hash of a payload, for comparing it with what
+Aero accepted before.
+"""
+
+import hashlib
+import json
+
+from field_mapping import compileSpec
+import reshape_analysis as s2
+import reshape_idsnp as s4
+import reshape_metrics as s3
+import reshape_flowcell as s1
+
+PAYLOADSPEC = {
+    "analysis": s2.ANALYSISSPEC,
+    "metrics": s3.METRICSSPEC,
+    "idsnp": s4.IDSNPSPEC,
+    "flowcell": s1.FLOWCELLSPEC,
+    "flowcellSample": s1.FLOWCELLSAMPLESPEC,
+}
+_PAYLOADS = compileSpec(PAYLOADSPEC)
+
+
+def reshapeAll(raw_qc: dict, analysisTypePermID: str, pipelinePermID: str) -> dict:
+    """Reshape a dict of a qc json into all payloads for the Aero API
+
+    :param raw_qc: dictionary of qc json
+    :type raw_qc: dict
+    :param analysisTypePermID: as according to the Aero API
+    :type analysisTypePermID: str
+    :param pipelinePermID: as according to the Aero API
+    :type pipelinePermID: str
+    :raises MissingFieldsError: listing all fields missing from raw_qc
+    :return: {'analysis', 'metrics', 'idsnp', 'flowcell', 'flowcellSample'} payloads. flowcell has no samples list
+        and the details of idsnp are an IdsnpSites, written as JSON by reshape_idsnp.dumpsPayload
+    :rtype: dict
+    """
+    return _PAYLOADS(raw_qc, analysisTypePermID=analysisTypePermID,
+                     pipelinePermID=pipelinePermID)
+
+
+def canonicalJSON(payload) -> str:
+    """Compact JSON text with sorted keys, the same for payloads with the same content.
+    idsnp details given as IdsnpSites are written straight from their columns
+
+    :param payload: any payload of reshapeAll
+    :rtype: str
+    """
+    if isinstance(payload, dict) and isinstance(payload.get("details"), s4.IdsnpSites):
+        return s4.dumpsPayload(payload, separators=(",", ":"), sort_keys=True)
+    return json.dumps(payload, separators=(",", ":"), sort_keys=True)
+
+
+def payloadHash(payload) -> str:
+    """sha256 hex digest of canonicalJSON of a payload
+
+    :param payload: any payload of reshapeAll
+    :rtype: str
+    """
+    return hashlib.sha256(canonicalJSON(payload).encode("utf-8")).hexdigest()
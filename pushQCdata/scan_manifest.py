@@ -0,0 +1,113 @@
+"""
+Persisted manifest of the json files found by get_json_paths.py, so later scans are incremental.
+
+Stores path, size, mtime and last-seen time of every json file and the mtime of every shortname and
+sample folder. A folder whose mtime is unchanged since the last scan has the same entries, so its
+contents are taken from the manifest instead of being listed and stat'ed again.
+Files rewritten in place do not change their folder's mtime; use a full scan to pick those up.
+"""
+
+import sqlite3
+import time
+from collections import namedtuple
+from pathlib import Path
+
+# What the last scan saw. dirs: folder path -> mtime_ns, children: shortname folder ->
+# sample folder names, files: sample folder -> rows of path,check,facility,NBA,shortname,samplename,file,size,mtime
+KnownTree = namedtuple('KnownTree', ['dirs', 'children', 'files'])
+
+CHANGES = ('added', 'changed', 'removed')
+
+
+def knownTree(rows, dirs) -> KnownTree:
+    """What a scan saw, as needed by the next scan
+
+    :param rows: rows of path,check,facility,NBA,shortname,samplename,file,size,mtime
+    :type rows: Iterable
+    :param dirs: (path, parent, mtime) of the scanned folders. Shortname folders have parent ''
+    :type dirs: Iterable
+    :rtype: KnownTree
+    """
+    known = KnownTree({}, {}, {})
+    for path, parent, mtime in dirs:
+        known.dirs[path] = mtime
+        if parent:
+            known.children.setdefault(parent, []).append(path.rsplit('/', 1)[1])
+    for row in rows:
+        known.files.setdefault(row[0].rsplit('/', 1)[0], []).append(list(row))
+    return known
+
+
+class ScanManifest:
+    """SQLite backed manifest of a json folder tree
+
+    :param path: path to the manifest file. Created if it does not exist
+    :type path: Path
+    """
+
+    def __init__(self, path: Path):
+        self.path = str(path)
+        self._con = sqlite3.connect(self.path)
+        self._con.execute("""
+            CREATE TABLE IF NOT EXISTS files (
+                path TEXT PRIMARY KEY,
+                dir TEXT NOT NULL,
+                "check" TEXT, facility TEXT, NBA TEXT, shortname TEXT, samplename TEXT, file TEXT,
+                size INTEGER NOT NULL,
+                mtime INTEGER NOT NULL,
+                lastseen REAL NOT NULL
+            )""")
+        self._con.execute("""
+            CREATE TABLE IF NOT EXISTS dirs (
+                path TEXT PRIMARY KEY,
+                parent TEXT NOT NULL,
+                mtime INTEGER NOT NULL
+            )""")
+        self._con.commit()
+
+    def known(self) -> KnownTree:
+        """Load what the last scan saw
+
+        :rtype: KnownTree
+        """
+        return knownTree(
+            self._con.execute(
+                'SELECT path, "check", facility, NBA, shortname, samplename, file, size, mtime FROM files'),
+            self._con.execute('SELECT path, parent, mtime FROM dirs'))
+
+    def update(self, rows: list, dirs: list) -> list:
+        """Replace the manifest with the result of a scan and return what changed since the last one
+
+        :param rows: rows of path,check,facility,NBA,shortname,samplename,file,size,mtime for all files found
+        :type rows: list
+        :param dirs: (path, parent, mtime) of all scanned folders. Shortname folders have parent ''
+        :type dirs: list
+        :return: rows of path,check,facility,NBA,shortname,samplename,file,change with change
+            being one of 'added', 'changed' or 'removed'
+        :rtype: list
+        """
+        old = {row[0]: row[1:] for row in self._con.execute(
+            'SELECT path, "check", facility, NBA, shortname, samplename, file, size, mtime FROM files')}
+
+        delta = []
+        for row in rows:
+            previous = old.pop(row[0], None)
+            if previous is None:
+                delta.append(row[:7] + ['added'])
+            elif list(previous[6:8]) != list(row[7:9]):
+                delta.append(row[:7] + ['changed'])
+        for path, previous in old.items():
+            delta.append([path] + list(previous[:6]) + ['removed'])
+
+        now = time.time()
+        with self._con:
+            self._con.execute('DELETE FROM files')
+            self._con.execute('DELETE FROM dirs')
+            self._con.executemany(
+                'INSERT INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                ((row[0], row[0].rsplit('/', 1)[0], *row[1:9], now) for row in rows))
+            self._con.executemany('INSERT INTO dirs VALUES (?, ?, ?)', dirs)
+        return delta
+
+    def close(self) -> None:
+        self._con.close()
@@ -0,0 +1,179 @@
+"""
+Per-stage timings of the push pipeline, to tell whether a slow run waits on GPFS, CPU or the Aero API.
+
+Stages are timed where they happen (file read and json parse in qc_documents, reshaping in
+push_historic_files and reshape_flowcell, token fetch and every HTTP call in aero_client) with
+stage() or record(). Nothing is timed until enable() is called, so the default cost is one check.
+Every timing is written as one json line tagged with the sample and facility being pushed
+(set per thread with tags()) and, for HTTP calls, the Aero Trace-ID and the server time.
+summary() gives a histogram per stage at the end of the run.
+"""
+
+import bisect
+import contextlib
+import json
+import math
+import threading
+import time
+from pathlib import Path
+
+# Upper bounds in seconds of the histogram buckets of summary()
+BUCKETS = (0.001, 0.01, 0.1, 1.0, 10.0, math.inf)
+
+_timer = None
+_local = threading.local()
+
+
+class StageTimer:
+    """Collects timings and writes them as json lines
+
+    :param path: file the json lines are appended to. Timings are only kept in memory if not given
+    :type path: Path
+    """
+
+    def __init__(self, path: Path = None):
+        self.path = path
+        self.seconds = {}
+        self._lock = threading.Lock()
+        self._out = open(path, 'a', buffering=1) if path is not None else None
+
+    def record(self, stage: str, seconds: float, **fields) -> None:
+        """Store one timing, tagged with the tags of the calling thread and fields
+
+        :param stage: stage name, e.g. 'parse' or 'POST /qc/analyses'
+        :type stage: str
+        :param seconds: duration
+        :type seconds: float
+        """
+        entry = {'time': time.time(), 'stage': stage, 'seconds': seconds}
+        entry.update(getattr(_local, 'tags', {}))
+        entry.update(fields)
+        line = json.dumps(entry, default=str) + '\n' if self._out is not None else None
+        with self._lock:
+            self.seconds.setdefault(stage, []).append(seconds)
+            server = fields.get('server_seconds')
+            if server is not None:
+                self.seconds.setdefault(stage + ' (server)', []).append(server)
+            if line is not None:
+                self._out.write(line)
+
+    def summary(self) -> str:
+        """Table with count, total, p50, p99, max and a histogram per stage"""
+        header = '{:<44} {:>7} {:>9} {:>8} {:>8} {:>8}'.format(
+            'stage', 'count', 'total s', 'p50 ms', 'p99 ms', 'max ms')
+        header += ''.join(' {:>7}'.format(_bucketName(bound)) for bound in BUCKETS)
+        lines = [header]
+        with self._lock:
+            stages = {stage: sorted(values) for stage, values in self.seconds.items()}
+        for stage, values in sorted(stages.items()):
+            counts = [0] * len(BUCKETS)
+            for value in values:
+                counts[bisect.bisect_right(BUCKETS, value)] += 1
+            line = '{:<44} {:>7} {:>9.2f} {:>8.2f} {:>8.2f} {:>8.2f}'.format(
+                stage, len(values), sum(values), _percentile(values, 50) * 1000,
+                _percentile(values, 99) * 1000, values[-1] * 1000)
+            lines.append(line + ''.join(' {:>7}'.format(count) for count in counts))
+        return '\n'.join(lines) + '\n'
+
+    def close(self) -> None:
+        with self._lock:
+            if self._out is not None:
+                self._out.close()
+                self._out = None
+
+
+def _bucketName(bound: float) -> str:
+    if bound == math.inf:
+        return '>10s'
+    return '<{:g}ms'.format(bound * 1000) if bound < 1 else '<{:g}s'.format(bound)
+
+
+def _percentile(ordered: list, q: float) -> float:
+    # Nearest-rank percentile of a sorted list
+    rank = max(int(math.ceil(q / 100 * len(ordered))) - 1, 0)
+    return ordered[min(rank, len(ordered) - 1)]
+
+
+def enable(path: Path = None) -> StageTimer:
+    """Start timing stages in this process
+
+    :param path: file to write json lines to
+    :type path: Path
+    :return: the active timer
+    :rtype: StageTimer
+    """
+    global _timer
+    _timer = StageTimer(path)
+    return _timer
+
+
+def disable() -> StageTimer:
+    """Stop timing stages and close the active timer
+
+    :return: the timer that was active, for its summary. None if timing was not enabled
+    :rtype: StageTimer
+    """
+    global _timer
+    timer, _timer = _timer, None
+    if timer is not None:
+        timer.close()
+    return timer
+
+
+def enabled() -> bool:
+    return _timer is not None
+
+
+def record(stage: str, seconds: float, **fields) -> None:
+    """Store a timing measured by the caller. Does nothing unless enabled"""
+    timer = _timer
+    if timer is not None:
+        timer.record(stage, seconds, **fields)
+
+
+class _Stage:
+
+    __slots__ = ('timer', 'name', 'fields', 'start')
+
+    def __init__(self, timer: StageTimer, name: str, fields: dict):
+        self.timer = timer
+        self.name = name
+        self.fields = fields
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.timer.record(self.name, time.perf_counter() - self.start, **self.fields)
+
+
+_NOSTAGE = contextlib.nullcontext()
+
+
+def stage(name: str, **fields):
+    """Context manager timing the code it wraps as stage name. Does nothing unless enabled
+
+    :param name: stage name
+    :type name: str
+    """
+    timer = _timer
+    if timer is None:
+        return _NOSTAGE
+    return _Stage(timer, name, fields)
+
+
+def currentTags() -> dict:
+    """Tags set with tags() in the calling thread"""
+    return dict(getattr(_local, 'tags', {}))
+
+
+@contextlib.contextmanager
+def tags(**fields):
+    """Tag all timings recorded by this thread inside the block, e.g. tags(sample=..., facility=...)"""
+    old = getattr(_local, 'tags', {})
+    _local.tags = dict(old, **fields)
+    try:
+        yield
+    finally:
+        _local.tags = old
@@ -0,0 +1,50 @@
+"""
+The compiled field mapping against payloads written by the reshape functions it replaced.
+
+test_field_mapping.json holds QC documents and the analysis, metrics and idsnp payloads the
+reshape_* modules made of them before field_mapping.py, so the payloads of the specs must give
+the same text with json.dumps as the push writes them.
+"""
+
+import json
+from pathlib import Path
+
+import pytest
+
+import reshape_analysis as s2
+import reshape_idsnp as s4
+import reshape_metrics as s3
+from field_mapping import MissingFieldsError
+from reshape_payloads import reshapeAll
+
+with open(Path(__file__).with_suffix(".json")) as src:
+    CASES = json.load(src)
+
+
+def _dumps(payload) -> str:
+    return json.dumps(payload, indent=2)
+
+
+@pytest.mark.parametrize("case", CASES)
+def test_reshape_functions_match_previous_output(case):
+    document = case["document"]
+    assert _dumps(list(s2.reshapeAnalysis(document, "ANALYSISTYPE", "PIPELINE"))) == _dumps(case["analysis"])
+    assert _dumps(s3.reshape(document)) == _dumps(case["metrics"])
+    assert _dumps(s4.reshape(document)) == _dumps(case["idsnp"])
+
+
+@pytest.mark.parametrize("case", CASES)
+def test_reshapeAll_matches_previous_output(case):
+    payloads = reshapeAll(case["document"], "ANALYSISTYPE", "PIPELINE")
+    assert _dumps(payloads["analysis"]) == _dumps(case["analysis"][0])
+    assert _dumps(payloads["metrics"]) == _dumps(case["metrics"])
+    assert s4.dumpsPayload(payloads["idsnp"], indent=2) == _dumps(case["idsnp"])
+
+
+def test_missing_fields_are_reported_together():
+    document = json.loads(json.dumps(CASES[0]["document"]))
+    del document["germline_full"]["metrics"]["samples"][0]["QC_summary"]["pct_q30"]
+    del document["metadata"]["experiment_run"]["experiment_samples"][0]["sample_name"]
+    with pytest.raises(MissingFieldsError) as e:
+        reshapeAll(document, "ANALYSISTYPE", "PIPELINE")
+    assert "pct_q30" in str(e.value) and "sample_name" in str(e.value)
@@ -0,0 +1,46 @@
+import sqlite3
+
+from get_and_filter_analysis import AnalysisCache
+
+
+def test_cache_is_kept_per_facility(tmp_path):
+    cache = AnalysisCache(tmp_path / "analyses.sqlite")
+    cache.put("A1", "wgs-east", {"lastUpdateDatetime": "2024-01-01", "source": "east"})
+    cache.put("A1", "wgs-west", {"lastUpdateDatetime": "2024-01-01", "source": "west"})
+    assert cache.get("A1", "wgs-east", "2024-01-01")["source"] == "east"
+    assert cache.get("A1", "wgs-west", "2024-01-01")["source"] == "west"
+    assert cache.get("A1", "wgs-north", "2024-01-01") is None
+
+    cache.put("A1", "wgs-east", {"lastUpdateDatetime": "2024-02-01", "source": "east again"})
+    assert cache.get("A1", "wgs-east", "2024-02-01")["source"] == "east again"
+    cache.close()
+
+
+def test_cache_serves_only_current_analyses(tmp_path):
+    cache = AnalysisCache(tmp_path / "analyses.sqlite")
+    cache.put("A1", "wgs-east", {"lastUpdateDatetime": "2024-01-01", "evalStatus": "pending"})
+    # Expired by default, as the analysis may have been patched since
+    assert cache.get("A1", "wgs-east") is None
+    assert cache.get("A1", "wgs-east", maxage=3600)["evalStatus"] == "pending"
+    assert cache.get("A1", "wgs-east", maxage=-1) is None
+    # A known lastUpdateDatetime decides at any age
+    assert cache.get("A1", "wgs-east", "2024-01-01", maxage=-1)["evalStatus"] == "pending"
+    assert cache.get("A1", "wgs-east", "2024-03-01", maxage=3600) is None
+    cache.close()
+
+
+def test_cache_drops_files_keyed_without_facility(tmp_path):
+    path = tmp_path / "analyses.sqlite"
+    con = sqlite3.connect(path)
+    con.execute("CREATE TABLE analyses (permID TEXT NOT NULL, lastUpdateDatetime TEXT NOT NULL, "
+                "facility TEXT NOT NULL, analysis TEXT NOT NULL, fetched REAL NOT NULL, "
+                "PRIMARY KEY (permID, lastUpdateDatetime))")
+    con.execute("INSERT INTO analyses VALUES ('A1', '', 'wgs-east', '{}', 0)")
+    con.commit()
+    con.close()
+
+    cache = AnalysisCache(path)
+    assert cache.get("A1", "wgs-east", "") is None
+    cache.put("A1", "wgs-east", {"source": "east"})
+    cache.close()
+    assert AnalysisCache(path).get("A1", "wgs-east", "") == {"source": "east"}
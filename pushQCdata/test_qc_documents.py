@@ -0,0 +1,28 @@
+import json
+import os
+
+from qc_documents import QCDocuments
+
+
+def _writeSummary(path, samplename: str) -> None:
+    path.write_text(json.dumps({"metadata": {"experiment_run": {"samplename": samplename}}}))
+
+
+def test_get_rereads_rewritten_file(tmp_path):
+    jsonpath = tmp_path / "summary.json"
+    _writeSummary(jsonpath, "S1")
+    documents = QCDocuments()
+    assert documents.get(jsonpath)["metadata"]["experiment_run"]["samplename"] == "S1"
+    assert documents.get(jsonpath)["metadata"]["experiment_run"]["samplename"] == "S1"
+    assert (documents.hits, documents.misses) == (1, 1)
+
+    # Same size, only the mtime tells the rewrite apart
+    _writeSummary(jsonpath, "S2")
+    stat = os.stat(jsonpath)
+    os.utime(jsonpath, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000))
+    assert documents.get(jsonpath)["metadata"]["experiment_run"]["samplename"] == "S2"
+
+    _writeSummary(jsonpath, "S300")
+    assert documents.get(jsonpath)["metadata"]["experiment_run"]["samplename"] == "S300"
+    assert documents.misses == 3
+    assert documents._size == os.path.getsize(jsonpath)
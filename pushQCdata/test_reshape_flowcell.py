@@ -0,0 +1,50 @@
+import copy
+import json
+from pathlib import Path
+
+from json_list import JsonRow, flowcellGroup
+from reshape_flowcell import streamFlowcellJsons
+
+with open(Path(__file__).with_name("test_field_mapping.json")) as src:
+    DOCUMENT = json.load(src)[0]["document"]
+
+
+def _rows(tmp_path, flowcells: list, runnumbers: list) -> list:
+    rows = []
+    for i, (flowcellID, runnumber) in enumerate(zip(flowcells, runnumbers)):
+        document = copy.deepcopy(DOCUMENT)
+        er = document["metadata"]["experiment_run"]
+        er["flowcell_id"] = [flowcellID]
+        er["run_number"] = [runnumber]
+        er["experiment_samples"][0]["sample_name"] = "S{}".format(i)
+        path = tmp_path / "S{}.json".format(i)
+        path.write_text(json.dumps(document))
+        rows.append(JsonRow(str(path), "passed", "wgs_east", "NBA2", "200622_A00559_0210_A" + flowcellID,
+                            "S{}".format(i), "summary.json"))
+    return rows
+
+
+def _expected(rows: list) -> dict:
+    expected = {}
+    for row in rows:
+        expected[flowcellGroup(row)] = expected.get(flowcellGroup(row), 0) + 1
+    return expected
+
+
+def test_flowcell_is_handed_out_before_its_samples(tmp_path):
+    rows = _rows(tmp_path, ["FC1", "FC1", "FC2"], [210, 210, 211])
+    events = [(event, key if event == "flowcell" else key.samplename)
+              for event, key, _ in streamFlowcellJsons(rows, _expected(rows))]
+    assert events == [("flowcell", "FC1-wgs_east"), ("sample", "S0"), ("sample", "S1"),
+                      ("flowcell", "FC2-wgs_east"), ("sample", "S2")]
+
+
+def test_disagreeing_flowcell_is_held_back(tmp_path):
+    rows = _rows(tmp_path, ["FC1", "FC2", "FC1", "FC1", "FC3"], [210, 211, 210, 999, 212])
+    events = list(streamFlowcellJsons(rows, _expected(rows)))
+    handedout = [(event, key if event == "flowcell" else key.samplename) for event, key, _ in events]
+    assert handedout == [("flowcell", "FC2-wgs_east"), ("sample", "S1"),
+                         ("mismatch", "S0"), ("mismatch", "S2"), ("mismatch", "S3"),
+                         ("flowcell", "FC3-wgs_east"), ("sample", "S4")]
+    problems = {problem for event, _, problem in events if event == "mismatch"}
+    assert len(problems) == 1 and "FC1-wgs_east" in problems.pop()
@@ -0,0 +1,15 @@
+from decimal import Decimal
+
+from reshape_metrics import adj_pct_float, parseList
+
+
+def test_parseList_keeps_integers_outside_int64():
+    assert parseList("1;99999999999999999999;3", int) == [1, 99999999999999999999, 3]
+    assert parseList("-99999999999999999999;2", int) == [-99999999999999999999, 2]
+    assert parseList("9223372036854775807;-9223372036854775808", int) == [2 ** 63 - 1, -2 ** 63]
+    assert parseList("1;2;3", int) == [1, 2, 3]
+
+
+def test_adj_pct_float_matches_decimal_beyond_float_range():
+    for x in ("1.7976931348623157e308", "9652034751.271e299", "-1.7976931348623157e308", "0.9312", "1e-330", 0.1234567):
+        assert adj_pct_float(x) == float(Decimal(str(x)) * 100)
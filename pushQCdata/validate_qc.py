@@ -0,0 +1,206 @@
+"""
+Pre-flight validation of the json files of a path list, before anything is sent to Aero.
+
+Every file is read and reshaped in parallel with the same compiled specs the push uses, one
+payload at a time, so unreadable files, missing fields and failed checks (one idsnp comparison,
+equal histogram lengths, ...) of all payloads are found up front. The samples of each flowcell
+are then checked against each other as reshape_flowcell does during the push. A flowcell whose
+samples disagree fails the whole push, so all its rows are held back.
+
+All problems are written to one report, path,samplename,kind,problem, and the rows without
+problems to a clean list to give to push_historic_files.py.
+
+Input: csv file from get_json_paths.py
+Output: clean csv list and the report csv
+"""
+
+import argparse
+import csv
+import sys
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+from field_mapping import MissingFieldsError, compileSpec
+from json_list import JsonRow, readJsonList, writeJsonList
+from push_historic_files import ANALYSISTYPEPERMID, PIPELINEPERMID
+from qc_documents import loadJSON
+from reshape_payloads import PAYLOADSPEC, canonicalJSON
+import reshape_flowcell as s1
+
+# Values of the check column the analysis patch knows
+CHECKS = ("pass", "passed", "fail", "failed")
+
+# Each payload compiled on its own, so a failing converter in one does not hide problems in the others
+_PAYLOADS = {kind: compileSpec(spec) for kind, spec in PAYLOADSPEC.items()}
+
+
+def _problem(e: Exception) -> tuple:
+    if isinstance(e, MissingFieldsError):
+        return "missing fields", str(e)
+    if isinstance(e, AssertionError):
+        if str(e):
+            return "failed check", str(e)
+        # Bare asserts only tell where they are
+        frame = traceback.extract_tb(e.__traceback__)[-1]
+        return "failed check", "{} at {}:{}".format(frame.line, Path(frame.filename).name, frame.lineno)
+    return "invalid value", "{}: {}".format(type(e).__name__, e)
+
+
+def validateFile(row: JsonRow) -> tuple:
+    """Problems of one json file on its own. Runs in a worker process
+
+    :param row: csv row of the file
+    :type row: JsonRow
+    :return: list of (kind, problem) and, if it could be reshaped, (flowcell key, flowcell fields,
+        fields to check against the other samples)
+    :rtype: tuple
+    """
+    problems = []
+    if row.check not in CHECKS:
+        problems.append(("unknown check", "check {!r} is none of {}".format(row.check, ", ".join(CHECKS))))
+    try:
+        raw_qc = loadJSON(row.path)
+    except (OSError, ValueError) as e:
+        problems.append(("unreadable", "{}: {}".format(type(e).__name__, e)))
+        return problems, None
+
+    for kind, build in _PAYLOADS.items():
+        try:
+            canonicalJSON(build(raw_qc, analysisTypePermID=ANALYSISTYPEPERMID, pipelinePermID=PIPELINEPERMID))
+        except Exception as e:
+            kindname, problem = _problem(e)
+            problems.append((kindname, kind + ": " + problem))
+
+    try:
+        flowcellkey, flowcell, _, checklist = s1.flowcellParts(row.path, raw_qc)
+    except Exception as e:
+        problems.append(_problem(e))
+        return problems, None
+    return problems, (flowcellkey, flowcell, checklist)
+
+
+def validateList(rows: list, processes: int = 4, chunksize: int = 16) -> dict:
+    """Validate all files of a path list
+
+    :param rows: rows of a json path csv
+    :type rows: list
+    :param processes: number of worker processes
+    :type processes: int
+    :param chunksize: number of files handed to a worker at a time
+    :type chunksize: int
+    :return: {path: list of (kind, problem)} of the files with problems
+    :rtype: dict
+    """
+    problems = {}
+    # Per flowcell key: fields of its first sample, paths of all its samples and of those disagreeing
+    flowcells = {}
+    members = {}
+    disagreeing = {}
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        for row, (fileproblems, parts) in zip(rows, executor.map(validateFile, rows, chunksize=chunksize)):
+            if fileproblems:
+                problems[row.path] = list(fileproblems)
+            if parts is None:
+                continue
+            # Checked in list order against the first sample of the flowcell, like the push does
+            flowcellkey, flowcell, checklist = parts
+            members.setdefault(flowcellkey, []).append(row.path)
+            if flowcellkey not in flowcells:
+                flowcells[flowcellkey] = flowcell
+                continue
+            try:
+                s1.checkFlowcell(flowcells[flowcellkey], flowcell, checklist, row.path)
+            except SystemExit as e:
+                problems.setdefault(row.path, []).append(
+                    ("flowcell mismatch", " ".join(str(e).split("\n"))))
+                disagreeing.setdefault(flowcellkey, []).append(row.path)
+
+    # Hold back the other samples of flowcells that disagree
+    for flowcellkey, paths in disagreeing.items():
+        for jsonpath in members[flowcellkey]:
+            if jsonpath not in paths:
+                problems.setdefault(jsonpath, []).append(
+                    ("flowcell mismatch", "flowcell {} has samples that disagree: {}".format(
+                        flowcellkey, ", ".join(paths))))
+    return problems
+
+
+def writeReport(path: Path, rows: list, problems: dict) -> None:
+    """Write the problems as csv of path,samplename,kind,problem
+
+    :param path: report file
+    :type path: Path
+    :param rows: rows of the validated list
+    :type rows: list
+    :param problems: output of validateList
+    :type problems: dict
+    """
+    with open(path, "w", newline="") as out:
+        writer = csv.writer(out, lineterminator="\n")
+        writer.writerow(("path", "samplename", "kind", "problem"))
+        for row in rows:
+            for kind, problem in problems.get(row.path, ()):
+                writer.writerow((row.path, row.samplename, kind, problem))
+
+
+def summary(rows: list, problems: dict) -> str:
+    """Number of files with problems and number of problems of each kind"""
+    kinds = {}
+    for fileproblems in problems.values():
+        for kind, _ in fileproblems:
+            kinds[kind] = kinds.get(kind, 0) + 1
+    lines = ["{} of {} files have problems".format(len(problems), len(rows))]
+    lines += ["  {:<20} {}".format(kind, count) for kind, count in sorted(kinds.items())]
+    return "\n".join(lines) + "\n"
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawTextHelpFormatter,
+        description=__doc__)
+    parser.add_argument(
+        "qc_list_input",
+        type=Path,
+        help="Path to file with list of json paths. Genereated by get_json_paths.py",
+    )
+    parser.add_argument(
+        "clean_list",
+        type=Path,
+        help="csv file to write the rows without problems to, for push_historic_files.py",
+    )
+    parser.add_argument(
+        "--report",
+        type=Path,
+        help="csv file to write all problems to, path,samplename,kind,problem. Default: <clean_list>.report.csv",
+    )
+    parser.add_argument(
+        "--processes",
+        type=int,
+        default=4,
+        help="Number of processes to validate with",
+    )
+    parser.add_argument(
+        "--chunksize",
+        type=int,
+        default=16,
+        help="Number of files handed to a process at a time",
+    )
+    parser.add_argument(
+        "--strict",
+        action="store_true",
+        help="Exit with status 1 if any file has a problem. The clean list is written either way",
+    )
+    args = parser.parse_args()
+
+    rows = list(readJsonList(args.qc_list_input))
+    problems = validateList(rows, args.processes, args.chunksize)
+    writeJsonList(args.clean_list, (row for row in rows if row.path not in problems))
+    report = args.report or args.clean_list.with_suffix(".report.csv")
+    writeReport(report, rows, problems)
+    sys.stderr.write(summary(rows, problems))
+    if problems:
+        sys.stderr.write("Report: {}\n".format(report))
+        if args.strict:
+            sys.exit(1)
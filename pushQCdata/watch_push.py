@@ -0,0 +1,515 @@
+"""
+Watches the json folder tree and pushes each new QC json to Aero a short while after it lands.
+
+The tree is scanned like get_json_paths.py --manifest does, only listing folders whose mtime
+changed, every --interval seconds. Where inotify works the scan also runs as soon as a watched
+folder changes. On GPFS inotify only sees changes made on the local node, so polling stays on as
+a fallback. Use --poll to not use inotify at all.
+
+A new file is pushed once its size and mtime have not changed for --settle seconds and it parses,
+so files still being written are left alone. Its flowcell is registered first, with all samples of
+its shortname folder, through a flowcell index (see flowcell_index.py). Pushed files are remembered
+for the life of the process. Use --journal to also not push them again after a restart.
+Files rewritten in place do not change their folder's mtime and are not seen.
+
+Input: json folder path, /<check>/<facility>/<NBA>/<shortname>/<samplename>/<file.json> below it
+Output: api request calls for every json file that lands in the tree
+"""
+
+import argparse
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import signal
+import sys
+import time
+from pathlib import Path
+
+from aero_client import COMPRESSROUTES, AdaptiveLimiter, AeroClient, facilityNameFromLabID
+from batch_mode import SamplePolicy, loadPolicy, readCredentials
+import call_log
+from field_mapping import MissingFieldsError
+from flowcell_index import FlowcellIndex
+from get_json_paths import NBA, scanTree
+from json_list import JsonRow
+from push_engine import PushEngine, parseFacilityLimits
+from push_historic_files import handleFlowcell, pushSample
+from push_journal import PushJournal
+from qc_documents import QCDocuments
+from scan_manifest import KnownTree, knownTree
+
+log = logging.getLogger(__name__)
+
+# Seconds before a file whose push failed is tried again
+RETRYDELAY = 300
+
+# inotify events on a folder that can mean a new json file below it:
+# IN_ATTRIB, IN_CLOSE_WRITE, IN_MOVED_TO, IN_CREATE and IN_DELETE
+_INMASK = 0x004 | 0x008 | 0x080 | 0x100 | 0x200
+
+
+def _subfolders(path: str) -> list:
+    try:
+        with os.scandir(path) as it:
+            return [entry.path for entry in it if not entry.name.startswith('.') and entry.is_dir()]
+    except (FileNotFoundError, NotADirectoryError, PermissionError):
+        return []
+
+
+class FolderEvents:
+    """Wakes the watcher when a watched folder changes, using inotify through libc. Without inotify,
+    wait() only sleeps
+
+    :param enabled: try to use inotify
+    :type enabled: bool
+    """
+
+    def __init__(self, enabled: bool = True):
+        self.fd = None
+        self.watched = set()
+        if not enabled or not sys.platform.startswith('linux'):
+            return
+        try:
+            self._libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        except (OSError, AttributeError):
+            fd = -1
+        if fd < 0:
+            log.warning("inotify is not available, polling only")
+            return
+        self.fd = fd
+
+    def watch(self, paths) -> None:
+        """Watch folders not watched yet. Stops using inotify if the watch limit is reached
+
+        :param paths: folder paths
+        :type paths: Iterable[str]
+        """
+        for path in paths:
+            if self.fd is None:
+                return
+            if path in self.watched:
+                continue
+            if self._libc.inotify_add_watch(self.fd, os.fsencode(path), _INMASK) < 0:
+                errno = ctypes.get_errno()
+                if errno == 28:  # ENOSPC, fs.inotify.max_user_watches reached
+                    log.warning("inotify watch limit reached after %d folders, polling only", len(self.watched))
+                    self.close()
+                    return
+                continue
+            self.watched.add(path)
+
+    def wait(self, timeout: float) -> bool:
+        """Wait until a watched folder changes or timeout seconds have passed
+
+        :return: whether a folder changed
+        :rtype: bool
+        """
+        if self.fd is None:
+            time.sleep(timeout)
+            return False
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return False
+        # The events themselves are not needed, the scan finds what changed
+        try:
+            while os.read(self.fd, 65536):
+                pass
+        except BlockingIOError:
+            pass
+        return True
+
+    def close(self) -> None:
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+            self.watched.clear()
+
+
+class Watcher:
+    """Finds new json files in the folder tree and pushes each once it has settled
+
+    :param path: root of the json folder tree
+    :type path: Path
+    :param resulthandling: 'send' will send to Aero API or input a path to save locally
+    :type resulthandling: str
+    :param client: shared Aero API client
+    :type client: AeroClient
+    :param engine: runs the samples concurrently
+    :type engine: PushEngine
+    :param index: flowcell index the flowcells are registered from
+    :type index: FlowcellIndex
+    :param documents: parsed document cache shared between the settle check and the push
+    :type documents: QCDocuments
+    :param journal: journal of finished calls
+    :type journal: PushJournal
+    :param policy: only push the samples it selects
+    :type policy: SamplePolicy
+    :param settle: seconds a file's size and mtime must be unchanged before it is pushed
+    :type settle: float
+    :param sync: push files again when they change, as delta syncs
+    :type sync: bool
+    :param backfill: also push the files already in the tree at the first scan
+    :type backfill: bool
+    :param workers: number of folders scanned at the same time
+    :type workers: int
+    """
+
+    def __init__(self, path: Path, resulthandling: str, client: AeroClient, engine: PushEngine,
+                 index: FlowcellIndex, documents: QCDocuments, journal: PushJournal = None,
+                 policy: SamplePolicy = None, settle: float = 30, sync: bool = False,
+                 backfill: bool = False, workers: int = 16):
+        self.path = path
+        self.resulthandling = resulthandling
+        self.client = client
+        self.engine = engine
+        self.index = index
+        self.documents = documents
+        self.journal = journal
+        self.policy = policy
+        self.settle = settle
+        self.sync = sync
+        self.backfill = backfill
+        self.workers = workers
+        self.known = KnownTree({}, {}, {})
+        self.scanned = False
+        # path -> (size, mtime) of files pushed, skipped by the policy or found at the first scan
+        self.done = {}
+        # path -> (size, mtime) of files that cannot be added to their flowcell, until they change
+        self.rejected = {}
+        # path -> ((size, mtime), time that state was first seen) of files waiting to settle
+        self.pending = {}
+        # path -> time of the last failed push
+        self.failedat = {}
+        self.inflight = set()
+
+    def scan(self) -> tuple:
+        """Scan the tree, only listing changed folders
+
+        :return: rows of all json files and (path, parent, mtime) of the scanned folders
+        :rtype: tuple
+        """
+        rows, dirs = scanTree(self.path, self.known, self.workers)
+        self.known = knownTree(rows, dirs)
+        return rows, dirs
+
+    def topFolders(self) -> list:
+        """Folders above the shortname folders, which also need watching for new folders"""
+        folders = [str(self.path)]
+        for check in _subfolders(str(self.path)):
+            folders.append(check)
+            for facility in _subfolders(check):
+                folders.append(facility)
+                if os.path.isdir(os.path.join(facility, NBA)):
+                    folders.append(os.path.join(facility, NBA))
+        return folders
+
+    def _settled(self, row: list, now: float) -> bool:
+        # True once the file stopped changing and parses
+        try:
+            stat = os.stat(row[0])
+        except FileNotFoundError:
+            self.pending.pop(row[0], None)
+            return False
+        state = (stat.st_size, stat.st_mtime_ns)
+        self._remember(row[0], state)
+        previous = self.pending.get(row[0])
+        if previous is None or previous[0] != state:
+            self.pending[row[0]] = (state, now)
+            return self.settle <= 0 and self._parses(row[0], now, state)
+        return now - previous[1] >= self.settle and self._parses(row[0], now, state)
+
+    def _remember(self, jsonpath: str, state: tuple) -> None:
+        # Folders with an unchanged mtime are not listed again, so their files keep the size and
+        # mtime of when they were listed. Keep those up to date for files that grew since
+        for row in self.known.files.get(jsonpath.rsplit('/', 1)[0], ()):
+            if row[0] == jsonpath:
+                row[7:9] = state
+
+    def _parses(self, jsonpath: str, now: float, state: tuple) -> bool:
+        try:
+            self.documents.get(jsonpath)
+        except ValueError:
+            # Still being written, or written without a final flush. Wait for it to change
+            self.pending[jsonpath] = (state, now)
+            log.debug("%s does not parse yet", jsonpath)
+            return False
+        return True
+
+    def tick(self, now: float = None) -> list:
+        """Scan once and push every file that has settled
+
+        :param now: current time, for tests
+        :type now: float
+        :return: rows queued for pushing
+        :rtype: list
+        """
+        now = time.time() if now is None else now
+        rows, _ = self.scan()
+        first = not self.scanned
+        self.scanned = True
+
+        ready = []
+        for row in rows:
+            jsonpath = row[0]
+            state = tuple(row[7:9])
+            if jsonpath in self.inflight or self.rejected.get(jsonpath) == state:
+                continue
+            done = self.done.get(jsonpath)
+            if first and not self.backfill:
+                self.done[jsonpath] = state
+                continue
+            if done is not None:
+                if done == state:
+                    continue
+                if not self.sync:
+                    log.warning("%s changed after it was pushed, use --sync to push changes", jsonpath)
+                    self.done[jsonpath] = state
+                    continue
+            jsonrow = JsonRow(*row[:7])
+            if self.policy is not None and not self.policy.selects(jsonrow):
+                self.done[jsonpath] = state
+                continue
+            if now - self.failedat.get(jsonpath, 0) < RETRYDELAY:
+                continue
+            if self._settled(row, now):
+                ready.append(jsonrow)
+        for jsonpath in set(self.pending) - {row[0] for row in rows}:
+            del self.pending[jsonpath]
+        if not ready:
+            return []
+        return self.push(ready, rows)
+
+    def push(self, ready: list, rows: list) -> list:
+        """Register the flowcells of ready rows and queue the rows
+
+        :param ready: settled rows to push
+        :type ready: list
+        :param rows: all rows of the last scan, for the other samples of the flowcells
+        :type rows: list
+        :return: rows queued for pushing
+        :rtype: list
+        """
+        # Every readable sample of the same shortname folders goes into the flowcell
+        shortnames = {(row.check, row.facility, row.shortname) for row in ready}
+        readypaths = {row.path for row in ready}
+        siblings = [row for row in rows if tuple(row[1:3]) + (row[4],) in shortnames
+                    and row[0] not in readypaths and row[0] in self.done]
+        rejected = set()
+        for row in siblings + ready:
+            try:
+                self.index.merge([row], self.documents)
+            except (SystemExit, MissingFieldsError, ValueError, OSError) as e:
+                log.error("%s is not pushed, it cannot be added to its flowcell: %s", row[0], e)
+                if row[0] in readypaths:
+                    self.rejected[row[0]] = self.pending.pop(row[0])[0]
+                    rejected.add(row[0])
+
+        failedflowcells = set()
+        for flowcellid in self.index.changed():
+            try:
+                handleFlowcell(flowcellid, self.index.flowcell(flowcellid), self.resulthandling,
+                               self.client, self.journal, True)
+            except Exception as e:
+                log.error("Flowcell %s failed, its samples are tried again later: %s", flowcellid, e)
+                failedflowcells.add(flowcellid)
+                continue
+            self.index.markEmitted(flowcellid)
+
+        queued = []
+        for row in ready:
+            if row.path in rejected:
+                continue
+            if self.index.flowcellKey(row.path) in failedflowcells:
+                self.failedat[row.path] = time.time()
+                self.pending.pop(row.path)
+                continue
+            state = self.pending.pop(row.path)[0]
+            self.inflight.add(row.path)
+            self.engine.submit(facilityNameFromLabID(row.facility), row.samplename, self._pushOne, row, state)
+            queued.append(row)
+        return queued
+
+    def _pushOne(self, row: JsonRow, state: tuple) -> None:
+        try:
+            pushSample(row.path, row.check, self.resulthandling, self.client, self.journal,
+                       self.documents, self.sync)
+        except BaseException:
+            self.failedat[row.path] = time.time()
+            raise
+        else:
+            self.done[row.path] = state
+            self.rejected.pop(row.path, None)
+            self.failedat.pop(row.path, None)
+            log.info("Pushed %s", row.path)
+        finally:
+            self.inflight.discard(row.path)
+
+    def run(self, interval: float, events: FolderEvents) -> None:
+        """Scan and push until interrupted
+
+        :param interval: max seconds between scans
+        :type interval: float
+        :param events: wakes the loop when a watched folder changes
+        :type events: FolderEvents
+        """
+        while True:
+            self.tick()
+            events.watch(self.topFolders())
+            events.watch(self.known.dirs)
+            # Wake up in time for files waiting to settle
+            timeout = interval
+            if self.pending:
+                timeout = min(timeout, max(min(since for _, since in self.pending.values())
+                                           + self.settle - time.time(), 0) + 0.1)
+            events.wait(timeout)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawTextHelpFormatter,
+        description=__doc__)
+    parser.add_argument(
+        "inpath",
+        type=Path,
+        help="Path to the json folder tree, as given to get_json_paths.py",
+    )
+    parser.add_argument(
+        "resulthandling",
+        type=str,
+        help="Define if results should be sent or saved to file [send / pathToSaveDir]",
+    )
+    parser.add_argument(
+        "--interval",
+        type=float,
+        default=60,
+        help="Max seconds between scans of the tree",
+    )
+    parser.add_argument(
+        "--settle",
+        type=float,
+        default=30,
+        help="Seconds a file must stay unchanged before it is pushed",
+    )
+    parser.add_argument(
+        "--poll",
+        action="store_true",
+        help="Do not use inotify, only scan every --interval seconds",
+    )
+    parser.add_argument(
+        "--backfill",
+        action="store_true",
+        help="Also push the files already in the tree when the watcher starts. Use with --journal",
+    )
+    parser.add_argument(
+        "--scan-workers",
+        type=int,
+        default=16,
+        help="Number of folders scanned at the same time",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of samples to push concurrently. Calls within a sample keep their order",
+    )
+    parser.add_argument(
+        "--facility-limit",
+        action="append",
+        metavar="FACILITY=N",
+        help="Max number of concurrent samples for one facility, e.g. wgs-east=4. Can be given more than once",
+    )
+    parser.add_argument(
+        "--policy",
+        type=Path,
+        help="json file selecting samples by check, facility, flowcell, shortname or samplename patterns",
+    )
+    parser.add_argument(
+        "--credentials",
+        type=Path,
+        help="File with the username on the first line and the password on the second. Without it the\n"
+             "AERO_USERNAME and AERO_PASSWORD environment variables are used, or else prompted for",
+    )
+    parser.add_argument(
+        "--journal",
+        type=Path,
+        help="SQLite file recording finished calls per sample, so a restarted watcher does not push them again",
+    )
+    parser.add_argument(
+        "--sync",
+        action="store_true",
+        help="With --journal: push files again when they change, sending only what changed",
+    )
+    parser.add_argument(
+        "--flowcell-index",
+        type=Path,
+        default=":memory:",
+        help="SQLite file indexing flowcells and their samples. Kept in memory if not given",
+    )
+    parser.add_argument(
+        "--cache-mb",
+        type=int,
+        default=512,
+        help="Memory bound in MB for parsed jsons kept between the settle check and the push",
+    )
+    parser.add_argument(
+        "--retries",
+        type=int,
+        default=5,
+        help="Max retries of a failed Aero API call. POST and PATCH are only retried when throttled (429)",
+    )
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        default=120,
+        help="Seconds to wait for an Aero API response",
+    )
+    parser.add_argument(
+        "--gzip",
+        nargs="*",
+        metavar="ROUTE",
+        help="gzip request bodies of these routes. Without routes: the metrics and idsnp-check posts",
+    )
+    parser.add_argument(
+        "--log-level",
+        default="INFO",
+        choices=("DEBUG", "INFO", "WARNING", "ERROR"),
+        help="INFO logs one line per API call, DEBUG also the full request and response bodies",
+    )
+    args = parser.parse_args()
+    if args.sync and not args.journal:
+        parser.error("--sync needs --journal, which keeps what Aero last accepted")
+    call_log.configure(args.log_level)
+
+    policy = loadPolicy(args.policy) if args.policy else None
+    client = None
+    # Saving locally needs no credentials
+    if args.resulthandling == "send":
+        usrname, pw = readCredentials(args.credentials)
+        compress = () if args.gzip is None else (args.gzip or COMPRESSROUTES)
+        client = AeroClient(usrname, pw, timeout=(10, args.timeout), retries=args.retries,
+                            limiter=AdaptiveLimiter(max(args.workers, 1)), compress=compress)
+    engine = PushEngine(args.workers, parseFacilityLimits(args.facility_limit))
+    journal = PushJournal(args.journal) if args.journal else None
+    index = FlowcellIndex(args.flowcell_index)
+    watcher = Watcher(args.inpath, args.resulthandling, client, engine, index,
+                      QCDocuments(args.cache_mb * 1024 ** 2), journal, policy, args.settle,
+                      args.sync, args.backfill, args.scan_workers)
+    events = FolderEvents(not args.poll)
+
+    # Stop cleanly on SIGTERM as on Ctrl-C, after the samples in flight
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    try:
+        watcher.run(args.interval, events)
+    except KeyboardInterrupt:
+        log.info("Stopping, waiting for the samples in flight")
+    events.close()
+    engine.shutdown()
+    if client is not None:
+        client.close()
+    index.close()
+    if journal is not None:
+        journal.close()